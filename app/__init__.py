@@ -1,4 +1,5 @@
 import os
+import time
 from flask import Flask
 from models import db
 
@@ -12,13 +13,37 @@ def create_app(config_object=None):
     app.config['SECRET_KEY'] = 'dev'
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sns.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if config_object is not None:
+        if isinstance(config_object, dict):
+            app.config.from_mapping(config_object)
+        else:
+            app.config.from_object(config_object)
 
     # Uploads
-    upload_folder = os.path.join(app.instance_path, 'uploads')
+    upload_folder = app.config.setdefault('UPLOAD_FOLDER', os.path.join(app.instance_path, 'uploads'))
     os.makedirs(upload_folder, exist_ok=True)
-    app.config['UPLOAD_FOLDER'] = upload_folder
+    # 用途別ディレクトリの下をハッシュで分散させる配置（flask migrate-uploads）
+    from app import uploads
+    uploads.init_app(app)
 
+    # SQLite の本番プロファイル（WAL・PRAGMA・プール・読み取り専用エンジン）
+    from app import sqlite_profile
+    sqlite_profile.configure(app)
+    # メッセージ用の DB（MESSAGES_DATABASE_URI があれば別ファイル、なければ既定のエンジンを共有）
+    from app import databases
+    databases.configure(app)
     db.init_app(app)
+    databases.init_app(app, db)
+    sqlite_profile.init_app(app, db)
+    # リクエスト単位の性能計測（PERF_ENABLED のときのみ）
+    from app import perf
+    perf.init_app(app, db)
+    # Prometheus 形式のメトリクス（METRICS_ENABLED のときのみ）
+    from app import metrics
+    metrics.init_app(app, db)
+    # スロークエリログ（SLOW_QUERY_ENABLED のときのみ）
+    from app import slow_query
+    slow_query.init_app(app, db)
 
     from datetime import datetime, timezone
 
@@ -54,21 +79,84 @@ def create_app(config_object=None):
         return f"{years}年前"
 
     def build_upload_path(filename, upload_type):
-        """テンプレート内で用途別ディレクトリパスを生成"""
-        if not filename:
-            return ''
-        return f"{upload_type}/{filename}"
+        """テンプレート内で用途別ディレクトリパスを生成（実際の配置は uploaded_file が解決する）"""
+        return uploads.url_path(filename, upload_type)
 
+    from app import schema, startup
     with app.app_context():
         from app import routes  # imports views
         app.register_blueprint(routes.bp)
-        db.create_all()
-
-        # NOTE: Schema changes are intentionally not applied automatically.
-        # If you add/remove columns, run migrations manually with your preferred tool.
+        # PRAGMA user_version が最新なら create_all を省く
+        # NOTE: 列の追加などは schema.SCHEMA_VERSION を上げて schema.UPGRADES に手順を書く
+        t0 = time.perf_counter()
+        schema.ensure_schema(app, db)
+        startup.record(app, 'schema', time.perf_counter() - t0)
 
     # Jinja filter
     app.jinja_env.filters['time_ago'] = time_ago
     app.jinja_env.filters['build_upload_path'] = build_upload_path
 
+    # 静的アセットのバンドル（flask build-assets）と事前圧縮版の配信
+    from app import assets
+    assets.init_app(app)
+
+    # 投稿・返信カードのフラグメントキャッシュ
+    from app import fragment_cache
+    fragment_cache.init_app(app)
+
+    # カーソル方式のフィード API
+    from app import feed
+    feed.init_app(app)
+
+    # 検索結果キャッシュ（正規化した条件 -> ID 一覧、世代番号で無効化）
+    from app import search_cache
+    search_cache.init_app(app)
+
+    # パスワードハッシュ専用のエグゼキュータ（flask hash-benchmark）
+    from app import passwords
+    passwords.init_app(app)
+
+    # 小さな書き込みのグループコミット（WRITE_QUEUE_ENABLED のときのみ）
+    from app import write_queue
+    write_queue.init_app(app)
+
+    # 会話のページング（最新ページ + before_id で古いページ）
+    from app import conversations
+    conversations.init_app(app)
+
+    # 未読数のカウンタ（flask check-unread-counters）
+    from app import unread
+    unread.init_app(app)
+
+    # 古い既読メッセージのアーカイブ（flask archive-messages / MESSAGE_ARCHIVE_INTERVAL）
+    from app import archive
+    archive.init_app(app)
+
+    # コミュニティ・投稿の削除（墓標で隠し、flask reap-deleted / REAPER_INTERVAL で後片付け）
+    from app import deletion
+    deletion.init_app(app)
+
+    # ポーリングの集約（/api/sync）
+    from app import sync
+    sync.init_app(app)
+
+    # CLI: flask import-data
+    from app import importer
+    importer.init_app(app)
+
+    # 個人データのエクスポート（flask export-user）
+    from app import export
+    export.init_app(app)
+
+    # Jinja のバイトコードキャッシュと起動時のテンプレート読み込み（フィルタ登録後に行う）
+    startup.init_app(app)
+
+    # 本番用サーバー（flask serve）とワーカーのライフサイクルフック
+    from app import server
+    server.init_app(app)
+
+    # HTML / JSON の動的圧縮（計測フックより後に登録し、圧縮時間も計測に含める）
+    from app import compression
+    compression.init_app(app)
+
     return app
@@ -0,0 +1,121 @@
+"""古いメッセージのアーカイブ（ホット / コールドの分離）
+
+``message`` テーブルは増え続け、会話・受信箱・未読数のクエリはすべてこのテーブルを読む。
+``MESSAGE_ARCHIVE_AFTER_DAYS`` 日より古い既読メッセージを ``message_archive`` へ移し、
+``message`` とそのインデックスを小さく保つ（ページキャッシュに収まる大きさにする）。
+
+- 移動は ``MESSAGE_ARCHIVE_BATCH_SIZE`` 件ずつ、1 バッチ 1 トランザクションで行い、
+  バッチの間に ``MESSAGE_ARCHIVE_PAUSE`` 秒空けて書き込みロックを長く握らない
+- ID はそのまま引き継ぐので、会話のページング（app/conversations.py）は両方のテーブルを
+  同じ ``before_id`` で辿れる。未読数はホットだけを数えればよい（アーカイブは既読のみ）
+- ``message`` は AUTOINCREMENT なので、最大の ID の行を移して消しても ID は再利用されない
+  （既存の DB はスキーマの v7 で作り直し、``sqlite_sequence`` をアーカイブの最大 ID まで進める）
+
+実行は ``flask archive-messages``（cron などから）か、``MESSAGE_ARCHIVE_INTERVAL`` 秒ごとに
+``flask serve`` のワーカー内で。複数のワーカーのうちロックファイルを取れた 1 つだけが実行する。
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+
+from app import server
+from models import db, ArchivedMessage, Message
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ('id', 'body', 'created_at', 'sender_id', 'recipient_id', 'is_read', 'read_at', 'conversation_key')
+
+
+def _candidate_ids(cutoff, after_id, batch_size):
+    rows = (db.session.query(Message.id)
+            .filter(Message.id > after_id,
+                    Message.recipient_id.isnot(None), Message.is_read.is_(True), Message.created_at < cutoff)
+            .order_by(Message.id.asc())
+            .limit(batch_size))
+    return [r[0] for r in rows]
+
+
+def seed_id_sequence(conn):
+    """``message`` の次の ID が ``message_archive`` の ID より大きくなるよう ``sqlite_sequence`` を進める"""
+    high = conn.exec_driver_sql(
+        'SELECT max((SELECT coalesce(max(id), 0) FROM message), (SELECT coalesce(max(id), 0) FROM message_archive))'
+    ).scalar()
+    row = conn.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name = 'message'").first()
+    if row is None:
+        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('message', ?)", (high,))
+    elif row[0] < high:
+        conn.exec_driver_sql("UPDATE sqlite_sequence SET seq = ? WHERE name = 'message'", (high,))
+
+
+def archive_batch(ids, cutoff):
+    """``ids`` のうち条件を満たす行をアーカイブへ移す。移した件数を返す"""
+    archive = ArchivedMessage.__table__
+    message = Message.__table__
+    # 候補を選んだ後に既読が外れた・削除されたものを除くため、条件を付け直して移す
+    source = db.select(*[message.c[name] for name in _COLUMNS], db.literal(datetime.utcnow())).where(
+        message.c.id.in_(ids), message.c.is_read.is_(True), message.c.created_at < cutoff)
+    try:
+        db.session.execute(archive.insert().from_select(list(_COLUMNS) + ['archived_at'], source))
+        moved = db.session.execute(message.delete().where(
+            message.c.id.in_(db.select(archive.c.id).where(archive.c.id.in_(ids))))).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return moved
+
+
+def archive_messages(older_than_days=None, batch_size=None, pause=None, dry_run=False, log=None):
+    """古い既読メッセージをアーカイブへ移す。移した（dry_run なら対象の）件数を返す"""
+    config = current_app.config
+    older_than_days = config['MESSAGE_ARCHIVE_AFTER_DAYS'] if older_than_days is None else older_than_days
+    batch_size = batch_size or config['MESSAGE_ARCHIVE_BATCH_SIZE']
+    pause = config['MESSAGE_ARCHIVE_PAUSE'] if pause is None else pause
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    total = 0
+    after_id = 0
+    while True:
+        ids = _candidate_ids(cutoff, after_id, batch_size)
+        if not ids:
+            break
+        after_id = ids[-1]
+        total += len(ids) if dry_run else archive_batch(ids, cutoff)
+        if log:
+            log(f'{total} 件')
+        if len(ids) < batch_size:
+            break
+        if not dry_run:
+            time.sleep(pause)
+    return total
+
+
+@click.command('archive-messages')
+@click.option('--older-than-days', type=int, default=None, help='この日数より古い既読メッセージを移す（既定: MESSAGE_ARCHIVE_AFTER_DAYS）')
+@click.option('--batch-size', type=int, default=None, help='1 トランザクションで移す件数（既定: MESSAGE_ARCHIVE_BATCH_SIZE）')
+@click.option('--pause', type=float, default=None, help='バッチ間の待ち時間（秒）')
+@click.option('--dry-run', is_flag=True, help='移動せずに件数だけ数える')
+def archive_messages_command(older_than_days, batch_size, pause, dry_run):
+    """古い既読メッセージを message_archive へ移す（稼働中に実行してよい）"""
+    moved = archive_messages(older_than_days, batch_size, pause, dry_run=dry_run, log=click.echo)
+    click.echo(f"{moved} 件{'が対象です' if dry_run else 'をアーカイブしました'}")
+
+
+def _scheduled_archive():
+    moved = archive_messages()
+    if moved:
+        logger.info('archived %s messages', moved)
+
+
+def init_app(app):
+    app.config.setdefault('MESSAGE_ARCHIVE_AFTER_DAYS', 90)
+    app.config.setdefault('MESSAGE_ARCHIVE_BATCH_SIZE', 500)
+    app.config.setdefault('MESSAGE_ARCHIVE_PAUSE', 0.05)
+    # 0 ならワーカー内では実行しない（flask archive-messages を cron などで動かす）
+    app.config.setdefault('MESSAGE_ARCHIVE_INTERVAL', 0)
+    app.cli.add_command(archive_messages_command)
+    if app.config['MESSAGE_ARCHIVE_INTERVAL']:
+        server.schedule(app, 'message_archive', app.config['MESSAGE_ARCHIVE_INTERVAL'], _scheduled_archive)
@@ -0,0 +1,203 @@
+"""静的アセットのバンドル・フィンガープリント・事前圧縮
+
+``flask build-assets`` で ``BUNDLES`` の JS / CSS を結合・縮小し、内容のハッシュを含む
+ファイル名で ``static/dist/`` に書き出す。あわせて gzip 圧縮版（``.gz``）と、
+論理名 → 実ファイル名の ``manifest.json`` を作る。
+
+テンプレートでは ``{{ asset_tags('app.js') }}`` のように論理名で参照する。
+マニフェストがない（ビルド前の開発環境）か ``ASSETS_DEBUG = True`` のときは元のファイルを個別に読み込む。
+
+``static/dist/`` 配下は内容が変われば名前も変わるので、``immutable`` で 1 年キャッシュさせ、
+クライアントが gzip を受け付ければ事前圧縮版をそのまま返す。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# 論理名 -> static 配下の元ファイル（結合する順）
+BUNDLES = {
+    # realtime_messages.js などより先に読み込む必要があるため <head> で読む
+    'head.js': ['js/sync.js'],
+    'app.js': [
+        'js/post_preview.js',
+        'js/image_carousel.js',
+        'js/unread_badge_updater.js',
+        'js/reply_toggle.js',
+        'js/like_handler.js',
+        'js/infinite_scroll.js',
+    ],
+    'messages.js': ['js/realtime_messages.js'],
+    # data-autocomplete-url の入力欄があるページだけで読む
+    'autocomplete.js': ['js/username_autocomplete.js'],
+    'app.css': ['css/styles.css'],
+}
+
+try:  # 入っていれば本格的な縮小器を使う
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+
+# -- 縮小 ------------------------------------------------------------------------
+
+_JS_BLOCK_COMMENT_RE = re.compile(r'^\s*/\*.*?\*/\s*$', re.MULTILINE | re.DOTALL)
+_JS_LINE_COMMENT_RE = re.compile(r'^\s*//.*$', re.MULTILINE)
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE_RE = re.compile(r'\s+')
+_CSS_PUNCT_RE = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_js(source):
+    if rjsmin is not None:
+        return rjsmin.jsmin(source)
+    # 文字列・正規表現リテラルを壊さないよう、行単位のコメントと字下げ・空行だけを落とす
+    source = _JS_BLOCK_COMMENT_RE.sub('', source)
+    source = _JS_LINE_COMMENT_RE.sub('', source)
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def minify_css(source):
+    if rcssmin is not None:
+        return rcssmin.cssmin(source)
+    source = _CSS_COMMENT_RE.sub('', source)
+    source = _CSS_SPACE_RE.sub(' ', source)
+    source = _CSS_PUNCT_RE.sub(r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+# -- ビルド ----------------------------------------------------------------------
+
+def build_bundle(static_folder, name, sources):
+    parts = []
+    for src in sources:
+        with open(os.path.join(static_folder, src), encoding='utf-8') as f:
+            parts.append(f.read())
+    if name.endswith('.js'):
+        # 各ファイルは自己完結しているので、ASI に頼らないよう ; で区切って結合する
+        return ';\n'.join(minify_js(p) for p in parts) + '\n'
+    return '\n'.join(minify_css(p) for p in parts) + '\n'
+
+
+def build(static_folder, bundles=None, clean=True):
+    """全バンドルを書き出して新しいマニフェストを返す"""
+    bundles = bundles or BUNDLES
+    out_dir = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {}
+    for name, sources in bundles.items():
+        data = build_bundle(static_folder, name, sources).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        filename = f'{stem}.{digest}{ext}'
+        path = os.path.join(out_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        # mtime=0 にして同じ内容からは同じ .gz ができるようにする
+        with open(path + '.gz', 'wb') as raw, gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=9, mtime=0) as gz:
+            gz.write(data)
+        manifest[name] = filename
+
+    tmp = os.path.join(out_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST_NAME))
+
+    if clean:
+        keep = set(manifest.values()) | {v + '.gz' for v in manifest.values()} | {MANIFEST_NAME}
+        for entry in os.listdir(out_dir):
+            if entry not in keep:
+                os.remove(os.path.join(out_dir, entry))
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# -- テンプレート ------------------------------------------------------------------
+
+def asset_urls(name):
+    manifest = current_app.extensions.get('asset_manifest') or {}
+    if name in manifest and not current_app.config['ASSETS_DEBUG']:
+        return [url_for('static', filename=f'{DIST_DIR}/{manifest[name]}')]
+    return [url_for('static', filename=src) for src in BUNDLES[name]]
+
+
+def asset_tags(name):
+    """論理名から <script> / <link> タグを作る"""
+    tags = []
+    for url in asset_urls(name):
+        if name.endswith('.css'):
+            tags.append(f'<link rel="stylesheet" href="{escape(url)}">')
+        else:
+            tags.append(f'<script src="{escape(url)}"></script>')
+    return Markup('\n'.join(tags))
+
+
+# -- 配信 ------------------------------------------------------------------------
+
+def _accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+
+def serve_static(filename):
+    """Flask の static ビューの置き換え。dist 配下は事前圧縮版と immutable キャッシュで返す"""
+    static_folder = current_app.static_folder
+    if not filename.startswith(DIST_DIR + '/') or filename.endswith('/' + MANIFEST_NAME):
+        return current_app.send_static_file(filename)
+
+    gz_path = os.path.join(static_folder, filename + '.gz')
+    if _accepts_gzip() and os.path.isfile(gz_path):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(static_folder, filename + '.gz', mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@click.command('build-assets')
+@click.option('--no-clean', is_flag=True, help='古いビルド結果を残す')
+def build_assets_command(no_clean):
+    """JS / CSS を結合・縮小し、ハッシュ付きファイル名と gzip 版、マニフェストを static/dist に書き出す"""
+    static_folder = current_app.static_folder
+    manifest = build(static_folder, clean=not no_clean)
+    current_app.extensions['asset_manifest'] = manifest
+    for name, filename in sorted(manifest.items()):
+        path = os.path.join(static_folder, DIST_DIR, filename)
+        size = os.path.getsize(path)
+        gz_size = os.path.getsize(path + '.gz')
+        original = sum(os.path.getsize(os.path.join(static_folder, src)) for src in BUNDLES[name])
+        click.echo(f'{name:<14}-> {DIST_DIR}/{filename}  {original:,} -> {size:,} bytes (gzip {gz_size:,})')
+
+
+def init_app(app):
+    app.config.setdefault('ASSETS_DEBUG', False)
+    app.extensions['asset_manifest'] = load_manifest(app.static_folder)
+    app.jinja_env.globals['asset_tags'] = asset_tags
+    app.jinja_env.globals['asset_url'] = lambda name: asset_urls(name)[0]
+    app.view_functions['static'] = serve_static
+    app.cli.add_command(build_assets_command)
@@ -0,0 +1,105 @@
+"""HTML / JSON レスポンスの動的 gzip 圧縮
+
+``after_request`` で、クライアントが gzip を受け付けていて Content-Type が
+``COMPRESS_MIMETYPES`` に含まれるレスポンスを圧縮する。
+
+- ``COMPRESS_MIN_SIZE`` バイト未満は圧縮しても得が少ないのでそのまま返す
+- ストリーミングのレスポンスはチャンクごとに圧縮して flush し、逐次送る
+- ``send_file`` 系（アップロード画像・動画、エクスポートの ZIP など ``direct_passthrough``）や
+  Content-Encoding 付き（事前圧縮済みの静的ファイル）、Range リクエストへの応答は対象外
+- ``COMPRESS_LEVEL``（1〜9）で CPU 時間と転送量の釣り合いを調整する
+"""
+import zlib
+
+from flask import current_app, request
+
+DEFAULT_MIMETYPES = (
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+)
+
+
+def _gzip_compressor(level):
+    # wbits=31 で gzip ヘッダ付きの deflate ストリームになる
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def compress_bytes(data, level):
+    comp = _gzip_compressor(level)
+    return comp.compress(data) + comp.flush()
+
+
+def compress_stream(response, level):
+    """元の iterable をチャンクごとに圧縮し、その都度 flush して送り出すジェネレータを返す"""
+    # response.response はこの後ジェネレータに差し替わるので、元の iterable を先に確保しておく
+    original = response.response
+    chunks = response.iter_encoded()
+
+    def generate():
+        comp = _gzip_compressor(level)
+        try:
+            for chunk in chunks:
+                if chunk:
+                    yield comp.compress(chunk) + comp.flush(zlib.Z_SYNC_FLUSH)
+            yield comp.flush()
+        finally:
+            close = getattr(original, 'close', None)
+            if close is not None:
+                close()
+    return generate()
+
+
+def _should_compress(response):
+    config = current_app.config
+    if response.mimetype not in config['COMPRESS_MIMETYPES']:
+        return False
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return False
+    if request.method == 'HEAD' or 'Range' in request.headers:
+        return False
+    return True
+
+
+def compress_response(response):
+    if not _should_compress(response):
+        return response
+    # 同じ URL でも Accept-Encoding によって表現が変わることをキャッシュに伝える
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+
+    level = current_app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        if not current_app.config['COMPRESS_STREAMS']:
+            return response
+        response.response = compress_stream(response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress_bytes(data, level))
+    response.headers['Content-Encoding'] = 'gzip'
+    # 圧縮前と同じ強い ETag を付けたままにしない
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag + '-gzip')
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES)
+    app.config.setdefault('COMPRESS_STREAMS', True)
+    if not app.config['COMPRESS_ENABLED']:
+        return
+    app.after_request(compress_response)
@@ -0,0 +1,141 @@
+"""1 対 1 の会話のページング
+
+メッセージには ``conversation_key``（``"<小さい方のユーザーID>:<大きい方のユーザーID>"``）を持たせ、
+``(conversation_key, id)`` のインデックスで会話を新しい順に辿る。送信者・受信者の OR 条件で
+会話全体を並べ替えていた頃と違い、会話の長さによらず 1 ページ分の行だけを読む。
+
+画面を開いたときは最新の ``MESSAGES_PAGE_SIZE`` 件だけを表示し、``.chat`` を上へスクロールすると
+``/api/messages/<username>?before_id=<表示中の最古の ID>`` で古いページを読み足す。
+既読にするのは実際にクライアントへ渡したページに含まれる受信メッセージだけ。
+ページの ID 範囲をインデックスだけで求め、既読にしてから行を読み込む。
+
+古い既読メッセージは app/archive.py が ``message_archive`` へ移している。ページがホットの範囲を
+越えたとき（ページが埋まらない、またはページ内にアーカイブ済みの ID が挟まるとき）だけ
+アーカイブ側も同じキーで読み、ID 順に混ぜて返す。
+"""
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.orm import selectinload
+
+from app import unread, write_queue
+from models import db, conversation_key, ArchivedMessage, Message
+
+
+def _page_size(limit=None):
+    if limit is None:
+        return current_app.config['MESSAGES_PAGE_SIZE']
+    return max(1, min(limit, current_app.config['MESSAGES_MAX_PAGE_SIZE']))
+
+
+def _mark_read_range(user_id, other_id, first_id, last_id):
+    """範囲内の自分宛ての未読を既読にする（読み込む前に行い、コミットで読み込んだ行が失効しないようにする）"""
+    key = conversation_key(user_id, other_id)
+
+    def pending(query):
+        return query.filter(Message.conversation_key == key, Message.recipient_id == user_id,
+                            Message.is_read.is_(False), Message.id.between(first_id, last_id))
+
+    def mark(session):
+        marked = pending(session.query(Message)).update(
+            {'is_read': True, 'read_at': datetime.utcnow()}, synchronize_session=False)
+        # 一括 UPDATE は after_flush を通らないので、同じトランザクションでカウンタを減らす
+        unread.apply(session, {(user_id, other_id): -marked})
+        return marked
+
+    # ポーリングの大半は既読にするものがないので、書き込みキューに空の書き込みを積まない
+    if pending(db.session.query(Message.id)).first() is None:
+        return 0
+    return write_queue.run(mark)
+
+
+def _load_range(model, user_id, other_id, first_id, last_id):
+    # メッセージは別 DB に置けるので、送信者は JOIN せずに別のクエリで読む
+    return (model.query
+            .options(selectinload(model.sender))
+            .filter(model.conversation_key == conversation_key(user_id, other_id),
+                    model.id.between(first_id, last_id))
+            .order_by(model.id.asc())
+            .all())
+
+
+def _page_ids(model, key, before_id, limit, above_id=None):
+    query = db.session.query(model.id).filter(model.conversation_key == key)
+    if before_id:
+        query = query.filter(model.id < before_id)
+    if above_id is not None:
+        query = query.filter(model.id > above_id)
+    return [r[0] for r in query.order_by(model.id.desc()).limit(limit)]
+
+
+def fetch_page(user_id, other_id, before_id=None, limit=None, mark_read=True):
+    """``before_id`` より前の最新 1 ページを古い順で返す。(メッセージ, 次の before_id または None)
+
+    ``mark_read`` なら、このページに含まれる自分宛ての未読を既読にしてから返す。
+    """
+    limit = _page_size(limit)
+    key = conversation_key(user_id, other_id)
+    hot_ids = _page_ids(Message, key, before_id, limit + 1)
+    # ホットでページが埋まるなら、その範囲に挟まるアーカイブ分だけを見る（通常は 0 件）
+    floor = hot_ids[-1] if len(hot_ids) > limit else None
+    archived_ids = _page_ids(ArchivedMessage, key, before_id, limit + 1, above_id=floor)
+    ids = sorted(hot_ids + archived_ids, reverse=True)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return [], None
+    first_id, last_id = ids[-1], ids[0]
+    messages = []
+    if hot_ids and hot_ids[0] >= first_id:
+        if mark_read:
+            _mark_read_range(user_id, other_id, first_id, last_id)
+        messages = _load_range(Message, user_id, other_id, first_id, last_id)
+    if archived_ids and archived_ids[0] >= first_id:
+        messages = sorted(messages + _load_range(ArchivedMessage, user_id, other_id, first_id, last_id),
+                          key=lambda m: m.id)
+    return messages, (first_id if has_more else None)
+
+
+def fetch_after(user_id, other_id, after_id, limit=None, mark_read=True):
+    """``after_id`` より後のメッセージを古い順に最大 1 ページ分返す（残りは次回のポーリングで届く）"""
+    ids = [r[0] for r in db.session.query(Message.id)
+           .filter(Message.conversation_key == conversation_key(user_id, other_id), Message.id > after_id)
+           .order_by(Message.id.asc())
+           .limit(_page_size(limit))]
+    if not ids:
+        return []
+    if mark_read:
+        _mark_read_range(user_id, other_id, ids[0], ids[-1])
+    return _load_range(Message, user_id, other_id, ids[0], ids[-1])
+
+
+def latest_read_id(user_id, other_id):
+    """自分が送ったメッセージのうち、相手が既読にした最新の ID（なければ 0）"""
+    key = conversation_key(user_id, other_id)
+    for model in (Message, ArchivedMessage):
+        row = (db.session.query(model.id)
+               .filter(model.conversation_key == key, model.sender_id == user_id, model.is_read.is_(True))
+               .order_by(model.id.desc())
+               .first())
+        if row:
+            # アーカイブより新しい既読がホットにあれば、アーカイブは見なくてよい
+            return row[0]
+    return 0
+
+
+def archived_partners(user_id, exclude=()):
+    """ホットに 1 件もない会話の最新メッセージ（アーカイブ分）を新しい順に返す"""
+    latest = (db.session.query(db.func.max(ArchivedMessage.id))
+              .filter((ArchivedMessage.sender_id == user_id) | (ArchivedMessage.recipient_id == user_id))
+              .group_by(ArchivedMessage.conversation_key))
+    ids = [r[0] for r in latest]
+    if not ids:
+        return []
+    rows = ArchivedMessage.query.filter(ArchivedMessage.id.in_(ids)).order_by(ArchivedMessage.id.desc()).all()
+    exclude = set(exclude)
+    return [m for m in rows if (m.recipient_id if m.sender_id == user_id else m.sender_id) not in exclude]
+
+
+def init_app(app):
+    app.config.setdefault('MESSAGES_PAGE_SIZE', 50)
+    app.config.setdefault('MESSAGES_MAX_PAGE_SIZE', 200)
@@ -0,0 +1,119 @@
+"""メッセージ用の SQLite ファイルの分離（SQLAlchemy の bind）
+
+SQLite の書き込みはファイルごとに 1 つずつしか進まない。チャットの送信や 1 秒間隔のポーリングの
+既読コミットと、投稿・いいね・フォローが同じ ``sns.db`` の書き込みロックを取り合わないよう、
+``MESSAGES_DATABASE_URI`` を設定すると ``Message`` / ``ArchivedMessage`` と未読数のカウンタ（``__bind_key__ = 'messages'``）を
+別ファイルに置く。未設定なら ``messages`` の bind は既定のエンジンをそのまま指す（従来どおり 1 ファイル）。
+
+別ファイルにした場合の注意:
+
+- ``message`` と ``user`` を JOIN するクエリは書けない。送信者などは別のクエリで読む
+  （``selectinload`` や ID での引き直し）
+- 1 つのセッションで両方に書き込むと、コミットはファイルごとの別トランザクションになる
+- 既存のメッセージは ``flask split-messages`` で新しいファイルへコピーする（アプリを止めて実行する）
+"""
+import click
+from flask import current_app
+from sqlalchemy.engine import make_url
+
+from app import archive, unread
+from models import db, ArchivedMessage, Message, PartnerUnreadCounter, UnreadCounter
+
+MESSAGES_BIND = 'messages'
+MESSAGE_MODELS = (Message, ArchivedMessage)
+# メッセージと同じトランザクションで更新する未読数のカウンタ（app/unread.py）。コピーせず数え直す
+COUNTER_MODELS = (UnreadCounter, PartnerUnreadCounter)
+
+
+def is_separate(app):
+    return bool(app.config['MESSAGES_DATABASE_URI'])
+
+
+def configure(app):
+    """db.init_app() より前（sqlite_profile.configure() の後）に呼び、bind を設定する"""
+    app.config.setdefault('MESSAGES_DATABASE_URI', None)
+    if not is_separate(app):
+        return
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    # bind のエンジンには SQLALCHEMY_ENGINE_OPTIONS が適用されないので、同じオプションを渡す
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options['url'] = app.config['MESSAGES_DATABASE_URI']
+    binds.setdefault(MESSAGES_BIND, options)
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def engine_groups(app):
+    """(エンジン, そのエンジンを使う bind キーの一覧) をエンジンごとに返す"""
+    groups = {}
+    with app.app_context():
+        for key, engine in db.engines.items():
+            groups.setdefault(engine, []).append(key)
+    return list(groups.items())
+
+
+def labeled_engines(app):
+    """計測用に (ラベル, エンジン) を返す。既定の DB は write / read、メッセージ用は messages / messages_read"""
+    read_engines = app.extensions.get('sqlite_read_engines', {})
+    for engine, keys in engine_groups(app):
+        label = 'write' if None in keys else keys[0]
+        yield label, engine
+        if engine in read_engines:
+            yield ('read' if label == 'write' else f'{label}_read'), read_engines[engine]
+
+
+def _sqlite_path(engine):
+    url = make_url(engine.url)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise click.ClickException('split-messages はファイルの SQLite 同士でのみ使えます')
+    return url.database
+
+
+@click.command('split-messages')
+@click.option('--drop-source', is_flag=True, help='コピー後に既定の DB から行を削除する')
+def split_messages_command(drop_source):
+    """既定の DB のメッセージを MESSAGES_DATABASE_URI のファイルへコピーする（アプリを止めて実行する）"""
+    if not is_separate(current_app):
+        raise click.ClickException('MESSAGES_DATABASE_URI が設定されていません')
+    source = _sqlite_path(db.engines[None])
+    with db.engines[MESSAGES_BIND].connect() as conn:
+        # ATTACH / DETACH はトランザクションの外で行う
+        conn.exec_driver_sql('ATTACH DATABASE ? AS src', (source,))
+        try:
+            for model in MESSAGE_MODELS:
+                table = model.__tablename__
+                exists = conn.exec_driver_sql(
+                    "SELECT 1 FROM src.sqlite_master WHERE type = 'table' AND name = ?", (table,)).first()
+                if not exists:
+                    continue
+                source_columns = {row[1] for row in conn.exec_driver_sql(f'PRAGMA src.table_info("{table}")')}
+                columns = ', '.join(c.name for c in model.__table__.columns if c.name in source_columns)
+                # ID を引き継ぎ、途中で止まっても続きからコピーできるようにする
+                copied = conn.exec_driver_sql(
+                    f'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM src."{table}" '
+                    f'WHERE id > (SELECT coalesce(max(id), 0) FROM main."{table}") ORDER BY id').rowcount
+                conn.commit()
+                click.echo(f'{table}: {copied} 件コピーしました')
+            unread.rebuild(conn)
+            # 移した先でもアーカイブ済みの ID を再利用させない
+            archive.seed_id_sequence(conn)
+            conn.commit()
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql('DETACH DATABASE src')
+    if drop_source:
+        with db.engines[None].begin() as conn:
+            for model in MESSAGE_MODELS + COUNTER_MODELS:
+                if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                        (model.__tablename__,)).first():
+                    conn.exec_driver_sql(f'DELETE FROM "{model.__tablename__}"')
+        click.echo('既定の DB からメッセージを削除しました')
+
+
+def init_app(app, db):
+    """db.init_app() の直後に呼ぶ"""
+    if not is_separate(app):
+        # 同じファイルに別のエンジンで書き込むとロックを取り合うので、既定のエンジンを共有する
+        with app.app_context():
+            engines = db.engines
+            engines[MESSAGES_BIND] = engines[None]
+    app.cli.add_command(split_messages_command)
@@ -0,0 +1,237 @@
+"""コミュニティ・投稿の削除（墓標で隠し、後片付けで行とファイルを消す）
+
+``db.session.delete(community)`` は ORM の ``cascade`` で投稿・画像・返信・いいね・フォローを
+すべてセッションに読み込んでから 1 件ずつ削除するので、投稿の多いコミュニティでは
+リクエストが長くかかり、その間ずっと書き込みロックを握る。アップロードファイルも残っていた。
+
+- 削除のリクエストは ``tombstone`` で ``deleted_at`` を付けてコミットするだけ
+- 墓標の付いたコミュニティ・投稿と、墓標の付いたコミュニティの投稿は、ORM の SELECT すべてに
+  ``with_loader_criteria`` で条件を足して隠す（一覧・``get_or_404``・件数・関連の読み込み）。
+  隠さずに読むときは ``execution_options(include_deleted=True)`` を付ける（そのオブジェクトの関連も隠さない）。
+  テーブルの列を使う Core の文には適用されない
+- アカウント削除（``purge_user``）も同じように、行を 1 件ずつ読まずにまとめて DELETE する
+- ``reap`` が ``REAPER_BATCH_SIZE`` 件の投稿ごとに返信・いいね・画像をまとめて DELETE してコミットし、
+  その後でアップロードファイルを消す。投稿が残っていないコミュニティはフォローとアイコンごと消す
+
+後片付けは ``REAPER_INTERVAL`` 秒ごとに ``flask serve`` のワーカー内で実行する
+（0 なら ``flask reap-deleted`` を cron などで動かす）。
+"""
+import logging
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import with_loader_criteria
+
+from app import fragment_cache, search_cache, server, unread, uploads
+from models import (db, ArchivedMessage, Community, CommunityFollow, Message, Post, PostImage, PostLike,
+                    Reply, ReplyImage, ReplyLike, User)
+
+logger = logging.getLogger(__name__)
+
+
+def tombstone(obj):
+    """コミュニティか投稿に墓標を付ける（コミットは呼び出し側）"""
+    obj.deleted_at = datetime.utcnow()
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _hide_tombstones(execute_state):
+    # 関連の遅延読み込みには、親を読んだクエリの条件が引き継がれる（include_deleted で読んだものは隠さない）
+    if (not execute_state.is_select or execute_state.is_column_load or execute_state.is_relationship_load
+            or execute_state.execution_options.get('include_deleted', False)):
+        return
+    community = Community.__table__
+    execute_state.statement = execute_state.statement.options(
+        with_loader_criteria(Community, lambda cls: cls.deleted_at.is_(None), include_aliases=True),
+        with_loader_criteria(
+            Post,
+            lambda cls: cls.deleted_at.is_(None) & ~db.exists().where(
+                community.c.id == cls.community_id, community.c.deleted_at.isnot(None)),
+            include_aliases=True))
+
+
+# -- 後片付け --------------------------------------------------------------------
+
+def _doomed_post_ids(batch_size):
+    post = Post.__table__
+    community = Community.__table__
+    # OR でまとめるとインデックスを使えないので、墓標の付いた投稿とコミュニティの投稿を別々に引く
+    ids = [r[0] for r in db.session.execute(
+        db.select(post.c.id).where(post.c.deleted_at.isnot(None)).limit(batch_size))]
+    if len(ids) < batch_size:
+        dead = db.select(community.c.id).where(community.c.deleted_at.isnot(None))
+        ids += [r[0] for r in db.session.execute(
+            db.select(post.c.id).where(post.c.community_id.in_(dead), post.c.deleted_at.is_(None))
+            .limit(batch_size - len(ids)))]
+    return ids
+
+
+def _media_files(post_ids):
+    post = Post.__table__
+    reply = Reply.__table__
+    post_image = PostImage.__table__
+    reply_image = ReplyImage.__table__
+    reply_ids = db.select(reply.c.id).where(reply.c.post_id.in_(post_ids))
+    queries = [
+        ('posts', db.select(post_image.c.filename).where(post_image.c.post_id.in_(post_ids))),
+        ('posts', db.select(post.c.video_filename).where(post.c.id.in_(post_ids), post.c.video_filename.isnot(None))),
+        ('replies', db.select(reply_image.c.filename).where(reply_image.c.reply_id.in_(reply_ids))),
+        ('replies', db.select(reply.c.video_filename).where(reply.c.post_id.in_(post_ids),
+                                                            reply.c.video_filename.isnot(None))),
+    ]
+    return [(upload_type, r[0]) for upload_type, query in queries for r in db.session.execute(query)]
+
+
+def _delete_posts(post_ids):
+    """投稿とその返信・いいね・画像の行を消す（``post_ids`` は ID の一覧か SELECT。コミットは呼び出し側）"""
+    reply = Reply.__table__
+    reply_ids = db.select(reply.c.id).where(reply.c.post_id.in_(post_ids))
+    for model in (ReplyLike, ReplyImage):
+        table = model.__table__
+        db.session.execute(table.delete().where(table.c.reply_id.in_(reply_ids)))
+    # 返信どうしの parent_id は同じ投稿の中なので、1 つの DELETE でまとめて消せる
+    db.session.execute(reply.delete().where(reply.c.post_id.in_(post_ids)))
+    for model in (PostLike, PostImage):
+        table = model.__table__
+        db.session.execute(table.delete().where(table.c.post_id.in_(post_ids)))
+    db.session.execute(Post.__table__.delete().where(Post.__table__.c.id.in_(post_ids)))
+
+
+def reap_posts(post_ids):
+    """投稿とその返信・いいね・画像の行を 1 トランザクションで消し、コミット後にファイルを消す"""
+    files = _media_files(post_ids)
+    try:
+        _delete_posts(post_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for upload_type, filename in files:
+        uploads.remove(filename, upload_type)
+    return len(post_ids)
+
+
+def reap_communities():
+    """投稿が残っていない墓標付きのコミュニティを、フォロー・アイコンごと消す。消した数を返す"""
+    community = Community.__table__
+    follow = CommunityFollow.__table__
+    post = Post.__table__
+    rows = db.session.execute(
+        db.select(community.c.id, community.c.icon_filename).where(
+            community.c.deleted_at.isnot(None), ~db.exists().where(post.c.community_id == community.c.id))
+    ).all()
+    for community_id, icon_filename in rows:
+        try:
+            db.session.execute(follow.delete().where(follow.c.community_id == community_id))
+            db.session.execute(community.delete().where(community.c.id == community_id))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        uploads.remove(icon_filename, 'community_icons')
+    return len(rows)
+
+
+def purge_user(user_id):
+    """アカウント削除: ユーザーとユーザーを参照する行を、件数によらない数の文で消す（コミットは呼び出し側）
+
+    - 投稿はそのまま消す（墓標付きも含む）。ユーザーの返信は、それへの返信（子孫）ごと消す
+    - 作成したコミュニティは最も古いフォロワーに引き継ぐ。フォロワーがいなければ墓標を付けて後片付けに任せる
+    - 送った未読メッセージの分は相手の未読数から減らす（app/unread.py）
+
+    コミット後に消すアップロードファイルの (upload_type, ファイル名) を返す。
+    """
+    post = Post.__table__
+    reply = Reply.__table__
+    reply_image = ReplyImage.__table__
+    community = Community.__table__
+    follow = CommunityFollow.__table__
+    post_ids = db.select(post.c.id).where(post.c.user_id == user_id)
+    doomed = db.select(reply.c.id).where(reply.c.user_id == user_id).cte('doomed_reply', recursive=True)
+    doomed = doomed.union_all(db.select(reply.c.id).where(reply.c.parent_id == doomed.c.id))
+    doomed_ids = db.select(doomed.c.id)
+
+    files = _media_files(post_ids)
+    files += [('replies', r[0]) for r in db.session.execute(
+        db.select(reply_image.c.filename).where(reply_image.c.reply_id.in_(doomed_ids)))]
+    files += [('replies', r[0]) for r in db.session.execute(
+        db.select(reply.c.video_filename).where(reply.c.id.in_(doomed_ids), reply.c.video_filename.isnot(None)))]
+    avatar = db.session.execute(db.select(User.__table__.c.avatar_filename).where(User.__table__.c.id == user_id)).scalar()
+    if avatar:
+        files.append(('avatars', avatar))
+    # 他のユーザーの投稿で、返信・いいねの数が変わるもの
+    touched = {r[0] for r in db.session.execute(
+        db.select(reply.c.post_id).where(reply.c.id.in_(doomed_ids))
+        .union(db.select(PostLike.__table__.c.post_id).where(PostLike.__table__.c.user_id == user_id)))}
+
+    reply_like = ReplyLike.__table__
+    db.session.execute(reply_like.delete().where(reply_like.c.reply_id.in_(doomed_ids) | (reply_like.c.user_id == user_id)))
+    db.session.execute(reply_image.delete().where(reply_image.c.reply_id.in_(doomed_ids)))
+    db.session.execute(reply.delete().where(reply.c.id.in_(doomed_ids)))
+    _delete_posts(post_ids)
+    db.session.execute(PostLike.__table__.delete().where(PostLike.__table__.c.user_id == user_id))
+
+    others = db.select(follow.c.user_id).where(follow.c.community_id == community.c.id, follow.c.user_id != user_id)
+    db.session.execute(community.update().where(community.c.created_by == user_id, ~db.exists(others))
+                       .values(created_by=None, deleted_at=datetime.utcnow()))
+    heir = others.order_by(follow.c.created_at.asc(), follow.c.id.asc()).limit(1).scalar_subquery()
+    db.session.execute(community.update().where(community.c.created_by == user_id).values(created_by=heir))
+    db.session.execute(follow.delete().where(follow.c.user_id == user_id))
+
+    for model in (Message, ArchivedMessage):
+        table = model.__table__
+        db.session.execute(table.delete().where((table.c.sender_id == user_id) | (table.c.recipient_id == user_id)))
+    unread.forget_user(db.session, user_id)
+    db.session.execute(User.__table__.delete().where(User.__table__.c.id == user_id))
+
+    fragment_cache.invalidate(db.session, [('user', user_id)] + [('post', post_id) for post_id in touched])
+    search_cache.invalidate(db.session, ('posts', 'post_counts', 'communities'))
+    return files
+
+
+def reap(batch_size=None, pause=None, log=None):
+    """墓標の付いた投稿・コミュニティを消す。(投稿数, コミュニティ数) を返す"""
+    config = current_app.config
+    batch_size = batch_size or config['REAPER_BATCH_SIZE']
+    pause = config['REAPER_PAUSE'] if pause is None else pause
+
+    posts = 0
+    while True:
+        ids = _doomed_post_ids(batch_size)
+        if not ids:
+            break
+        posts += reap_posts(ids)
+        if log:
+            log(f'投稿 {posts} 件')
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause)
+    return posts, reap_communities()
+
+
+@click.command('reap-deleted')
+@click.option('--batch-size', type=int, default=None, help='1 トランザクションで消す投稿数（既定: REAPER_BATCH_SIZE）')
+@click.option('--pause', type=float, default=None, help='バッチ間の待ち時間（秒）')
+def reap_deleted_command(batch_size, pause):
+    """削除済み（墓標付き）の投稿・コミュニティの行とファイルを消す（稼働中に実行してよい）"""
+    posts, communities = reap(batch_size, pause, log=click.echo)
+    click.echo(f'投稿 {posts} 件・コミュニティ {communities} 件を削除しました')
+
+
+def _scheduled_reap():
+    posts, communities = reap()
+    if posts or communities:
+        logger.info('reaped %s posts and %s communities', posts, communities)
+
+
+def init_app(app):
+    app.config.setdefault('REAPER_BATCH_SIZE', 200)
+    app.config.setdefault('REAPER_PAUSE', 0.05)
+    # 0 ならワーカー内では実行しない（flask reap-deleted を cron などで動かす）
+    app.config.setdefault('REAPER_INTERVAL', 30)
+    app.cli.add_command(reap_deleted_command)
+    if app.config['REAPER_INTERVAL']:
+        server.schedule(app, 'reaper', app.config['REAPER_INTERVAL'], _scheduled_reap)
@@ -0,0 +1,243 @@
+"""個人データのエクスポート（ZIP をストリーミング生成）
+
+投稿・返信・メッセージなどを ``yield_per`` のサーバーサイドカーソルで JSONL に書き出し、
+メディアファイルはチャンク単位で読み込みながら ZIP に格納する。
+ZIP はシーク不可のストリームに書くため、アカウントの大きさに関わらずメモリ使用量は一定。
+
+生成中のアーカイブは ``EXPORT_FOLDER`` にも書き出しておき、完成後は
+キャッシュとして Range リクエスト（ダウンロード再開）に応える。
+"""
+import heapq
+import json
+import os
+import time
+import uuid
+import zipfile
+
+import click
+from flask import current_app
+
+from models import db, User, Post, PostImage, Reply, ReplyImage, PostLike, ReplyLike, Message, ArchivedMessage, CommunityFollow, Community
+
+CHUNK_SIZE = 64 * 1024
+YIELD_PER = 500
+
+
+class _ChunkBuffer:
+    """ZipFile の出力先。書かれたバイト列を drain() で取り出す"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _iso(dt):
+    return dt.isoformat() if dt else None
+
+
+def _rows(stmt):
+    return db.session.execute(stmt.execution_options(yield_per=YIELD_PER))
+
+
+def _partner_ids(user_id):
+    """メッセージ（アーカイブ済みを含む）のやり取り相手の ID 集合"""
+    ids = set()
+    for model in (Message, ArchivedMessage):
+        ids.update(db.session.scalars(db.select(model.recipient_id).where(model.sender_id == user_id).distinct()))
+        ids.update(db.session.scalars(db.select(model.sender_id).where(model.recipient_id == user_id).distinct()))
+    ids.discard(None)
+    return ids
+
+
+def _usernames(user_ids, chunk=500):
+    """ID -> ユーザー名。存在しない（削除済みの）ユーザーは含まない"""
+    user_ids = sorted(user_ids)
+    names = {}
+    for i in range(0, len(user_ids), chunk):
+        names.update(db.session.execute(
+            db.select(User.id, User.username).where(User.id.in_(user_ids[i:i + chunk]))).all())
+    return names
+
+
+def iter_records(user_id):
+    """(アーカイブ内のファイル名, レコードのイテレータ) を順に返す"""
+    u = db.session.get(User, user_id)
+    yield 'profile.json', iter([{
+        'username': u.username,
+        'display_name': u.display_name,
+        'bio': u.bio,
+        'avatar': u.avatar_filename,
+    }])
+
+    posts = db.select(Post.id, Post.body, Post.created_at, Post.community_id, Post.video_filename).where(
+        Post.user_id == user_id).order_by(Post.id)
+    yield 'posts.jsonl', ({
+        'id': r.id, 'body': r.body, 'created_at': _iso(r.created_at),
+        'community_id': r.community_id, 'video': r.video_filename,
+    } for r in _rows(posts))
+
+    post_images = db.select(PostImage.post_id, PostImage.filename, PostImage.order).join(
+        Post, Post.id == PostImage.post_id).where(Post.user_id == user_id).order_by(PostImage.post_id, PostImage.order)
+    yield 'post_images.jsonl', ({'post_id': r.post_id, 'filename': r.filename, 'order': r.order} for r in _rows(post_images))
+
+    replies = db.select(Reply.id, Reply.post_id, Reply.parent_id, Reply.body, Reply.created_at, Reply.video_filename).where(
+        Reply.user_id == user_id).order_by(Reply.id)
+    yield 'replies.jsonl', ({
+        'id': r.id, 'post_id': r.post_id, 'parent_id': r.parent_id, 'body': r.body,
+        'created_at': _iso(r.created_at), 'video': r.video_filename,
+    } for r in _rows(replies))
+
+    reply_images = db.select(ReplyImage.reply_id, ReplyImage.filename, ReplyImage.order).join(
+        Reply, Reply.id == ReplyImage.reply_id).where(Reply.user_id == user_id).order_by(ReplyImage.reply_id, ReplyImage.order)
+    yield 'reply_images.jsonl', ({'reply_id': r.reply_id, 'filename': r.filename, 'order': r.order} for r in _rows(reply_images))
+
+    def message_rows(model):
+        return _rows(db.select(model.id, model.body, model.created_at, model.is_read, model.read_at,
+                               model.sender_id, model.recipient_id).where(
+            (model.sender_id == user_id) | (model.recipient_id == user_id)).order_by(model.id))
+    # アーカイブ済みの古いメッセージも ID 順に混ぜる。メッセージは別 DB に置けるので user とは JOIN せず、
+    # 相手のユーザー名は先に相手の ID をまとめて引いてから IN で読む
+    messages = heapq.merge(message_rows(Message), message_rows(ArchivedMessage), key=lambda r: r.id)
+    usernames = _usernames(_partner_ids(user_id) | {user_id})
+    yield 'messages.jsonl', ({
+        'id': r.id, 'sender': usernames.get(r.sender_id), 'recipient': usernames.get(r.recipient_id), 'body': r.body,
+        'created_at': _iso(r.created_at), 'is_read': r.is_read, 'read_at': _iso(r.read_at),
+    } for r in messages if r.sender_id in usernames)
+
+    likes = db.select(PostLike.post_id, PostLike.created_at).where(PostLike.user_id == user_id).order_by(PostLike.id)
+    yield 'post_likes.jsonl', ({'post_id': r.post_id, 'created_at': _iso(r.created_at)} for r in _rows(likes))
+    reply_likes = db.select(ReplyLike.reply_id, ReplyLike.created_at).where(ReplyLike.user_id == user_id).order_by(ReplyLike.id)
+    yield 'reply_likes.jsonl', ({'reply_id': r.reply_id, 'created_at': _iso(r.created_at)} for r in _rows(reply_likes))
+
+    follows = db.select(Community.name, CommunityFollow.created_at).join(
+        Community, Community.id == CommunityFollow.community_id).where(CommunityFollow.user_id == user_id)
+    yield 'follows.jsonl', ({'community': r.name, 'created_at': _iso(r.created_at)} for r in _rows(follows))
+
+
+def iter_media(user_id):
+    """(upload_type, ファイル名) を順に返す"""
+    u = db.session.get(User, user_id)
+    if u.avatar_filename:
+        yield 'avatars', u.avatar_filename
+    queries = [
+        ('posts', db.select(PostImage.filename).join(Post, Post.id == PostImage.post_id).where(Post.user_id == user_id)),
+        ('posts', db.select(Post.video_filename).where(Post.user_id == user_id, Post.video_filename.isnot(None))),
+        ('replies', db.select(ReplyImage.filename).join(Reply, Reply.id == ReplyImage.reply_id).where(Reply.user_id == user_id)),
+        ('replies', db.select(Reply.video_filename).where(Reply.user_id == user_id, Reply.video_filename.isnot(None))),
+    ]
+    for upload_type, stmt in queries:
+        for (filename,) in _rows(stmt):
+            yield upload_type, filename
+
+
+def iter_export_zip(user_id):
+    """ZIP アーカイブをチャンクのイテレータとして生成する"""
+    from app.routes import upload_path
+
+    buf = _ChunkBuffer()
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        for name, records in iter_records(user_id):
+            with zf.open(name, 'w', force_zip64=True) as f:
+                for rec in records:
+                    f.write(json.dumps(rec, ensure_ascii=False).encode('utf-8') + b'\n')
+                    yield from buf.drain()
+            yield from buf.drain()
+
+        for upload_type, filename in iter_media(user_id):
+            path = upload_path(filename, upload_type)
+            if not os.path.isfile(path):
+                continue
+            # 画像・動画は圧縮済みなので無圧縮で格納する
+            info = zipfile.ZipInfo(f'media/{upload_type}/{filename}', date_time=time.localtime(os.path.getmtime(path))[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, zf.open(info, 'w', force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from buf.drain()
+            yield from buf.drain()
+    yield from buf.drain()
+
+
+# -- キャッシュ ------------------------------------------------------------------
+
+def export_dir():
+    folder = current_app.config['EXPORT_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def cached_archive_path(user_id):
+    return os.path.join(export_dir(), f'user-{user_id}.zip')
+
+
+def fresh_cached_archive(user_id):
+    """TTL 内の完成済みアーカイブがあればそのパスを返す"""
+    path = cached_archive_path(user_id)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    return path if age < current_app.config['EXPORT_CACHE_TTL'] else None
+
+
+def iter_export_and_cache(user_id):
+    """クライアントへ流しつつキャッシュファイルにも書き、完走したら確定する"""
+    final = cached_archive_path(user_id)
+    tmp = f'{final}.{uuid.uuid4().hex}.part'
+    completed = False
+    try:
+        with open(tmp, 'wb') as out:
+            for chunk in iter_export_zip(user_id):
+                out.write(chunk)
+                yield chunk
+        os.replace(tmp, final)
+        completed = True
+    finally:
+        if not completed:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def discard_cached(user_id):
+    try:
+        os.remove(cached_archive_path(user_id))
+    except OSError:
+        pass
+
+
+@click.command('export-user')
+@click.argument('username')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='出力先（既定: <username>-export.zip）')
+def export_user_command(username, output):
+    """ユーザーの個人データを ZIP に書き出す"""
+    u = User.query.filter_by(username=username).first()
+    if not u:
+        raise click.ClickException(f'ユーザーが見つかりません: {username}')
+    output = output or f'{username}-export.zip'
+    size = 0
+    with open(output, 'wb') as f:
+        for chunk in iter_export_zip(u.id):
+            f.write(chunk)
+            size += len(chunk)
+    click.echo(f'{output} ({size:,} bytes)')
+
+
+def init_app(app):
+    app.config.setdefault('EXPORT_FOLDER', os.path.join(app.instance_path, 'exports'))
+    app.config.setdefault('EXPORT_CACHE_TTL', 24 * 3600)
+    app.cli.add_command(export_user_command)
@@ -0,0 +1,238 @@
+"""カーソル方式のフィード取得（/api/feed と各一覧ページの 1 ページ目で共用）
+
+並び順ごとに (並びキー, 投稿ID) のキーセットでページングする。
+カーソルは SECRET_KEY で署名した不透明な文字列で、改ざんされたものは無視する。
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app, g, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, normalize_username, Post, PostImage, PostLike, Reply, User
+
+SCOPES = ('home', 'latest', 'community', 'user', 'search')
+SORTS = ('latest', 'likes', 'replies')
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='feed-cursor')
+
+
+def encode_cursor(sort_by, key, post_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    return _serializer().dumps([sort_by, key, post_id])
+
+
+def decode_cursor(cursor, sort_by):
+    if not cursor:
+        return None
+    try:
+        cur_sort, key, post_id = _serializer().loads(cursor)
+    except (BadSignature, ValueError, TypeError):
+        return None
+    if cur_sort != sort_by:
+        return None
+    if sort_by == 'latest':
+        key = datetime.fromisoformat(key)
+    return key, post_id
+
+
+def like_count_expr():
+    return db.select(db.func.count(PostLike.id)).where(PostLike.post_id == Post.id).correlate(Post).scalar_subquery()
+
+
+def reply_count_expr():
+    return db.select(db.func.count(Reply.id)).where(Reply.post_id == Post.id).correlate(Post).scalar_subquery()
+
+
+def username_prefix_filter(prefix):
+    """``username_key`` の前方一致（LIKE ではなく範囲比較なので通常のインデックスが効く）"""
+    key = normalize_username(prefix)
+    return (User.username_key >= key) & (User.username_key < key + '\U0010ffff')
+
+
+def apply_search_filters(query, params):
+    """検索条件（ユーザー名・本文・期間）を投稿クエリに適用する"""
+    username = (params.get('username') or '').strip()
+    body = (params.get('body') or '').strip()
+    if username:
+        # ユーザー名は前方一致。username_key のインデックスを範囲検索で使い、投稿と結合する
+        query = query.join(User, User.id == Post.user_id).filter(username_prefix_filter(username))
+    if body:
+        query = query.filter(Post.body.ilike(f'%{body}%'))
+    if params.get('date_from'):
+        try:
+            query = query.filter(Post.created_at >= datetime.strptime(params['date_from'], '%Y-%m-%d'))
+        except (ValueError, TypeError):
+            pass
+    if params.get('date_to'):
+        try:
+            # 翌日の開始までを含める
+            date_to = datetime.strptime(params['date_to'], '%Y-%m-%d') + timedelta(days=1)
+            query = query.filter(Post.created_at < date_to)
+        except (ValueError, TypeError):
+            pass
+    return query
+
+
+def scoped_query(scope, params):
+    """スコープに応じて絞り込んだ投稿クエリ（並び順・件数は未指定）。対象なしなら None"""
+    query = Post.query
+    if scope == 'home':
+        if not g.user or not g.following_ids:
+            return None
+        return query.filter(Post.community_id.in_(g.following_ids))
+    if scope == 'latest':
+        return query.filter(Post.community_id.isnot(None))
+    if scope == 'community':
+        try:
+            community_id = int(params.get('community_id'))
+        except (TypeError, ValueError):
+            return None
+        return query.filter(Post.community_id == community_id)
+    if scope == 'user':
+        u = User.query.filter_by(username=params.get('username')).first()
+        if not u:
+            return None
+        return query.filter(Post.user_id == u.id)
+    if scope == 'search':
+        return apply_search_filters(query.filter(Post.community_id.isnot(None)), params)
+    return None
+
+
+def sort_key_expr(sort_by):
+    if sort_by == 'likes':
+        return like_count_expr()
+    if sort_by == 'replies':
+        return reply_count_expr()
+    return Post.created_at
+
+
+def _load(query, limit=None):
+    """投稿クエリを実行し、``feed_like_count`` / ``feed_reply_count`` 属性を付けた投稿を返す
+
+    投稿カード（_post_card.html）が使う作者・コミュニティ・画像も読み込んでおく。
+    """
+    query = (query.options(joinedload(Post.author), joinedload(Post.community), selectinload(Post.images))
+             .add_columns(like_count_expr().label('like_count'), reply_count_expr().label('reply_count')))
+    if limit is not None:
+        query = query.limit(limit)
+    posts = []
+    for post, like_count, reply_count in query.all():
+        post.feed_like_count = like_count
+        post.feed_reply_count = reply_count
+        posts.append(post)
+    return posts
+
+
+def posts_by_ids(ids):
+    """ID の並び順どおりに投稿を読み込む（見つからない ID は飛ばす）"""
+    if not ids:
+        return []
+    by_id = {p.id: p for p in _load(Post.query.filter(Post.id.in_(ids)))}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def next_cursor_for(posts, sort_by):
+    last = posts[-1]
+    last_key = {'likes': last.feed_like_count, 'replies': last.feed_reply_count}.get(sort_by, last.created_at)
+    return encode_cursor(sort_by, last_key, last.id)
+
+
+def fetch_page(scope, params, sort_by='latest', cursor=None, limit=None):
+    """1 ページ分の投稿と次ページのカーソルを返す
+
+    戻り値の投稿には ``feed_like_count`` / ``feed_reply_count`` 属性を付ける。
+    検索は結果キャッシュ（``app.search_cache``）が有効ならそちらを通す。
+    """
+    if sort_by not in SORTS:
+        sort_by = 'latest'
+    limit = limit or current_app.config['FEED_PAGE_SIZE']
+    if scope == 'search' and 'search_cache' in current_app.extensions:
+        from app import search_cache
+        return search_cache.fetch_page(params, sort_by, cursor, limit)
+    return query_page(scope, params, sort_by, cursor, limit)
+
+
+def query_page(scope, params, sort_by, cursor, limit):
+    """キャッシュを使わず、キーセットで 1 ページ分を取得する"""
+    query = scoped_query(scope, params)
+    if query is None:
+        return [], None
+
+    key_expr = sort_key_expr(sort_by)
+    after = decode_cursor(cursor, sort_by)
+    if after is not None:
+        key, last_id = after
+        query = query.filter((key_expr < key) | ((key_expr == key) & (Post.id < last_id)))
+
+    posts = _load(query.order_by(key_expr.desc(), Post.id.desc()), limit + 1)
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    next_cursor = next_cursor_for(posts, sort_by) if has_more and posts else None
+    return posts, next_cursor
+
+
+def first_images(post_ids):
+    """投稿ごとの先頭画像と画像枚数をまとめて取得する"""
+    result = {}
+    if not post_ids:
+        return result
+    images = PostImage.query.filter(PostImage.post_id.in_(post_ids)).order_by(
+        PostImage.post_id, PostImage.order, PostImage.id).all()
+    for img in images:
+        entry = result.get(img.post_id)
+        if entry is None:
+            result[img.post_id] = {'filename': img.filename, 'order': img.order, 'count': 1}
+        else:
+            entry['count'] += 1
+    return result
+
+
+def serialize_posts(posts):
+    """フィード API 用のコンパクトな JSON 表現"""
+    build = current_app.jinja_env.filters['build_upload_path']
+    time_ago = current_app.jinja_env.filters['time_ago']
+    images = first_images([p.id for p in posts])
+
+    def upload_url(filename, upload_type):
+        return url_for('main.uploaded_file', filename=build(filename, upload_type)) if filename else None
+
+    items = []
+    for p in posts:
+        img = images.get(p.id)
+        items.append({
+            'id': p.id,
+            'body': p.body,
+            'created_at': p.created_at.isoformat() if p.created_at else None,
+            'time_ago': time_ago(p.created_at),
+            'author': {
+                'username': p.author.username,
+                'display_name': p.author.display_name or p.author.username,
+                'avatar_url': upload_url(p.author.avatar_filename, 'avatars'),
+            },
+            'community': {
+                'id': p.community.id,
+                'name': p.community.name,
+                'icon_url': upload_url(p.community.icon_filename, 'community_icons'),
+            } if p.community else None,
+            'like_count': p.feed_like_count,
+            'reply_count': p.feed_reply_count,
+            'liked': p.id in g.liked_post_ids,
+            'is_owner': bool(g.user and g.user.id == p.user_id),
+            'first_image': {
+                'filename': img['filename'],
+                'order': img['order'],
+                'url': upload_url(img['filename'], 'posts'),
+                'count': img['count'],
+            } if img else None,
+            'video_url': upload_url(p.video_filename, 'posts'),
+        })
+    return items
+
+
+def init_app(app):
+    app.config.setdefault('FEED_PAGE_SIZE', 20)
+    app.config.setdefault('FEED_MAX_PAGE_SIZE', 100)
@@ -0,0 +1,241 @@
+"""投稿カード・返信カードのフラグメントキャッシュ
+
+カードの HTML は「ID + バージョン」をキーにしてプロセス内 LRU に保持する。
+バージョンは投稿の編集・いいね・返信、作者のプロフィール変更などの
+コミット時に SQLAlchemy のセッションイベントで自動的に更新される。
+
+閲覧者ごとに異なる部分（いいね状態・相対時刻・削除ボタン）はスロットとして
+キャッシュ済み HTML に埋め込み、描画時に文字列の差し込みだけで埋める。
+
+バージョンはプロセスごとに持つため、複数ワーカー（``flask serve``）では他のワーカーの書き込みに
+``FRAGMENT_CACHE_TTL`` 秒までしか遅れないよう、エントリに有効期限を付ける。
+有効期限より前に上げたバージョンはどのエントリのキーにも残っていないので、古いものから捨てる。
+"""
+import itertools
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, has_app_context, render_template
+from markupsafe import Markup, escape
+from sqlalchemy import event
+
+from app import metrics
+from models import db, Post, PostImage, PostLike, Reply, ReplyImage, ReplyLike, User, Community
+
+# スロットのマーカー。本文などの利用者の入力はどんな文字でも含みうるので、区切りには
+# プロセスごとの乱数を入れる。マーカーは差し込みで必ず置き換わり応答には出ないため、利用者には分からない
+SLOT_TOKEN = secrets.token_hex(16)
+SLOT_PATTERN = re.compile(f'\ue000{SLOT_TOKEN}([?/]?\\w+)\ue000')
+
+
+def slot(name):
+    """テンプレート内でスロット位置を示すマーカーを出力"""
+    return Markup(f'\ue000{SLOT_TOKEN}{name}\ue000')
+
+
+def compile_fragment(html):
+    """描画済み HTML を「静的部分とスロット名が交互に並ぶタプル」に変換"""
+    return tuple(SLOT_PATTERN.split(html))
+
+
+def splice(parts, values, sections):
+    """キャッシュ済みフラグメントにスロット値を差し込む
+
+    ``?name`` ～ ``/name`` で囲まれた区間は ``sections[name]`` が偽なら除去する。
+    """
+    out = []
+    skip = None
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if skip is None:
+                out.append(part)
+            continue
+        head = part[0]
+        if head == '?':
+            if skip is None and not sections.get(part[1:]):
+                skip = part[1:]
+        elif head == '/':
+            if skip == part[1:]:
+                skip = None
+        elif skip is None:
+            out.append(values[part])
+    return ''.join(out)
+
+
+class FragmentCache:
+    """バージョン付きキーで描画済みフラグメントを保持する LRU キャッシュ"""
+
+    def __init__(self, max_entries=5000, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # (種類, ID) -> (バージョン, 上げた時刻)。上げた順に並ぶ
+        self._versions = OrderedDict()
+        # 捨てたキーに同じ番号を振り直さないよう、バージョンは全キーで通し番号にする
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, kind, obj_id):
+        entry = self._versions.get((kind, obj_id))
+        return entry[0] if entry is not None else 0
+
+    def _expire_versions(self, now):
+        while self._versions:
+            key, (_version, bumped_at) = next(iter(self._versions.items()))
+            if bumped_at >= now - self.ttl:
+                break
+            del self._versions[key]
+
+    def bump(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._versions.pop(key, None)
+                self._versions[key] = (next(self._sequence), now)
+            if self.ttl:
+                self._expire_versions(now)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl and entry[0] < now):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, parts):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, parts)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _affected_keys(obj):
+    """変更されたオブジェクトから無効化すべきバージョンキーを求める"""
+    if isinstance(obj, Post):
+        return [('post', obj.id)]
+    if isinstance(obj, (PostLike, PostImage)):
+        return [('post', obj.post_id)]
+    if isinstance(obj, Reply):
+        # 返信数は投稿カードにも表示される
+        return [('reply', obj.id), ('post', obj.post_id)]
+    if isinstance(obj, (ReplyLike, ReplyImage)):
+        return [('reply', obj.reply_id)]
+    if isinstance(obj, User):
+        return [('user', obj.id)]
+    if isinstance(obj, Community):
+        return [('community', obj.id)]
+    return []
+
+
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault('fragment_keys', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        pending.update(k for k in _affected_keys(obj) if k[1] is not None)
+
+
+def invalidate(session, keys):
+    """ORM を通らない書き込み（Core の一括 DELETE など）で変わったカードを、コミット時に無効化する"""
+    session.info.setdefault('fragment_keys', set()).update(keys)
+
+
+def _get_cache():
+    return current_app.extensions.get('fragment_cache')
+
+
+def _cache_key(kind, obj, author_id, community_id=None):
+    cache = _get_cache()
+    return (
+        kind,
+        obj.id,
+        cache.version(kind, obj.id),
+        cache.version('user', author_id),
+        cache.version('community', community_id),
+        g.user is not None,
+    )
+
+
+def _render_cached(key, template, **context):
+    cache = _get_cache()
+    parts = cache.get(key) if cache is not None else None
+    if parts is None:
+        parts = compile_fragment(render_template(template, slot=slot, **context))
+        if cache is not None:
+            cache.set(key, parts)
+    return parts
+
+
+def _like_slots(is_liked):
+    return {
+        'like_class': 'text-danger' if is_liked else 'text-muted',
+        'like_attr': 'true' if is_liked else 'false',
+        'like_icon': '❤️' if is_liked else '🤍',
+    }
+
+
+def post_card(p):
+    """投稿カードを描画（Jinja グローバル）"""
+    cache = _get_cache()
+    key = _cache_key('post', p, p.user_id, p.community_id) if cache is not None else None
+    parts = _render_cached(key, '_post_card.html', p=p)
+    time_ago = current_app.jinja_env.filters['time_ago']
+    values = _like_slots(p.id in g.liked_post_ids)
+    values['time'] = str(escape(time_ago(p.created_at)))
+    sections = {'owner': g.user is not None and g.user.id == p.user_id}
+    return Markup(splice(parts, values, sections))
+
+
+def reply_card(r):
+    """返信カードを描画（Jinja グローバル）"""
+    cache = _get_cache()
+    key = _cache_key('reply', r, r.user_id) if cache is not None else None
+    parts = _render_cached(key, '_reply_card.html', r=r)
+    time_ago = current_app.jinja_env.filters['time_ago']
+    values = _like_slots(r.id in g.liked_reply_ids)
+    values['time'] = str(escape(time_ago(r.created_at)))
+    return Markup(splice(parts, values, {}))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _after_flush(session, flush_context):
+    _collect_changes(session, flush_context)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    keys = session.info.pop('fragment_keys', None)
+    if keys and has_app_context():
+        cache = _get_cache()
+        if cache is not None:
+            cache.bump(keys)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('fragment_keys', None)
+
+
+def init_app(app):
+    app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 5000)
+    # 0 なら有効期限なし（ワーカーが 1 つのときだけ）
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 30.0)
+    if app.config['FRAGMENT_CACHE_ENABLED']:
+        cache = app.extensions['fragment_cache'] = FragmentCache(
+            app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+        metrics.register_cache(app, 'fragment', cache)
+    app.jinja_env.globals['post_card'] = post_card
+    app.jinja_env.globals['reply_card'] = reply_card
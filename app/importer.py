@@ -0,0 +1,476 @@
+"""他サービスからのデータ一括インポート（``flask import-data``）
+
+ディレクトリ内の ``follows`` / ``posts`` / ``replies`` / ``likes`` / ``messages``
+（それぞれ ``.jsonl`` または ``.csv``）をこの順にストリーミングで読み込み、
+大きなトランザクション単位で executemany により挿入する。
+
+レコード形式（JSONL のキー / CSV の列）:
+
+- follows : user, community, created_at
+- posts   : id, user, community, body, created_at, images, video
+- replies : id, post_id, parent_id, user, body, created_at, images, video
+- likes   : user, post_id または reply_id, created_at
+- messages: sender, recipient, body, created_at, is_read
+
+``user`` / ``sender`` / ``recipient`` はユーザー名、``community`` はコミュニティ名、
+``id`` / ``post_id`` / ``parent_id`` / ``reply_id`` は移行元の ID。
+CSV の ``images`` は JSON 配列または ``|`` 区切り。メディアのパスは ``--media-root`` 相対。
+``created_at`` は ISO 8601 か UNIX 時刻。タイムゾーンのない値は UTC とみなし、UTC の naive datetime で保存する。
+解釈できない日時のレコードはスキップして件数を表示する（空なら現在時刻）。
+
+移行元 ID との対応表（ImportMap）と進捗（ImportCheckpoint）はバッチと同じ
+トランザクションで保存するため、途中で止まっても同じコマンドで再開できる。
+ID はこちらで採番するので、インポート中はアプリの書き込みを止めておくこと。
+"""
+import csv
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import click
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+
+from models import (db, User, Community, CommunityFollow, Post, PostImage, PostLike,
+                    Reply, ReplyImage, ReplyLike, Message, ImportMap, ImportCheckpoint)
+
+KINDS = ('follows', 'posts', 'replies', 'likes', 'messages')
+
+# インポート完了時に呼ばれる後処理（非正規化カウンタの再計算など）
+FINALIZERS = []
+
+
+def finalizer(fn):
+    """インポート完了時に実行する後処理を登録するデコレータ"""
+    FINALIZERS.append(fn)
+    return fn
+
+
+class ImportAborted(click.ClickException):
+    pass
+
+
+def read_records(path):
+    """JSONL / CSV を 1 レコードずつ読む"""
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    else:
+        with open(path, encoding='utf-8', newline='') as f:
+            yield from csv.DictReader(f)
+
+
+def find_input(directory, kind):
+    for ext in ('.jsonl', '.csv'):
+        path = os.path.join(directory, kind + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class InvalidDatetime(ValueError):
+    """解釈できない日時（そのレコードはスキップする）"""
+
+
+def parse_datetime(value):
+    """アプリと同じ UTC の naive datetime にする"""
+    if value is None or value == '':
+        return datetime.utcnow()
+    text = str(value).strip()
+    try:
+        # CSV では UNIX 時刻も文字列で来る
+        return datetime.utcfromtimestamp(float(text))
+    except (ValueError, OverflowError, OSError):
+        pass
+    try:
+        dt = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidDatetime(text) from None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def parse_list(value):
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    value = str(value).strip()
+    if value.startswith('['):
+        return json.loads(value)
+    return [v for v in value.split('|') if v]
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+class MediaCopier:
+    """メディアファイルをワーカープールでアップロード先へコピーする"""
+
+    def __init__(self, media_root, workers):
+        self.media_root = media_root
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.copied = []
+        self.missing = 0
+
+    def submit(self, rel_path, upload_type):
+        """コピー先のファイル名を即座に返し、コピー自体は非同期で行う"""
+        from app.routes import allowed_file, upload_path
+
+        if not rel_path or not self.media_root:
+            return None
+        src = os.path.join(self.media_root, rel_path)
+        name = secure_filename(os.path.basename(rel_path))
+        if not os.path.isfile(src) or not allowed_file(name):
+            self.missing += 1
+            return None
+        unique = f"{uuid.uuid4().hex}_{name}"
+        dest = upload_path(unique, upload_type)
+        self.pending.append(self.pool.submit(shutil.copyfile, src, dest))
+        self.copied.append(dest)
+        return unique
+
+    def wait(self):
+        """バッチ分のコピー完了を待つ（失敗があれば例外）"""
+        pending, self.pending = self.pending, []
+        for fut in pending:
+            fut.result()
+        self.copied = []
+
+    def discard(self):
+        """ロールバックしたバッチでコピーしたファイルを消す"""
+        for fut in self.pending:
+            fut.cancel()
+        for fut in self.pending:
+            if not fut.cancelled():
+                try:
+                    fut.result()
+                except Exception:
+                    pass
+        for path in self.copied:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.pending = []
+        self.copied = []
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class Batch:
+    def __init__(self):
+        self.rows = {}
+        self.size = 0
+
+    def add(self, model, row):
+        self.rows.setdefault(model, []).append(row)
+        self.size += 1
+
+
+class Importer:
+    # 依存関係の順に挿入する
+    TABLE_ORDER = (User, Community, CommunityFollow, Post, PostImage, Reply, ReplyImage,
+                   PostLike, ReplyLike, Message, ImportMap)
+
+    def __init__(self, source, directory, media_root=None, batch_size=20000, workers=8,
+                 create_missing=True, echo=click.echo):
+        self.source = source
+        self.directory = directory
+        self.batch_size = batch_size
+        self.create_missing = create_missing
+        self.echo = echo
+        self.media = MediaCopier(media_root, workers)
+        self.skipped = {}
+        # 種類ごとの (件数, 最初の値)
+        self.invalid_dates = {}
+        self.inserted = {}
+
+    # -- ID maps ------------------------------------------------------------------
+
+    def load_maps(self):
+        self.users = dict(db.session.query(User.username, User.id))
+        self.communities = dict(db.session.query(Community.name, Community.id))
+        self.maps = {'post': {}, 'reply': {}}
+        rows = db.session.query(ImportMap.kind, ImportMap.external_id, ImportMap.local_id).filter(
+            ImportMap.source == self.source)
+        for kind, ext, local in rows.yield_per(50000):
+            self.maps[kind][ext] = local
+        self.next_ids = {}
+        for model in (User, Community, Post, Reply):
+            self.next_ids[model] = (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+        self.batch_first_ids = {}
+        # 作成するユーザーは誰も知らないパスワードで登録する（要パスワード再設定）
+        self.placeholder_hash = generate_password_hash(uuid.uuid4().hex)
+
+    def alloc(self, model):
+        new_id = self.next_ids[model]
+        self.next_ids[model] = new_id + 1
+        self.batch_first_ids.setdefault(model, new_id)
+        return new_id
+
+    def user_id(self, batch, username):
+        if not username:
+            return None
+        uid = self.users.get(username)
+        if uid is None and self.create_missing:
+            uid = self.alloc(User)
+            batch.add(User, {'id': uid, 'username': username, 'password_hash': self.placeholder_hash})
+            self.users[username] = uid
+        return uid
+
+    def community_id(self, batch, name):
+        if not name:
+            return None
+        cid = self.communities.get(name)
+        if cid is None and self.create_missing:
+            cid = self.alloc(Community)
+            batch.add(Community, {'id': cid, 'name': name, 'created_at': datetime.utcnow()})
+            self.communities[name] = cid
+        return cid
+
+    def remember(self, batch, kind, external_id, local_id):
+        ext = str(external_id)
+        self.maps[kind][ext] = local_id
+        batch.add(ImportMap, {'source': self.source, 'kind': kind, 'external_id': ext, 'local_id': local_id})
+
+    def lookup(self, kind, external_id):
+        if external_id in (None, ''):
+            return None
+        return self.maps[kind].get(str(external_id))
+
+    # -- record handlers ----------------------------------------------------------
+
+    # 日時は最初に解釈する（解釈できなければユーザー作成などの副作用の前にスキップする）
+
+    def add_follow(self, batch, rec):
+        created = parse_datetime(rec.get('created_at'))
+        uid = self.user_id(batch, rec.get('user'))
+        cid = self.community_id(batch, rec.get('community'))
+        if not uid or not cid:
+            return False
+        batch.add(CommunityFollow, {'user_id': uid, 'community_id': cid, 'created_at': created})
+        return True
+
+    def _attach_media(self, batch, rec, image_model, fk, owner_id, upload_type):
+        for order, path in enumerate(parse_list(rec.get('images'))[:4]):
+            filename = self.media.submit(path, upload_type)
+            if filename:
+                batch.add(image_model, {fk: owner_id, 'filename': filename, 'order': order})
+        return self.media.submit(rec.get('video'), upload_type)
+
+    def add_post(self, batch, rec):
+        if self.lookup('post', rec.get('id')):
+            return False
+        created = parse_datetime(rec.get('created_at'))
+        uid = self.user_id(batch, rec.get('user'))
+        cid = self.community_id(batch, rec.get('community'))
+        if not uid:
+            return False
+        pid = self.alloc(Post)
+        video = self._attach_media(batch, rec, PostImage, 'post_id', pid, 'posts')
+        batch.add(Post, {
+            'id': pid,
+            'body': rec.get('body') or '',
+            'created_at': created,
+            'user_id': uid,
+            'community_id': cid,
+            'video_filename': video,
+        })
+        if rec.get('id') not in (None, ''):
+            self.remember(batch, 'post', rec['id'], pid)
+        return True
+
+    def add_reply(self, batch, rec):
+        if self.lookup('reply', rec.get('id')):
+            return False
+        created = parse_datetime(rec.get('created_at'))
+        pid = self.lookup('post', rec.get('post_id'))
+        uid = self.user_id(batch, rec.get('user'))
+        if not pid or not uid:
+            return False
+        rid = self.alloc(Reply)
+        video = self._attach_media(batch, rec, ReplyImage, 'reply_id', rid, 'replies')
+        batch.add(Reply, {
+            'id': rid,
+            'post_id': pid,
+            'parent_id': self.lookup('reply', rec.get('parent_id')),
+            'user_id': uid,
+            'body': rec.get('body') or '',
+            'created_at': created,
+            'video_filename': video,
+        })
+        if rec.get('id') not in (None, ''):
+            self.remember(batch, 'reply', rec['id'], rid)
+        return True
+
+    def add_like(self, batch, rec):
+        created = parse_datetime(rec.get('created_at'))
+        uid = self.user_id(batch, rec.get('user'))
+        if not uid:
+            return False
+        if rec.get('post_id') not in (None, ''):
+            pid = self.lookup('post', rec['post_id'])
+            if not pid:
+                return False
+            batch.add(PostLike, {'user_id': uid, 'post_id': pid, 'created_at': created})
+        else:
+            rid = self.lookup('reply', rec.get('reply_id'))
+            if not rid:
+                return False
+            batch.add(ReplyLike, {'user_id': uid, 'reply_id': rid, 'created_at': created})
+        return True
+
+    def add_message(self, batch, rec):
+        created = parse_datetime(rec.get('created_at'))
+        sender = self.user_id(batch, rec.get('sender'))
+        if not sender:
+            return False
+        recipient = self.user_id(batch, rec.get('recipient'))
+        is_read = parse_bool(rec.get('is_read', False))
+        batch.add(Message, {
+            'body': rec.get('body') or '',
+            'created_at': created,
+            'sender_id': sender,
+            'recipient_id': recipient,
+            'is_read': is_read,
+            'read_at': created if is_read else None,
+        })
+        return True
+
+    # -- batching -------------------------------------------------------------------
+
+    def checkpoint(self, kind):
+        cp = db.session.get(ImportCheckpoint, (self.source, kind))
+        return cp.records_done if cp else 0
+
+    def flush(self, kind, batch, done):
+        if not batch.size and not done:
+            return
+        try:
+            # 先に進捗を書いて書き込みロックを取ってから ID の衝突を確認する
+            cp = db.session.get(ImportCheckpoint, (self.source, kind))
+            if cp is None:
+                cp = ImportCheckpoint(source=self.source, kind=kind)
+                db.session.add(cp)
+            cp.records_done = done
+            cp.updated_at = datetime.utcnow()
+            db.session.flush()
+            for model, first_id in self.batch_first_ids.items():
+                current_max = db.session.query(db.func.max(model.id)).scalar() or 0
+                if current_max >= first_id:
+                    raise ImportAborted(f'{model.__tablename__} の ID が他の書き込みと衝突しました。'
+                                       'アプリを停止してから再実行してください')
+            for model in self.TABLE_ORDER:
+                rows = batch.rows.get(model)
+                if not rows:
+                    continue
+                stmt = model.__table__.insert()
+                if model in (CommunityFollow, PostLike, ReplyLike):
+                    # 重複フォロー・重複いいねは無視する
+                    stmt = stmt.prefix_with('OR IGNORE')
+                result = db.session.execute(stmt, rows)
+                count = result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(rows)
+                name = model.__tablename__
+                self.inserted[name] = self.inserted.get(name, 0) + count
+            self.media.wait()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.media.discard()
+            raise
+        finally:
+            self.batch_first_ids = {}
+
+    def import_kind(self, kind):
+        path = find_input(self.directory, kind)
+        if not path:
+            return
+        handler = {
+            'follows': self.add_follow,
+            'posts': self.add_post,
+            'replies': self.add_reply,
+            'likes': self.add_like,
+            'messages': self.add_message,
+        }[kind]
+        skip = self.checkpoint(kind)
+        t0 = time.perf_counter()
+        done = 0
+        batch = Batch()
+        for rec in read_records(path):
+            done += 1
+            if done <= skip:
+                continue
+            try:
+                added = handler(batch, rec)
+            except InvalidDatetime as exc:
+                count, first = self.invalid_dates.get(kind, (0, str(exc)))
+                self.invalid_dates[kind] = (count + 1, first)
+                continue
+            if not added:
+                self.skipped[kind] = self.skipped.get(kind, 0) + 1
+            if batch.size >= self.batch_size:
+                self.flush(kind, batch, done)
+                batch = Batch()
+        self.flush(kind, batch, done)
+        elapsed = time.perf_counter() - t0
+        resumed = f'（{skip:,} 件目から再開）' if skip else ''
+        self.echo(f'{kind:<9} {done - skip:>10,} 件 {elapsed:7.1f}s{resumed}')
+
+    def run(self):
+        # 一括投入中は fsync を減らす（コミット単位の原子性は保たれる）
+        db.session.execute(db.text('PRAGMA synchronous=OFF'))
+        self.load_maps()
+        try:
+            for kind in KINDS:
+                self.import_kind(kind)
+        finally:
+            self.media.close()
+        for fn in FINALIZERS:
+            fn()
+        db.session.execute(db.text('ANALYZE'))
+        db.session.execute(db.text('PRAGMA optimize'))
+        db.session.commit()
+        return self.inserted
+
+
+@click.command('import-data')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--source', help='移行元の名前（ID 対応表と進捗の名前空間。既定はディレクトリ名）')
+@click.option('--media-root', type=click.Path(exists=True, file_okay=False), help='メディアファイルの基準ディレクトリ')
+@click.option('--batch-size', default=20000, show_default=True, help='1 トランザクションあたりのレコード数')
+@click.option('--workers', default=8, show_default=True, help='メディアコピーのスレッド数')
+@click.option('--no-create-missing', is_flag=True, help='未知のユーザー・コミュニティを作らずにスキップする')
+def import_data_command(directory, source, media_root, batch_size, workers, no_create_missing):
+    """JSONL / CSV から投稿・返信・いいね・フォロー・メッセージを一括インポートする"""
+    source = source or os.path.basename(os.path.abspath(directory))
+    importer = Importer(source, directory, media_root=media_root, batch_size=batch_size,
+                        workers=workers, create_missing=not no_create_missing)
+    t0 = time.perf_counter()
+    inserted = importer.run()
+    for table, n in inserted.items():
+        click.echo(f'  {table:<18} {n:>10,}')
+    for kind, n in importer.skipped.items():
+        click.echo(f'  スキップ {kind:<12} {n:>10,}（参照先が見つからない・重複）')
+    for kind, (n, first) in importer.invalid_dates.items():
+        click.echo(f'  スキップ {kind:<12} {n:>10,}（日時を解釈できない。例: {first!r}）')
+    if importer.media.missing:
+        click.echo(f'  見つからないメディア {importer.media.missing:,} 件')
+    click.echo(f'完了: {time.perf_counter() - t0:.1f}s')
+
+
+def init_app(app):
+    app.cli.add_command(import_data_command)
@@ -0,0 +1,489 @@
+"""Prometheus 形式のメトリクス（/metrics）
+
+``METRICS_ENABLED = True`` のときだけフックを登録する。
+
+記録はスレッドごとのシャード（dict）に対して行うためロックを取らない。
+複数ワーカープロセスで動かす場合は、各プロセスが自分の集計値を
+``METRICS_SPOOL_DIR/<pid>-<起動時刻>.json`` に定期的に書き出し（一時ファイル + os.replace）、
+/metrics はスプール内の全ファイルと自プロセスの最新値を合算して返す。
+終了したワーカーの値は ``cumulative.json`` に足し込んでから pid ごとのファイルを消すので、
+カウンタは巻き戻らず、ファイルもワーカーの入れ替えのたびに増えていかない。
+足し込みはワーカーの終了時（worker_stop / atexit）に行い、落ちたワーカーの分は
+``METRICS_REAP_INTERVAL`` 秒ごとの回収で拾う。ゲージは終了したプロセスの値に意味がないので捨てる。
+
+主なメトリクス:
+- http_requests_total / http_request_duration_seconds（エンドポイント別）
+- db_queries_total / db_query_duration_seconds（書き込み・読み取りエンジン別）
+- uploads_total / upload_bytes_total（upload_type 別）
+- poll_requests_total（/api/sync・未読数・メッセージ取得などのポーリング API）
+- cache_hits_total / cache_misses_total（register_cache で登録したキャッシュ）
+- sqlite_lock_errors_total / sqlite_lock_retries_total
+- password_hash_rejections_total
+"""
+import atexit
+import bisect
+import contextlib
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+import click
+from flask import Response, current_app, g, request
+from sqlalchemy import event
+
+from app import databases, server
+
+try:
+    import fcntl
+except ImportError:  # Windows（flask serve は 1 プロセスなのでロック不要）
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# name -> (type, help, buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP リクエスト数', None),
+    'http_request_duration_seconds': ('histogram', 'HTTP リクエストの処理時間', DEFAULT_BUCKETS),
+    'db_queries_total': ('counter', '実行した SQL 文の数', None),
+    'db_query_duration_seconds': ('histogram', 'SQL 文の実行時間', SQL_BUCKETS),
+    'uploads_total': ('counter', '保存したアップロードファイル数', None),
+    'upload_bytes_total': ('counter', '保存したアップロードファイルのバイト数', None),
+    'poll_requests_total': ('counter', 'ポーリング API へのリクエスト数', None),
+    'cache_hits_total': ('counter', 'キャッシュヒット数', None),
+    'cache_misses_total': ('counter', 'キャッシュミス数', None),
+    'sqlite_lock_errors_total': ('counter', '"database is locked" で失敗した SQL 文の数', None),
+    'sqlite_lock_retries_total': ('counter', 'ロック待ちによる再試行の回数', None),
+    'password_hash_rejections_total': ('counter', '混雑のため断ったパスワードハッシュ計算の数', None),
+}
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class Registry:
+    """プロセス内のメトリクス。記録はスレッドローカルなシャードに対して行う"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        # register_cache などで登録した関数（スナップショット時に呼ぶ）
+        self.collectors = []
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def reset(self):
+        """記録をすべて捨てる（fork したワーカーがマスターの値を二重に数えないように）"""
+        with self._shards_lock:
+            self._local = threading.local()
+            self._shards = []
+
+    def inc(self, name, labels=(), amount=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        h = histograms.get(key)
+        buckets = METRICS[name][2]
+        if h is None:
+            # [バケットごとの件数..., +Inf の件数, 合計]
+            h = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        h[bisect.bisect_left(buckets, value)] += 1
+        h[-1] += value
+
+    def snapshot(self):
+        """全シャードを合算した {'counters': {...}, 'histograms': {...}}（キーは JSON 文字列）"""
+        with self._shards_lock:
+            shards = list(self._shards)
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            # 他スレッドが更新中でも list() は GIL 下で一度にコピーされる
+            for key, value in list(shard.counters.items()):
+                k = _encode_key(key)
+                counters[k] = counters.get(k, 0) + value
+            for key, h in list(shard.histograms.items()):
+                _merge_histogram(histograms, _encode_key(key), list(h))
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                counters[_encode_key((name, labels))] = value
+        return {'counters': counters, 'histograms': histograms}
+
+
+def _encode_key(key):
+    name, labels = key
+    return json.dumps([name, list(labels)], ensure_ascii=False)
+
+
+def _merge_histogram(histograms, key, h):
+    current = histograms.get(key)
+    if current is None:
+        histograms[key] = h
+    else:
+        for i, v in enumerate(h):
+            current[i] += v
+
+
+def merge(snapshots):
+    counters = {}
+    histograms = {}
+    for snap in snapshots:
+        for key, value in snap.get('counters', {}).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, h in snap.get('histograms', {}).items():
+            _merge_histogram(histograms, key, list(h))
+    return {'counters': counters, 'histograms': histograms}
+
+
+# -- スプール（複数プロセスの集約） ---------------------------------------------
+
+CUMULATIVE_FILE = 'cumulative.json'
+_SPOOL_FILE = re.compile(r'(\d+)-\d+\.json(\.tmp)?$')
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # Windows の os.kill(pid, 0) はプロセスを終了させてしまうので確かめない
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _without_gauges(snapshot):
+    counters = {key: value for key, value in snapshot.get('counters', {}).items()
+                if METRICS.get(json.loads(key)[0], ('untyped',))[0] != 'gauge'}
+    return {'counters': counters, 'histograms': snapshot.get('histograms', {})}
+
+
+class Spool:
+    def __init__(self, directory, registry, interval):
+        self.directory = directory
+        self.registry = registry
+        self.interval = interval
+        self.path = os.path.join(directory, f'{os.getpid()}-{int(time.time() * 1000)}.json')
+        self._next_flush = 0.0
+        self._flush_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now < self._next_flush:
+            return
+        # 他スレッドが書き出し中なら任せる
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_flush = now + self.interval
+            self._write()
+        finally:
+            self._flush_lock.release()
+
+    def flush(self):
+        with self._flush_lock:
+            self._write()
+
+    def _write(self):
+        if self.path is None:
+            return  # retire() 済み。書くと累積ファイルと二重に数える
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.registry.snapshot(), f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        """累積ファイルへの足し込み（排他）と /metrics の読み込み（共有）を直列にする"""
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _fold(self, snapshots, paths):
+        """``snapshots`` を累積ファイルに足し込み、``paths`` を消す（排他ロック中に呼ぶ）"""
+        cumulative = os.path.join(self.directory, CUMULATIVE_FILE)
+        folded = [_load(cumulative) or {}]
+        folded.extend(_without_gauges(snap) for snap in snapshots)
+        tmp = f'{cumulative}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(merge(folded), f, ensure_ascii=False)
+        os.replace(tmp, cumulative)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def retire(self):
+        """終了するプロセスの値を累積ファイルに移し、自分のファイルを消す"""
+        with self._flush_lock:
+            if self.path is None:
+                return
+            with self._locked(exclusive=True):
+                # 自分のファイルより新しい手元の値を足し、ファイルは読まずに消す
+                self._fold([self.registry.snapshot()], [self.path, f'{self.path}.tmp'])
+            self.path = None
+
+    def reap(self):
+        """落ちたワーカー（pid がもういない）のファイルを累積ファイルに移す。移した件数を返す"""
+        dead = []
+        for path in glob.glob(os.path.join(self.directory, '*.json*')):
+            m = _SPOOL_FILE.match(os.path.basename(path))
+            if m and path != self.path and not _pid_alive(int(m.group(1))):
+                dead.append(path)
+        if dead:
+            with self._locked(exclusive=True):
+                # .tmp は書き込み途中で落ちた残骸なので中身は使わない
+                snapshots = [_load(p) for p in dead if not p.endswith('.tmp')]
+                self._fold([snap for snap in snapshots if snap is not None], dead)
+        return sum(1 for p in dead if not p.endswith('.tmp'))
+
+    def collect(self):
+        """スプール内の他プロセス分と自プロセスの最新値を合算する"""
+        snapshots = [self.registry.snapshot()]
+        with self._locked(exclusive=False):
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == self.path:
+                    continue
+                snap = _load(path)
+                # 書き込み途中などで読めないファイルは次回に回す
+                if snap is not None:
+                    snapshots.append(snap)
+        return merge(snapshots)
+
+
+# -- 出力 ------------------------------------------------------------------------
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for k, v in pairs)
+    return '{' + body + '}'
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+def render(data):
+    """Prometheus テキスト形式（version 0.0.4）"""
+    by_name = {}
+    for key, value in data['counters'].items():
+        name, labels = json.loads(key)
+        by_name.setdefault(name, []).append((tuple(tuple(l) for l in labels), value))
+    for key, h in data['histograms'].items():
+        name, labels = json.loads(key)
+        by_name.setdefault(name, []).append((tuple(tuple(l) for l in labels), h))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text, buckets = METRICS.get(name, ('untyped', '', None))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", repr(bound))])} {cumulative}')
+            cumulative += value[len(buckets)]
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+# -- 記録用のヘルパー（無効時は何もしない） ----------------------------------------
+
+def _registry():
+    try:
+        return current_app.extensions.get('metrics')
+    except RuntimeError:
+        return None
+
+
+def inc(name, labels=(), amount=1):
+    registry = _registry()
+    if registry is not None:
+        registry.inc(name, labels, amount)
+
+
+def observe_upload(upload_type, size):
+    registry = _registry()
+    if registry is not None:
+        registry.inc('uploads_total', (('upload_type', upload_type),))
+        registry.inc('upload_bytes_total', (('upload_type', upload_type),), size)
+
+
+def count_lock_retry(engine='write'):
+    registry = _registry()
+    if registry is not None:
+        registry.inc('sqlite_lock_retries_total', (('engine', engine),))
+
+
+def register_cache(app, name, cache):
+    """hits / misses 属性を持つキャッシュを cache_hits_total などに載せる"""
+    registry = app.extensions.get('metrics')
+    if registry is None:
+        return
+
+    def collect():
+        labels = (('cache', name),)
+        return [('cache_hits_total', labels, cache.hits), ('cache_misses_total', labels, cache.misses)]
+    registry.collectors.append(collect)
+
+
+# -- フック --------------------------------------------------------------------------
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _finish_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    registry = current_app.extensions['metrics']
+    endpoint = request.endpoint or 'unmatched'
+    if endpoint != 'metrics':
+        registry.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                              ('status', str(response.status_code))))
+        registry.observe('http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - start)
+        if endpoint in current_app.config['METRICS_POLL_ENDPOINTS']:
+            registry.inc('poll_requests_total', (('endpoint', endpoint),))
+    spool = current_app.extensions.get('metrics_spool')
+    if spool is not None:
+        spool.maybe_flush()
+    return response
+
+
+def metrics_view():
+    spool = current_app.extensions.get('metrics_spool')
+    registry = current_app.extensions['metrics']
+    data = spool.collect() if spool is not None else merge([registry.snapshot()])
+    return Response(render(data), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def instrument_engine(registry, engine, label):
+    labels = (('engine', label),)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if starts:
+            registry.inc('db_queries_total', labels)
+            registry.observe('db_query_duration_seconds', labels, time.perf_counter() - starts.pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('metrics_query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+        if 'database is locked' in str(context.original_exception):
+            registry.inc('sqlite_lock_errors_total', labels)
+
+
+@click.command('metrics-reset')
+def metrics_reset_command():
+    """スプールに残った集計ファイルを削除する（全ワーカー停止中に実行する）"""
+    directory = current_app.config['METRICS_SPOOL_DIR']
+    removed = 0
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        os.remove(path)
+        removed += 1
+    click.echo(f'{removed} 件削除しました')
+
+
+def _start_worker(app):
+    app.extensions['metrics'].reset()
+    spool = app.extensions.get('metrics_spool')
+    if spool is not None:
+        app.extensions['metrics_spool'] = Spool(spool.directory, spool.registry, spool.interval)
+
+
+def _stop_worker(app):
+    spool = app.extensions.get('metrics_spool')
+    if spool is not None:
+        spool.retire()
+
+
+def _scheduled_reap():
+    spool = current_app.extensions.get('metrics_spool')
+    if spool is not None:
+        spool.reap()
+
+
+def init_app(app, db):
+    app.config.setdefault('METRICS_ENABLED', False)
+    app.config.setdefault('METRICS_SPOOL_DIR', os.path.join(app.instance_path, 'metrics'))
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', 5.0)
+    # 落ちたワーカーのスプールファイルを回収する間隔（0 で回収しない）
+    app.config.setdefault('METRICS_REAP_INTERVAL', 60)
+    app.config.setdefault('METRICS_POLL_ENDPOINTS', (
+        'main.api_sync',
+        'main.api_unread_count',
+        'main.api_get_messages',
+        'main.api_partner_unread_count',
+    ))
+    app.cli.add_command(metrics_reset_command)
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    registry = app.extensions['metrics'] = Registry()
+    for label, engine in databases.labeled_engines(app):
+        instrument_engine(registry, engine, label)
+
+    if app.config['METRICS_SPOOL_DIR']:
+        spool = app.extensions['metrics_spool'] = Spool(
+            app.config['METRICS_SPOOL_DIR'], registry, app.config['METRICS_FLUSH_INTERVAL'])
+        atexit.register(spool.retire)
+        if app.config['METRICS_REAP_INTERVAL']:
+            server.schedule(app, 'metrics_reap', app.config['METRICS_REAP_INTERVAL'], _scheduled_reap)
+
+    # flask serve のワーカーは自分の pid のスプールファイルに書き、終了時に累積ファイルへ移す
+    server.register_hook(app, 'worker_start', _start_worker)
+    server.register_hook(app, 'worker_stop', _stop_worker)
+
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
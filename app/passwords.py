@@ -0,0 +1,150 @@
+"""パスワードハッシュ専用の上限付きエグゼキュータ
+
+パスワードのハッシュ計算は意図的に重い（scrypt / pbkdf2）。ログインや登録が集中すると
+リクエスト処理スレッドがすべてハッシュ計算に取られ、フィードなど他のページまで止まる。
+そこで計算は ``PASSWORD_HASH_WORKERS`` 本の専用スレッドで行い、実行中と待ちを合わせて
+``PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE`` 件を超える依頼は待たずに ``HashingBusy`` で断る。
+（hashlib の scrypt / pbkdf2_hmac は計算中に GIL を解放するため、スレッドで並列に動く）
+
+ハッシュの強さは ``PASSWORD_HASH_METHOD``（Werkzeug の method 文字列）で指定する。
+ログイン成功時に保存済みハッシュの方式が現在の設定と違えば、同じタスク内で作り直して返す。
+``flask hash-benchmark --target-ms 250`` で候補の方式ごとの所要時間を測り、目標に収まる最も強い設定を提案する。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import click
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import metrics
+
+# hash-benchmark で試す候補（弱い順）
+CANDIDATE_METHODS = (
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:600000',
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+    'scrypt:65536:8:1',
+    'scrypt:131072:8:1',
+)
+
+
+class HashingBusy(Exception):
+    """ハッシュ計算の待ちが上限に達している、または時間内に終わらなかった"""
+
+
+class PasswordHasher:
+    def __init__(self, method, workers, queue_size, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._prefix = None
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.inc('password_hash_rejections_total', (('reason', 'saturated'),))
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            metrics.inc('password_hash_rejections_total', (('reason', 'timeout'),))
+            raise HashingBusy()
+
+    def current_prefix(self):
+        """設定中の方式で作ったハッシュの ``method`` 部分（'scrypt:32768:8:1' など）"""
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', method=self.method).split('$', 1)[0]
+        return self._prefix
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.current_prefix()
+
+    def _hash(self, password):
+        return generate_password_hash(password, method=self.method)
+
+    def _verify(self, pwhash, password):
+        if not check_password_hash(pwhash, password):
+            return False, None
+        if self.needs_rehash(pwhash):
+            return True, self._hash(password)
+        return True, None
+
+    def hash(self, password):
+        return self._submit(self._hash, password)
+
+    def verify(self, pwhash, password):
+        """(一致したか, 作り直したハッシュまたは None) を返す"""
+        if not pwhash or password is None:
+            return False, None
+        return self._submit(self._verify, pwhash, password)
+
+
+def _hasher():
+    return current_app.extensions['password_hasher']
+
+
+def hash_password(password):
+    return _hasher().hash(password)
+
+
+def verify_password(pwhash, password):
+    return _hasher().verify(pwhash, password)
+
+
+def time_method(method, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        generate_password_hash('benchmark-password', method=method)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+@click.command('hash-benchmark')
+@click.option('--target-ms', type=float, default=250.0, show_default=True, help='1 回のハッシュ計算にかけてよい時間')
+@click.option('--rounds', type=int, default=3, show_default=True, help='方式ごとの計測回数（中央値を使う）')
+@click.option('--method', 'methods', multiple=True, help='計測する方式（既定: 組み込みの候補）')
+def hash_benchmark_command(target_ms, rounds, methods):
+    """方式ごとのハッシュ計算時間を測り、目標時間に収まる最も強い設定を提案する"""
+    methods = methods or CANDIDATE_METHODS
+    current = current_app.config['PASSWORD_HASH_METHOD']
+    best = None
+    for method in methods:
+        ms = time_method(method, rounds)
+        ok = ms <= target_ms
+        if ok:
+            best = method
+        mark = ' (現在の設定)' if method == current else ''
+        click.echo(f"{method:<24}{ms:>10.1f} ms  {'OK' if ok else '超過'}{mark}")
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if best:
+        ms = time_method(best, 1)
+        click.echo(f'\n推奨: PASSWORD_HASH_METHOD = {best!r}')
+        click.echo(f'  ワーカー {workers} 本での目安: 毎秒 {workers * 1000 / ms:.0f} 件のログイン')
+    else:
+        click.echo('\n目標時間に収まる方式がありません。--target-ms を見直してください')
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config.setdefault('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1))
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 16)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10.0)
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_QUEUE'],
+        app.config['PASSWORD_HASH_TIMEOUT'],
+    )
+    app.cli.add_command(hash_benchmark_command)
@@ -0,0 +1,198 @@
+"""リクエスト単位の性能計測と Server-Timing ヘッダ
+
+``PERF_ENABLED = True`` のときだけフックを登録する（無効時はフックも
+イベントリスナーも登録しないため、オーバーヘッドはほぼゼロ）。
+
+計測する項目:
+- db: SQL 文の数と累積実行時間（SQLAlchemy のエンジンイベント）
+- tpl: テンプレート描画時間（外側の render_template のみ）
+- upload: アップロードファイルの保存時間（``track('upload')``）
+- total: ハンドラ全体の処理時間
+
+ルートごとに直近 ``PERF_WINDOW`` 件の処理時間を保持し、
+``PERF_DEBUG_ENDPOINT = True`` なら ``/debug/perf`` で p50/p95/p99 を返す。
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, jsonify, request, template_rendered, before_render_template
+from sqlalchemy import event
+
+from app import databases
+
+
+class RequestStats:
+    __slots__ = ('start', 'sql_count', 'sql_time', 'tpl_time', 'tpl_depth', 'tpl_start', 'timers')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.tpl_time = 0.0
+        self.tpl_depth = 0
+        self.tpl_start = 0.0
+        self.timers = {}
+
+
+class RouteHistograms:
+    """ルートごとの直近 N 件の処理時間（ミリ秒）"""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, ms):
+        with self._lock:
+            samples = self._samples.get(route)
+            if samples is None:
+                samples = self._samples[route] = deque(maxlen=self.window)
+            samples.append(ms)
+
+    def snapshot(self):
+        with self._lock:
+            data = {route: sorted(samples) for route, samples in self._samples.items()}
+        return {route: summarize(samples) for route, samples in data.items()}
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[idx]
+
+
+def summarize(sorted_samples):
+    return {
+        'count': len(sorted_samples),
+        'p50': round(percentile(sorted_samples, 50), 2),
+        'p95': round(percentile(sorted_samples, 95), 2),
+        'p99': round(percentile(sorted_samples, 99), 2),
+        'max': round(sorted_samples[-1], 2) if sorted_samples else 0.0,
+    }
+
+
+def _current_stats():
+    if not has_app_context():
+        return None
+    return g.get('perf_stats')
+
+
+@contextmanager
+def track(name):
+    """任意の区間を計測する（計測無効時は何もしない）"""
+    stats = _current_stats()
+    if stats is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timers[name] = stats.timers.get(name, 0.0) + (time.perf_counter() - t0)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    if stats is not None:
+        conn.info.setdefault('perf_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish_query(conn)
+
+
+def _handle_error(context):
+    # 失敗した文（IntegrityError、"database is locked" など）は after_cursor_execute が呼ばれないので、
+    # ここで開始時刻を取り除く。残るとプールに戻った接続の次の文が古い時刻で計られる
+    if context.connection is not None:
+        _finish_query(context.connection)
+
+
+def _finish_query(conn):
+    stats = _current_stats()
+    starts = conn.info.get('perf_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_time += elapsed
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None:
+        if stats.tpl_depth == 0:
+            stats.tpl_start = time.perf_counter()
+        stats.tpl_depth += 1
+
+
+def _after_render(sender, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None and stats.tpl_depth > 0:
+        stats.tpl_depth -= 1
+        if stats.tpl_depth == 0:
+            stats.tpl_time += time.perf_counter() - stats.tpl_start
+
+
+def _start_request():
+    if request.blueprint == 'main':
+        g.perf_stats = RequestStats()
+
+
+def server_timing(stats, total):
+    parts = [
+        f'db;dur={stats.sql_time * 1000:.1f};desc="{stats.sql_count} queries"',
+        f'tpl;dur={stats.tpl_time * 1000:.1f}',
+    ]
+    for name, seconds in stats.timers.items():
+        parts.append(f'{name};dur={seconds * 1000:.1f}')
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def _finish_request(response):
+    stats = g.pop('perf_stats', None)
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.start
+    response.headers['Server-Timing'] = server_timing(stats, total)
+    route = request.endpoint or request.path
+    current_app.extensions['perf_histograms'].add(route, total * 1000)
+    return response
+
+
+def debug_perf():
+    """ルートごとの p50/p95/p99（ミリ秒）"""
+    return jsonify({'routes': current_app.extensions['perf_histograms'].snapshot()})
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def init_app(app, db):
+    app.config.setdefault('PERF_ENABLED', False)
+    app.config.setdefault('PERF_DEBUG_ENDPOINT', False)
+    app.config.setdefault('PERF_WINDOW', 1024)
+    if not app.config['PERF_ENABLED']:
+        return
+
+    app.extensions['perf_histograms'] = RouteHistograms(app.config['PERF_WINDOW'])
+    for _label, engine in databases.labeled_engines(app):
+        instrument_engine(engine)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    # load_logged_in_user など他の before_request より先に計測を開始する
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
+
+    if app.config['PERF_DEBUG_ENDPOINT']:
+        app.add_url_rule('/debug/perf', 'debug_perf', debug_perf)
@@ -0,0 +1,99 @@
+"""ルートごとのクエリ予算（SQL 文の数・読み込んだ行数の上限）
+
+テンプレートでの遅延ロードの追加などによる N+1 を、本番の負荷で初めて気づくのではなく
+``python -m benchmark.budgets`` で検出するための仕組み。
+
+- 予算はルートの横に ``@query_budget(statements=..., rows=...)`` で宣言する（app/routes.py）。
+  ``load_logged_in_user`` など、そのリクエストで実行されるものはすべて含む
+- SQL 文はエンジンのイベント（``before_cursor_execute``）で、行数は ORM がインスタンスを
+  読み込んだ回数（``load`` / ``refresh`` イベント）で数える。列だけを選ぶクエリの行は数えない
+- ``method`` を指定するとそのメソッドのリクエストだけに適用される（GET と POST で予算が違うとき）
+- ``args`` は URL の変数、``params`` はクエリ文字列（GET）またはフォーム（POST）。
+  値の ``{name}`` はチェック時のフィクスチャ（benchmark/budgets.py）で置き換えられる
+- ``order`` を 1 以上にしたルートはデータやセッションを壊すので、他のルートを計測した後に叩く（大きいほど後）
+- ``status`` / ``redirect`` は成功したときの応答。``redirect`` にはリダイレクト先のエンドポイント名を書き、
+  ``status`` を省略すると ``redirect`` があれば 302、なければ 200 を期待する。
+  失敗してすぐリダイレクトした応答の少ない SQL 文を予算内と数えないため
+- 何も読まずにリダイレクトするだけのルートは ``@no_query_budget`` を付けてチェックから外す
+
+予算の決め方:
+
+- ``statements`` はそのルートが実行する SQL 文の数そのもの（余裕は持たせない）。データの件数に
+  よらない定数のはずなので、チェックは件数が 10 倍違う 2 つのデータ（benchmark/budgets.py の
+  ``SIZES``）で同じ予算を確かめる。件数とともに増えるクエリは大きい方のデータで必ず超える。
+  データによって実行したりしなかったりする文（返信があるときだけの selectin など）は含めて数える
+- ``rows`` は 1 ページに表示する件数から決める上限で、実測値ではない。下の ``*_ROWS`` を足して書く
+"""
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from app import databases
+from models import db
+
+Budget = namedtuple('Budget', 'statements rows args params order status redirect')
+
+# ``rows`` の見積もりに使う 1 ページあたりの行数（ページの件数は各モジュールの設定の既定値）
+ITEM_ROWS = 6  # 1 件だけ扱うルート: ログインユーザー・対象・画像 4 枚まで
+FEED_PAGE_ROWS = 21 * 7  # FEED_PAGE_SIZE + 次ページ判定の 1 件 × (投稿・作者・コミュニティ・画像 4 枚)
+THREAD_ROWS = 10 * 6  # ページングしないスレッドの返信 10 件 × (返信・作者・画像 4 枚)
+MESSAGE_PAGE_ROWS = 50 + 2  # MESSAGES_PAGE_SIZE 件 + 自分と相手
+PARTNER_ROWS = 20 * 2  # ページングしない会話相手の一覧 20 人 × (最新のメッセージ・相手)
+# サイドバーのコミュニティ一覧（運営が決める分類なので件数はデータの規模によらない。チェックのデータは
+# 20 件 + 既定の 3 件 + フィクスチャ）と、ログインユーザーのフォロー
+SIDEBAR_ROWS = 30 + 10
+
+
+def query_budget(statements, rows, method=None, args=None, params=None, order=0, status=None, redirect=None):
+    """ビュー関数にクエリ予算を付ける（``@bp.route`` の直下に書く）"""
+    if status is None:
+        status = 302 if redirect else 200
+
+    def decorator(view):
+        budgets = view.__dict__.setdefault('query_budgets', {})
+        budgets[method] = Budget(statements, rows, args or {}, params or {}, order, status, redirect)
+        return view
+    return decorator
+
+
+def no_query_budget(view):
+    """予算を付けずにチェックから外す（何も読まずにリダイレクトするだけのルート）"""
+    view.query_budget_exempt = True
+    return view
+
+
+def budget_for(view, method):
+    budgets = getattr(view, 'query_budgets', {})
+    return budgets.get(method) or budgets.get(None)
+
+
+class Recorder:
+    """``with`` の間に実行された SQL 文と、ORM が読み込んだ行を数える"""
+
+    def __init__(self, app):
+        self.engines = [engine for _label, engine in databases.labeled_engines(app)]
+        self.statements = []
+        self.rows = 0
+
+    def reset(self):
+        self.statements = []
+        self.rows = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def _on_load(self, target, context, *args):
+        self.rows += 1
+
+    def __enter__(self):
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+        event.listen(db.Model, 'load', self._on_load, propagate=True)
+        event.listen(db.Model, 'refresh', self._on_load, propagate=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._on_execute)
+        event.remove(db.Model, 'load', self._on_load)
+        event.remove(db.Model, 'refresh', self._on_load)
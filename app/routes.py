@@ -1,11 +1,14 @@
 import os
 import shutil
 import uuid
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, g, current_app, send_from_directory
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, g, current_app, send_from_directory, send_file, stream_with_context, abort
 from werkzeug.utils import secure_filename
-from models import User, Post, Message, PostImage, Community, Reply, CommunityFollow, PostLike, ReplyLike, ReplyImage, db
-from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+from models import normalize_username, User, Post, Message, ArchivedMessage, PostImage, Community, Reply, CommunityFollow, PostLike, ReplyLike, ReplyImage, db
 import json
+from app import conversations, deletion, export, feed, fragment_cache, metrics, passwords, perf, search_cache, sync, unread, uploads, write_queue
+from app.query_budget import (query_budget, no_query_budget, FEED_PAGE_ROWS, ITEM_ROWS, MESSAGE_PAGE_ROWS, PARTNER_ROWS,
+                              SIDEBAR_ROWS, THREAD_ROWS)
 
 bp = Blueprint('main', __name__)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm', 'mov', 'avi', 'mkv'}
@@ -15,20 +18,9 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def get_upload_dir(upload_type):
-    """用途別のアップロードディレクトリを取得・作成"""
-    valid_types = {
-        'avatars': 'ユーザープロフィール画像',
-        'community_icons': 'コミュニティアイコン',
-        'posts': '投稿画像・動画',
-        'replies': '返信画像・動画'
-    }
-    if upload_type not in valid_types:
-        raise ValueError(f"Invalid upload type: {upload_type}")
-    
-    upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], upload_type)
-    os.makedirs(upload_dir, exist_ok=True)
-    return upload_dir
+def upload_path(filename, upload_type):
+    """アップロードファイルのパスを返す（新旧どちらの配置にあっても見つける。なければ保存先）"""
+    return uploads.path_for_write(filename, upload_type)
 
 
 def save_upload_file(file, upload_type):
@@ -38,24 +30,25 @@ def save_upload_file(file, upload_type):
     
     filename = secure_filename(file.filename)
     unique = f"{uuid.uuid4().hex}_{filename}"
-    upload_dir = get_upload_dir(upload_type)
-    save_path = os.path.join(upload_dir, unique)
-    file.save(save_path)
+    save_path = upload_path(unique, upload_type)
+    with perf.track('upload'):
+        file.save(save_path)
+    metrics.observe_upload(upload_type, os.path.getsize(save_path))
     return unique
 
 
 def delete_upload_file(filename, upload_type):
     """用途別ディレクトリからファイルを削除"""
-    if not filename:
-        return
-    
-    upload_dir = get_upload_dir(upload_type)
-    file_path = os.path.join(upload_dir, filename)
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except Exception:
-        pass
+    uploads.remove(filename, upload_type)
+
+
+def _delete_by_id(model, obj_id):
+    """write_queue.run に渡す削除（リクエストのセッションのオブジェクトは渡さず、ID で引き直す）"""
+    def delete(session):
+        obj = session.get(model, obj_id)
+        if obj is not None:
+            session.delete(obj)
+    return delete
 
 
 
@@ -93,8 +86,7 @@ def ensure_default_communities():
                         # Save into uploads/community_icons with UUID prefix
                         base = secure_filename(fname)
                         unique = f"{uuid.uuid4().hex}_{base}"
-                        dest_dir = get_upload_dir('community_icons')
-                        dest_path = os.path.join(dest_dir, unique)
+                        dest_path = upload_path(unique, 'community_icons')
                         try:
                             shutil.copyfile(src_path, dest_path)
                             c.icon_filename = unique
@@ -121,17 +113,37 @@ def build_reply_tree(replies):
     return roots
 
 
+def attach_community_counts(communities):
+    """``follower_count`` / ``post_count`` 属性を付ける（コミュニティごとに follows / posts を読み込まない）"""
+    ids = [c.id for c in communities]
+    followers, posts = {}, {}
+    if ids:
+        followers = dict(db.session.query(CommunityFollow.community_id, db.func.count(CommunityFollow.id))
+                         .filter(CommunityFollow.community_id.in_(ids)).group_by(CommunityFollow.community_id).all())
+        posts = dict(db.session.query(Post.community_id, db.func.count(Post.id))
+                     .filter(Post.community_id.in_(ids)).group_by(Post.community_id).all())
+    for c in communities:
+        c.follower_count = followers.get(c.id, 0)
+        c.post_count = posts.get(c.id, 0)
+    return communities
+
+
+# ポーリング用の API は g.user だけあればよいので、未読数やいいね一覧の読み込みを省く
+LIGHTWEIGHT_ENDPOINTS = {'main.api_sync', 'main.api_unread_count', 'main.api_partner_unread_count', 'main.api_get_messages',
+                         'main.api_user_suggest'}
+
+
 @bp.before_app_request
 def load_logged_in_user():
     user_id = session.get('user_id')
     g.user = User.query.get(user_id) if user_id else None
     # Calculate unread message count for logged-in users
-    if g.user:
-        g.unread_count = Message.query.filter_by(recipient_id=g.user.id, is_read=False).count()
-        g.following_ids = {f.community_id for f in CommunityFollow.query.filter_by(user_id=g.user.id).all()}
-        # Get all liked post and reply IDs for templates
-        g.liked_post_ids = {like.post_id for like in PostLike.query.filter_by(user_id=g.user.id).all()}
-        g.liked_reply_ids = {like.reply_id for like in ReplyLike.query.filter_by(user_id=g.user.id).all()}
+    if g.user and request.endpoint not in LIGHTWEIGHT_ENDPOINTS:
+        g.unread_count = unread.total(g.user.id)
+        # テンプレートが使うのは ID だけなので、行をモデルに組み立てずに列だけ読む
+        g.following_ids = set(db.session.scalars(db.select(CommunityFollow.community_id).where(CommunityFollow.user_id == g.user.id)))
+        g.liked_post_ids = set(db.session.scalars(db.select(PostLike.post_id).where(PostLike.user_id == g.user.id)))
+        g.liked_reply_ids = set(db.session.scalars(db.select(ReplyLike.reply_id).where(ReplyLike.user_id == g.user.id)))
     else:
         g.unread_count = 0
         g.following_ids = set()
@@ -140,6 +152,7 @@ def load_logged_in_user():
 
 
 @bp.route('/')
+@query_budget(statements=18, rows=ITEM_ROWS + SIDEBAR_ROWS + FEED_PAGE_ROWS)
 def index():
     ensure_default_communities()
     tab = request.args.get('tab', 'home')  # home, latest, search
@@ -161,19 +174,13 @@ def index():
         followed_communities = Community.query.filter(Community.id.in_(followed_ids)).order_by(Community.name.asc()).all() if followed_ids else []
     
     posts = []
+    next_cursor = None
     selected_community = None
     
-    if tab == 'home':
-        # Show only posts from followed communities
-        if g.user and followed_communities:
-            followed_ids = [c.id for c in followed_communities]
-            query = Post.query.filter(Post.community_id.in_(followed_ids))
-            posts = query.all()
-        # If not logged in or no follows, show nothing
-    elif tab == 'latest':
-        # Show all posts
-        query = Post.query.filter(Post.community_id.isnot(None))
-        posts = query.all()
+    if tab in ('home', 'latest'):
+        # 1 ページ目だけ描画し、続きは /api/feed から無限スクロールで読み込む
+        # （home はフォロー中のコミュニティのみ。未ログイン・フォローなしなら空）
+        posts, next_cursor = feed.fetch_page(tab, request.args, sort_by)
     elif tab == 'search':
         # Search functionality
         if g.user:
@@ -182,32 +189,8 @@ def index():
             followers_max = request.args.get('followers_max', type=int)
             sort_by = request.args.get('sort', 'name')  # name, followers, created_at
             
-            query = Community.query
-            if community_name:
-                query = query.filter(Community.name.ilike(f'%{community_name}%'))
-            
-            # Apply sorting
-            if sort_by == 'followers':
-                # Sort by followers count (requires Python sorting after query)
-                search_communities = query.all()
-                search_communities = sorted(search_communities, key=lambda c: len(c.follows), reverse=True)
-            elif sort_by == 'created_at':
-                # Sort by creation date (newest first)
-                search_communities = query.order_by(Community.created_at.desc()).all()
-            else:  # 'name' (default)
-                search_communities = query.order_by(Community.name.asc()).all()
-            
-            # Filter by follower count
-            if followers_min is not None or followers_max is not None:
-                filtered = []
-                for c in search_communities:
-                    count = len(c.follows)
-                    if followers_min is not None and count < followers_min:
-                        continue
-                    if followers_max is not None and count > followers_max:
-                        continue
-                    filtered.append(c)
-                search_communities = filtered
+            search_communities = attach_community_counts(
+                search_cache.search_communities(community_name, followers_min, followers_max, sort_by))
             
             return render_template('search_communities.html', 
                                  communities=communities,
@@ -217,17 +200,10 @@ def index():
                                  search_params={'community_name': community_name, 'followers_min': followers_min, 'followers_max': followers_max},
                                  sort_by=sort_by)
     
-    # Sort posts
-    if posts:
-        if sort_by == 'likes':
-            posts = sorted(posts, key=lambda p: len(p.likes), reverse=True)
-        elif sort_by == 'replies':
-            posts = sorted(posts, key=lambda p: len(p.replies), reverse=True)
-        else:  # latest (default)
-            posts = sorted(posts, key=lambda p: p.created_at, reverse=True)
-    
     return render_template('index.html', 
                          posts=posts, 
+                         next_cursor=next_cursor,
+                         feed_url=url_for('main.api_feed', scope=tab, sort=sort_by),
                          communities=communities,
                          official_communities=official_communities,
                          followed_communities=followed_communities,
@@ -237,66 +213,27 @@ def index():
 
 
 @bp.route('/search', methods=['GET', 'POST'])
+@query_budget(statements=12, rows=ITEM_ROWS + SIDEBAR_ROWS + FEED_PAGE_ROWS)
 def search_posts():
     ensure_default_communities()
-    query = Post.query.filter(Post.community_id.isnot(None))
     search_params = {
         'username': request.args.get('username', '').strip(),
         'body': request.args.get('body', '').strip(),
         'date_from': request.args.get('date_from', ''),
         'date_to': request.args.get('date_to', '')
     }
-    
-    # ユーザー名で検索
-    if search_params['username']:
-        user = User.query.filter(User.username.ilike(f"%{search_params['username']}%")).all()
-        user_ids = [u.id for u in user]
-        if user_ids:
-            query = query.filter(Post.user_id.in_(user_ids))
-        else:
-            query = query.filter(Post.user_id == -1)  # 結果なし
-    
-    # 投稿本文で検索
-    if search_params['body']:
-        query = query.filter(Post.body.ilike(f"%{search_params['body']}%"))
-    
-    # 開始日時で検索
-    if search_params['date_from']:
-        try:
-            from datetime import datetime
-            date_from = datetime.strptime(search_params['date_from'], '%Y-%m-%d')
-            query = query.filter(Post.created_at >= date_from)
-        except (ValueError, TypeError):
-            pass
-    
-    # 終了日時で検索
-    if search_params['date_to']:
-        try:
-            from datetime import datetime
-            date_to = datetime.strptime(search_params['date_to'], '%Y-%m-%d')
-            # 翌日の開始までを含める
-            from datetime import timedelta
-            date_to = date_to + timedelta(days=1)
-            query = query.filter(Post.created_at < date_to)
-        except (ValueError, TypeError):
-            pass
-
     sort_by = request.args.get('sort', 'latest')  # latest, likes, replies
     communities = Community.query.order_by(Community.name.asc()).all()
-    posts = query.all()
+    posts, next_cursor = feed.fetch_page('search', search_params, sort_by)
+    feed_url = url_for('main.api_feed', scope='search', sort=sort_by, **{k: v for k, v in search_params.items() if v})
     
-    # Sort posts based on sort_by parameter
-    if sort_by == 'likes':
-        posts = sorted(posts, key=lambda p: len(p.likes), reverse=True)
-    elif sort_by == 'replies':
-        posts = sorted(posts, key=lambda p: len(p.replies), reverse=True)
-    else:  # latest (default)
-        posts = sorted(posts, key=lambda p: p.created_at, reverse=True)
-    
-    return render_template('index.html', posts=posts, communities=communities, selected_community=None, search_active=True, search_params=search_params, sort_by=sort_by)
+    return render_template('index.html', posts=posts, communities=communities, selected_community=None, search_active=True, search_params=search_params, sort_by=sort_by, next_cursor=next_cursor, feed_url=feed_url)
 
 
 @bp.route('/communities/new', methods=['GET', 'POST'])
+@query_budget(statements=9, rows=ITEM_ROWS, method='POST', params={'name': '予算チェック', 'description': 'query budget'},
+              redirect='main.community_page')
+@query_budget(statements=5, rows=ITEM_ROWS)
 def create_community():
     if not g.user:
         flash('ログインが必要です')
@@ -311,7 +248,8 @@ def create_community():
             flash('コミュニティ名を入力してください')
             return redirect(url_for('main.create_community'))
         
-        if Community.query.filter_by(name=name).first():
+        # 削除済みで後片付けを待っているコミュニティも名前の一意制約に残っている
+        if Community.query.execution_options(include_deleted=True).filter_by(name=name).first():
             flash('同名のコミュニティが既に存在します')
             return redirect(url_for('main.create_community'))
         
@@ -342,24 +280,17 @@ def create_community():
 
 
 @bp.route('/communities/<int:community_id>', methods=['GET'])
+@query_budget(statements=15, rows=ITEM_ROWS + SIDEBAR_ROWS + FEED_PAGE_ROWS)
 def community_page(community_id):
     c = Community.query.get_or_404(community_id)
     
     # Get statistics
-    posts_count = len(c.posts)
-    followers_count = len(c.follows)
+    posts_count = Post.query.filter_by(community_id=c.id).count()
+    followers_count = CommunityFollow.query.filter_by(community_id=c.id).count()
     
     # Get sort parameter
     sort_by = request.args.get('sort', 'latest')  # latest, likes, replies
-    posts = c.posts
-    
-    # Sort posts based on sort_by parameter
-    if sort_by == 'likes':
-        posts = sorted(posts, key=lambda p: len(p.likes), reverse=True)
-    elif sort_by == 'replies':
-        posts = sorted(posts, key=lambda p: len(p.replies), reverse=True)
-    else:  # latest (default)
-        posts = sorted(posts, key=lambda p: p.created_at, reverse=True)
+    posts, next_cursor = feed.fetch_page('community', {'community_id': c.id}, sort_by)
     
     communities = Community.query.order_by(Community.name.asc()).all()
     official_communities = Community.query.filter(Community.created_by.is_(None)).order_by(Community.name.asc()).all()
@@ -374,6 +305,8 @@ def community_page(community_id):
     return render_template('community.html', 
                          community=c, 
                          posts=posts,
+                         next_cursor=next_cursor,
+                         feed_url=url_for('main.api_feed', scope='community', community_id=c.id, sort=sort_by),
                          posts_count=posts_count,
                          followers_count=followers_count,
                          communities=communities,
@@ -385,6 +318,7 @@ def community_page(community_id):
 
 
 @bp.route('/communities/<int:community_id>/follow', methods=['POST'])
+@query_budget(statements=9, rows=ITEM_ROWS, args={'community_id': '{other_community_id}'}, redirect='main.index')
 def follow_community(community_id):
     if not g.user:
         flash('ログインが必要です')
@@ -392,11 +326,10 @@ def follow_community(community_id):
     community = Community.query.get_or_404(community_id)
     existing = CommunityFollow.query.filter_by(user_id=g.user.id, community_id=community.id).first()
     if not existing:
+        user_id, community_id = g.user.id, community.id
         try:
-            db.session.add(CommunityFollow(user_id=g.user.id, community_id=community.id))
-            db.session.commit()
+            write_queue.run(lambda session: session.add(CommunityFollow(user_id=user_id, community_id=community_id)))
         except Exception:
-            db.session.rollback()
             flash('フォローに失敗しました')
             next_url = request.form.get('next') or url_for('main.index', community=community.id)
             return redirect(next_url)
@@ -406,6 +339,7 @@ def follow_community(community_id):
 
 
 @bp.route('/communities/<int:community_id>/unfollow', methods=['POST'])
+@query_budget(statements=9, rows=ITEM_ROWS, args={'community_id': '{other_community_id}'}, redirect='main.index')
 def unfollow_community(community_id):
     if not g.user:
         flash('ログインが必要です')
@@ -421,10 +355,8 @@ def unfollow_community(community_id):
     existing = CommunityFollow.query.filter_by(user_id=g.user.id, community_id=community.id).first()
     if existing:
         try:
-            db.session.delete(existing)
-            db.session.commit()
+            write_queue.run(_delete_by_id(CommunityFollow, existing.id))
         except Exception:
-            db.session.rollback()
             flash('フォロー解除に失敗しました')
             next_url = request.form.get('next') or url_for('main.index', community=community.id)
             return redirect(next_url)
@@ -434,6 +366,7 @@ def unfollow_community(community_id):
 
 
 @bp.route('/communities/<int:community_id>/delete', methods=['POST'])
+@query_budget(statements=7, rows=ITEM_ROWS, args={'community_id': '{own_community_id}'}, order=1, redirect='main.index')
 def delete_community(community_id):
     if not g.user:
         flash('ログインが必要です')
@@ -445,7 +378,8 @@ def delete_community(community_id):
         return redirect(url_for('main.index', community=community.id))
     name = community.name
     try:
-        db.session.delete(community)
+        # 投稿などの行とファイルは後片付け（app/deletion.py）が少しずつ消す
+        deletion.tombstone(community)
         db.session.commit()
     except Exception:
         db.session.rollback()
@@ -456,6 +390,8 @@ def delete_community(community_id):
 
 # Posts
 @bp.route('/post', methods=['POST'])
+@query_budget(statements=9, rows=ITEM_ROWS, params={'body': 'query budget', 'community_id': '{followed_community_id}'},
+              redirect='main.view_post')
 def create_post():
     if not g.user:
         flash('ログインが必要です')
@@ -561,9 +497,19 @@ def create_post():
 
 
 @bp.route('/post/<int:post_id>')
+@query_budget(statements=14, rows=ITEM_ROWS + SIDEBAR_ROWS + THREAD_ROWS)
 def view_post(post_id):
-    p = Post.query.get_or_404(post_id)
-    replies = Reply.query.filter_by(post_id=p.id).order_by(Reply.created_at.asc()).all()
+    p = Post.query.options(joinedload(Post.author), selectinload(Post.images)).filter_by(id=post_id).first_or_404()
+    like_count = PostLike.query.filter_by(post_id=p.id).count()
+    # 返信カード（_reply_card.html）が使う作者・画像・いいね数も返信と一緒に読む
+    reply_likes = (db.select(db.func.count(ReplyLike.id)).where(ReplyLike.reply_id == Reply.id)
+                   .correlate(Reply).scalar_subquery())
+    replies = []
+    for r, reply_like_count in (Reply.query.options(joinedload(Reply.user), selectinload(Reply.images))
+                                .filter_by(post_id=p.id).add_columns(reply_likes)
+                                .order_by(Reply.created_at.asc()).all()):
+        r.feed_like_count = reply_like_count
+        replies.append(r)
     reply_tree = build_reply_tree(replies)
     communities = Community.query.order_by(Community.name.asc()).all()
     official_communities = Community.query.filter(Community.created_by.is_(None)).order_by(Community.name.asc()).all()
@@ -571,10 +517,11 @@ def view_post(post_id):
     if g.user:
         followed_ids = {f.community_id for f in CommunityFollow.query.filter_by(user_id=g.user.id).all()}
         followed_communities = Community.query.filter(Community.id.in_(followed_ids)).order_by(Community.name.asc()).all() if followed_ids else []
-    return render_template('view_post.html', post=p, reply_tree=reply_tree, communities=communities, followed_communities=followed_communities, official_communities=official_communities)
+    return render_template('view_post.html', post=p, like_count=like_count, reply_tree=reply_tree, communities=communities, followed_communities=followed_communities, official_communities=official_communities)
 
 
 @bp.route('/post/<int:post_id>/reply', methods=['POST'])
+@query_budget(statements=7, rows=ITEM_ROWS, params={'body': 'query budget'}, redirect='main.view_post')
 def reply_post(post_id):
     if not g.user:
         flash('ログインが必要です')
@@ -671,6 +618,7 @@ def reply_post(post_id):
 
 
 @bp.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
+@no_query_budget
 def edit_post(post_id):
     # Editing posts is not supported in this app by design
     flash('投稿の編集はサポートされていません')
@@ -678,6 +626,7 @@ def edit_post(post_id):
 
 
 @bp.route('/post/<int:post_id>/delete', methods=['POST'])
+@query_budget(statements=7, rows=ITEM_ROWS, args={'post_id': '{own_post_id}'}, order=1, redirect='main.index')
 def delete_post(post_id):
     from urllib.parse import urlparse
     p = Post.query.get_or_404(post_id)
@@ -685,23 +634,9 @@ def delete_post(post_id):
         flash('権限がありません')
         return redirect(url_for('main.index'))
     
-    # Remove attached image files
-    for img in p.images:
-        delete_upload_file(img.filename, 'posts')
-    
-    # Remove attached video file
-    if p.video_filename:
-        delete_upload_file(p.video_filename, 'posts')
-
-    # Remove reply attachments (images/videos)
-    for reply in p.replies:
-        for rimg in reply.images:
-            delete_upload_file(rimg.filename, 'replies')
-        if reply.video_filename:
-            delete_upload_file(reply.video_filename, 'replies')
-    
     try:
-        db.session.delete(p)
+        # 返信・画像などの行とファイルは後片付け（app/deletion.py）が消す
+        deletion.tombstone(p)
         db.session.commit()
     except Exception:
         db.session.rollback()
@@ -731,6 +666,7 @@ def delete_post(post_id):
 
 
 @bp.route('/post/<int:post_id>/like', methods=['POST'])
+@query_budget(statements=10, rows=ITEM_ROWS)
 def like_post(post_id):
     from flask import jsonify
     if not g.user:
@@ -738,17 +674,17 @@ def like_post(post_id):
     post = Post.query.get_or_404(post_id)
     existing = PostLike.query.filter_by(user_id=g.user.id, post_id=post.id).first()
     if not existing:
+        user_id = g.user.id
         try:
-            db.session.add(PostLike(user_id=g.user.id, post_id=post.id))
-            db.session.commit()
+            write_queue.run(lambda session: session.add(PostLike(user_id=user_id, post_id=post_id)))
         except Exception:
-            db.session.rollback()
             return jsonify({'error': 'いいねに失敗しました'}), 500
     like_count = PostLike.query.filter_by(post_id=post.id).count()
     return jsonify({'success': True, 'liked': True, 'like_count': like_count})
 
 
 @bp.route('/post/<int:post_id>/unlike', methods=['POST'])
+@query_budget(statements=10, rows=ITEM_ROWS)
 def unlike_post(post_id):
     from flask import jsonify
     if not g.user:
@@ -757,16 +693,15 @@ def unlike_post(post_id):
     existing = PostLike.query.filter_by(user_id=g.user.id, post_id=post.id).first()
     if existing:
         try:
-            db.session.delete(existing)
-            db.session.commit()
+            write_queue.run(_delete_by_id(PostLike, existing.id))
         except Exception:
-            db.session.rollback()
             return jsonify({'error': 'いいね解除に失敗しました'}), 500
     like_count = PostLike.query.filter_by(post_id=post.id).count()
     return jsonify({'success': True, 'liked': False, 'like_count': like_count})
 
 
 @bp.route('/reply/<int:reply_id>/like', methods=['POST'])
+@query_budget(statements=10, rows=ITEM_ROWS)
 def like_reply(reply_id):
     from flask import jsonify
     if not g.user:
@@ -774,17 +709,17 @@ def like_reply(reply_id):
     reply = Reply.query.get_or_404(reply_id)
     existing = ReplyLike.query.filter_by(user_id=g.user.id, reply_id=reply.id).first()
     if not existing:
+        user_id = g.user.id
         try:
-            db.session.add(ReplyLike(user_id=g.user.id, reply_id=reply.id))
-            db.session.commit()
+            write_queue.run(lambda session: session.add(ReplyLike(user_id=user_id, reply_id=reply_id)))
         except Exception:
-            db.session.rollback()
             return jsonify({'error': '返信へのいいねに失敗しました'}), 500
     like_count = ReplyLike.query.filter_by(reply_id=reply.id).count()
     return jsonify({'success': True, 'liked': True, 'like_count': like_count})
 
 
 @bp.route('/reply/<int:reply_id>/unlike', methods=['POST'])
+@query_budget(statements=10, rows=ITEM_ROWS)
 def unlike_reply(reply_id):
     from flask import jsonify
     if not g.user:
@@ -793,10 +728,8 @@ def unlike_reply(reply_id):
     existing = ReplyLike.query.filter_by(user_id=g.user.id, reply_id=reply.id).first()
     if existing:
         try:
-            db.session.delete(existing)
-            db.session.commit()
+            write_queue.run(_delete_by_id(ReplyLike, existing.id))
         except Exception:
-            db.session.rollback()
             return jsonify({'error': '返信のいいね解除に失敗しました'}), 500
     like_count = ReplyLike.query.filter_by(reply_id=reply.id).count()
     return jsonify({'success': True, 'liked': False, 'like_count': like_count})
@@ -805,6 +738,9 @@ def unlike_reply(reply_id):
 
 
 @bp.route('/register', methods=['GET', 'POST'])
+@query_budget(statements=8, rows=ITEM_ROWS, method='POST', params={'username': 'budget_user', 'password': 'budget-pass'},
+              redirect='main.index')
+@query_budget(statements=5, rows=ITEM_ROWS)
 def register():
     if request.method == 'POST':
         username = (request.form.get('username') or '').strip()
@@ -814,12 +750,16 @@ def register():
         if not username or not password:
             flash('ユーザー名とパスワードが必要です')
             return redirect(url_for('main.register'))
-        # 大小文字差を無視して重複をチェック
-        if User.query.filter(func.lower(User.username) == username.lower()).first():
+        # 大小文字差を無視して重複をチェック（username_key のインデックスを使う）
+        if User.query.filter(User.username_key == normalize_username(username)).first():
             flash('ユーザー名は既に存在します')
             return redirect(url_for('main.register'))
-        u = User(username=username)
-        u.set_password(password)
+        try:
+            password_hash = passwords.hash_password(password)
+        except passwords.HashingBusy:
+            flash('ただいま混み合っています。しばらくしてから再度お試しください')
+            return render_template('register.html'), 503, {'Retry-After': '5'}
+        u = User(username=username, password_hash=password_hash)
         u.display_name = display_name or None
         # handle avatar upload
         if avatar and avatar.filename != '':
@@ -846,14 +786,29 @@ def register():
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@query_budget(statements=6, rows=ITEM_ROWS, method='POST', params={'username': '{username}', 'password': '{password}'},
+              redirect='main.index')
+@query_budget(statements=5, rows=ITEM_ROWS)
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         u = User.query.filter_by(username=username).first()
-        if not u or not u.check_password(password):
+        try:
+            ok, new_hash = passwords.verify_password(u.password_hash, password) if u else (False, None)
+        except passwords.HashingBusy:
+            flash('ただいま混み合っています。しばらくしてから再度お試しください')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        if not ok:
             flash('ユーザー名またはパスワードが無効です')
             return redirect(url_for('main.login'))
+        if new_hash:
+            # 古い設定のハッシュは、平文が手元にあるこの機会に現在の設定で作り直す
+            u.password_hash = new_hash
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
         session['user_id'] = u.id
         flash('ログインしました')
         return redirect(url_for('main.index'))
@@ -861,6 +816,7 @@ def login():
 
 
 @bp.route('/logout')
+@query_budget(statements=5, rows=ITEM_ROWS, order=1, redirect='main.index')
 def logout():
     session.pop('user_id', None)
     flash('ログアウトしました')
@@ -868,6 +824,9 @@ def logout():
 
 
 @bp.route('/settings', methods=['GET', 'POST'])
+@query_budget(statements=6, rows=ITEM_ROWS, method='POST', params={'display_name': 'query budget', 'bio': 'query budget'},
+              redirect='main.settings')
+@query_budget(statements=5, rows=ITEM_ROWS)
 def settings():
     if not g.user:
         flash('Login required')
@@ -941,6 +900,7 @@ def settings():
 
 
 @bp.route('/account/delete', methods=['POST'])
+@query_budget(statements=32, rows=ITEM_ROWS, params={'password': '{password}'}, order=2, redirect='main.index')
 def delete_account():
     """Delete user account and transfer community ownership to oldest follower"""
     if not g.user:
@@ -949,65 +909,21 @@ def delete_account():
     
     # Get password confirmation
     password = request.form.get('password')
-    if not g.user.check_password(password):
+    try:
+        ok, _ = passwords.verify_password(g.user.password_hash, password)
+    except passwords.HashingBusy:
+        flash('ただいま混み合っています。しばらくしてから再度お試しください')
+        return redirect(url_for('main.settings'))
+    if not ok:
         flash('パスワードが正しくありません')
         return redirect(url_for('main.settings'))
     
     username = g.user.username
     user_id = g.user.id
     
-    # 先に削除対象ファイル名を収集（DBトランザクション成功後に削除）
-    files_to_delete = []
-    user_posts = Post.query.filter_by(user_id=user_id).all()
-    for post in user_posts:
-        for img in post.images:
-            files_to_delete.append(('posts', img.filename))
-        if post.video_filename:
-            files_to_delete.append(('posts', post.video_filename))
-        for reply in post.replies:
-            for rimg in reply.images:
-                files_to_delete.append(('replies', rimg.filename))
-            if reply.video_filename:
-                files_to_delete.append(('replies', reply.video_filename))
-    user_replies = Reply.query.filter_by(user_id=user_id).all()
-    for reply in user_replies:
-        for rimg in reply.images:
-            files_to_delete.append(('replies', rimg.filename))
-        if reply.video_filename:
-            files_to_delete.append(('replies', reply.video_filename))
-    communities_created = Community.query.filter_by(created_by=user_id).all()
-    for community in communities_created:
-        if community.icon_filename:
-            files_to_delete.append(('community_icons', community.icon_filename))
-    if g.user.avatar_filename:
-        files_to_delete.append(('avatars', g.user.avatar_filename))
-
     try:
-        # Delete user's posts and replies
-        for post in user_posts:
-            for reply in post.replies:
-                db.session.delete(reply)
-            db.session.delete(post)
-        for reply in user_replies:
-            db.session.delete(reply)
-        # Delete messages
-        sent_messages = Message.query.filter_by(sender_id=user_id).all()
-        for msg in sent_messages:
-            db.session.delete(msg)
-        received_messages = Message.query.filter_by(recipient_id=user_id).all()
-        for msg in received_messages:
-            db.session.delete(msg)
-        # Transfer or delete communities
-        for community in communities_created:
-            oldest_follow = CommunityFollow.query.filter_by(community_id=community.id).filter(
-                CommunityFollow.user_id != user_id
-            ).order_by(CommunityFollow.created_at.asc()).first()
-            if oldest_follow:
-                community.created_by = oldest_follow.user_id
-            else:
-                db.session.delete(community)
-        # Delete the user
-        db.session.delete(g.user)
+        # 投稿・返信・いいね・フォロー・メッセージをまとめて DELETE する（ファイル名は先に集める）
+        files_to_delete = deletion.purge_user(user_id)
         db.session.commit()
     except Exception:
         db.session.rollback()
@@ -1017,6 +933,7 @@ def delete_account():
     # コミット成功後にファイル削除
     for typ, fn in files_to_delete:
         delete_upload_file(fn, typ)
+    export.discard_cached(user_id)
     
     # Clear session
     session.clear()
@@ -1025,22 +942,38 @@ def delete_account():
     return redirect(url_for('main.index'))
 
 
+@bp.route('/account/export')
+@query_budget(statements=25, rows=ITEM_ROWS, params={'refresh': '1'})
+def export_account():
+    """個人データを ZIP でダウンロード（完成済みのキャッシュは Range で再開可能）"""
+    if not g.user:
+        flash('ログインが必要です')
+        return redirect(url_for('main.login'))
+    download_name = f'{g.user.username}-export.zip'
+    cached = None if request.args.get('refresh') else export.fresh_cached_archive(g.user.id)
+    if cached:
+        resp = send_file(cached, mimetype='application/zip', as_attachment=True,
+                         download_name=download_name, conditional=True, max_age=0)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+    resp = current_app.response_class(
+        stream_with_context(export.iter_export_and_cache(g.user.id)),
+        mimetype='application/zip')
+    resp.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    resp.headers['Cache-Control'] = 'private, no-store'
+    return resp
+
+
 @bp.route('/user/<username>')
+@query_budget(statements=17, rows=ITEM_ROWS + 2 * SIDEBAR_ROWS + FEED_PAGE_ROWS)
 def user(username):
     u = User.query.filter_by(username=username).first()
     if not u:
         flash('ユーザーが見つかりません')
         return redirect(url_for('main.index'))
     sort_by = request.args.get('sort', 'latest')  # latest, likes, replies
-    posts = Post.query.filter_by(user_id=u.id).all()
-    
-    # Sort posts based on sort_by parameter
-    if sort_by == 'likes':
-        posts = sorted(posts, key=lambda p: len(p.likes), reverse=True)
-    elif sort_by == 'replies':
-        posts = sorted(posts, key=lambda p: len(p.replies), reverse=True)
-    else:  # latest (default)
-        posts = sorted(posts, key=lambda p: p.created_at, reverse=True)
+    posts, next_cursor = feed.fetch_page('user', {'username': u.username}, sort_by)
+    feed_url = url_for('main.api_feed', scope='user', username=u.username, sort=sort_by)
     
     communities = Community.query.order_by(Community.name.asc()).all()
     official_communities = Community.query.filter(Community.created_by.is_(None)).order_by(Community.name.asc()).all()
@@ -1052,12 +985,15 @@ def user(username):
     # Get communities followed by the displayed user
     user_followed_ids = {f.community_id for f in CommunityFollow.query.filter_by(user_id=u.id).all()}
     user_followed_communities = Community.query.filter(Community.id.in_(user_followed_ids)).order_by(Community.name.asc()).all() if user_followed_ids else []
+    attach_community_counts(user_followed_communities)
     
     bio = u.bio
-    return render_template('user.html', user=u, posts=posts, bio=bio, sort_by=sort_by, communities=communities, followed_communities=followed_communities, official_communities=official_communities, user_followed_communities=user_followed_communities)
+    return render_template('user.html', user=u, posts=posts, next_cursor=next_cursor, feed_url=feed_url, bio=bio, sort_by=sort_by, communities=communities, followed_communities=followed_communities, official_communities=official_communities, user_followed_communities=user_followed_communities)
 
 
 @bp.route('/messages/<username>', methods=['GET', 'POST'])
+@query_budget(statements=9, rows=ITEM_ROWS, method='POST', params={'body': 'query budget thread'}, redirect='main.messages_with')
+@query_budget(statements=14, rows=MESSAGE_PAGE_ROWS)
 def messages_with(username):
     if not g.user:
         flash('ログインが必要です')
@@ -1072,33 +1008,24 @@ def messages_with(username):
         if other.id == g.user.id:
             flash('自分自身にメッセージを送信することはできません')
             return redirect(url_for('main.messages'))
-        m = Message(body=body, sender_id=g.user.id, recipient_id=other.id)
+        sender_id, recipient_id = g.user.id, other.id
         try:
-            db.session.add(m)
-            db.session.commit()
+            write_queue.run(lambda session: session.add(Message(body=body, sender_id=sender_id, recipient_id=recipient_id)))
         except Exception:
-            db.session.rollback()
             flash('メッセージ送信に失敗しました')
             return redirect(url_for('main.messages_with', username=username))
         flash('メッセージを送信しました')
         return redirect(url_for('main.messages_with', username=username))
-    # conversation between g.user and other
-    conv = Message.query.filter(
-        ((Message.sender_id == g.user.id) & (Message.recipient_id == other.id)) |
-        ((Message.sender_id == other.id) & (Message.recipient_id == g.user.id))
-    ).order_by(Message.created_at.asc()).all()
-    # mark received messages as read
-    from datetime import datetime
-    for msg in conv:
-        if msg.recipient_id == g.user.id and not msg.is_read:
-            msg.is_read = True
-            msg.read_at = datetime.utcnow()
-    db.session.commit()
-    return render_template('messages_thread.html', other=other, messages=conv)
+    # 最新の 1 ページだけ表示し（表示した受信分を既読にする）、古い分はスクロールで読み足す
+    conv, next_before_id = conversations.fetch_page(g.user.id, other.id)
+    return render_template('messages_thread.html', other=other, messages=conv, next_before_id=next_before_id)
 
 
 # Messages
 @bp.route('/messages', methods=['GET', 'POST'])
+@query_budget(statements=10, rows=ITEM_ROWS, method='POST', params={'body': 'query budget', 'recipient': '{partner}'},
+              redirect='main.messages')
+@query_budget(statements=19, rows=SIDEBAR_ROWS + PARTNER_ROWS + MESSAGE_PAGE_ROWS, params={'username': '{partner}'})
 def messages():
     if not g.user:
         flash('ログインが必要です')
@@ -1118,12 +1045,10 @@ def messages():
             if recipient_user.id == g.user.id:
                 flash('自分自身にメッセージを送信することはできません')
                 return redirect(url_for('main.messages'))
-        m = Message(body=body, sender_id=g.user.id, recipient_id=(recipient_user.id if recipient_user else None))
+        sender_id, recipient_id = g.user.id, (recipient_user.id if recipient_user else None)
         try:
-            db.session.add(m)
-            db.session.commit()
+            write_queue.run(lambda session: session.add(Message(body=body, sender_id=sender_id, recipient_id=recipient_id)))
         except Exception:
-            db.session.rollback()
             flash('メッセージ送信に失敗しました')
             if recipient and recipient_user:
                 return redirect(url_for('main.messages', username=recipient_user.username))
@@ -1135,44 +1060,35 @@ def messages():
         return redirect(url_for('main.messages'))
 
     # Build conversation threads: partners and last message
-    msgs = Message.query.filter((Message.sender_id == g.user.id) | (Message.recipient_id == g.user.id)).order_by(Message.created_at.desc()).all()
+    # 履歴全体は読まず、会話（conversation_key）ごとの最新メッセージだけを新しい順に引く
+    latest = (db.select(db.func.max(Message.id))
+              .where((Message.sender_id == g.user.id) | (Message.recipient_id == g.user.id))
+              .group_by(Message.conversation_key))
+    msgs = Message.query.filter(Message.id.in_(latest)).order_by(Message.id.desc()).all()
     partners = {}
     for m in msgs:
-        other_id = m.sender_id if m.sender_id != g.user.id else m.recipient_id
-        if other_id is None:
-            other_key = None
-        else:
-            other_key = other_id
-        if other_key not in partners:
-            partners[other_key] = m
+        partners[m.sender_id if m.sender_id != g.user.id else m.recipient_id] = m
+    # 古いメッセージがすべてアーカイブ済みの会話も一覧に出す
+    for m in conversations.archived_partners(g.user.id, exclude=partners):
+        partners[m.recipient_id if m.sender_id == g.user.id else m.sender_id] = m
+    partner_users = {u.id: u for u in User.query.filter(User.id.in_([k for k in partners if k is not None]))}
     partner_objs = []
+    partner_unread = unread.by_sender(g.user.id)
     for k, last_msg in partners.items():
         if k is None:
             partner_objs.append({'user': None, 'last': last_msg, 'unread_count': 0})
         else:
-            u = User.query.get(k)
-            # Count unread messages from this specific user
-            unread_count = Message.query.filter_by(sender_id=k, recipient_id=g.user.id, is_read=False).count()
-            partner_objs.append({'user': u, 'last': last_msg, 'unread_count': unread_count})
+            partner_objs.append({'user': partner_users.get(k), 'last': last_msg, 'unread_count': partner_unread.get(k, 0)})
 
     # if username param is present, load the thread for that user to show on the right column
     username = request.args.get('username')
     other = None
     thread = None
+    next_before_id = None
     if username:
         other = User.query.filter_by(username=username).first()
         if other:
-            thread = Message.query.filter(
-                ((Message.sender_id == g.user.id) & (Message.recipient_id == other.id)) |
-                ((Message.sender_id == other.id) & (Message.recipient_id == g.user.id))
-            ).order_by(Message.created_at.asc()).all()
-            # mark received messages as read
-            from datetime import datetime
-            for msg in thread:
-                if msg.recipient_id == g.user.id and not msg.is_read:
-                    msg.is_read = True
-                    msg.read_at = datetime.utcnow()
-            db.session.commit()
+            thread, next_before_id = conversations.fetch_page(g.user.id, other.id)
 
     communities = Community.query.order_by(Community.name.asc()).all()
     official_communities = Community.query.filter(Community.created_by.is_(None)).order_by(Community.name.asc()).all()
@@ -1180,13 +1096,16 @@ def messages():
     if g.user:
         followed_ids = {f.community_id for f in CommunityFollow.query.filter_by(user_id=g.user.id).all()}
         followed_communities = Community.query.filter(Community.id.in_(followed_ids)).order_by(Community.name.asc()).all() if followed_ids else []
-    return render_template('messages.html', partners=partner_objs, other=other, messages_thread=thread, communities=communities, followed_communities=followed_communities, official_communities=official_communities)
+    return render_template('messages.html', partners=partner_objs, other=other, messages_thread=thread, next_before_id=next_before_id, communities=communities, followed_communities=followed_communities, official_communities=official_communities)
 
 
 @bp.route('/message/<int:msg_id>/delete', methods=['POST'])
+@query_budget(statements=7, rows=ITEM_ROWS, order=1, redirect='main.messages')
 def delete_message(msg_id):
     from urllib.parse import urlparse
-    m = Message.query.get_or_404(msg_id)
+    m = db.session.get(Message, msg_id) or db.session.get(ArchivedMessage, msg_id)
+    if m is None:
+        abort(404)
     if not g.user or g.user.id != m.sender_id:
         flash('権限がありません')
         return redirect(url_for('main.messages'))
@@ -1222,8 +1141,9 @@ def delete_message(msg_id):
 
 
 @bp.route('/api/messages/<username>')
+@query_budget(statements=7, rows=MESSAGE_PAGE_ROWS)
 def api_get_messages(username):
-    """API endpoint to fetch messages with a specific user (for real-time updates)"""
+    """API endpoint to fetch a page of messages with a specific user (scroll-back loading)"""
     from flask import jsonify
     if not g.user:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -1232,52 +1152,60 @@ def api_get_messages(username):
     if not other:
         return jsonify({'error': 'User not found'}), 404
     
-    # Get all messages between current user and the other user
-    conv = Message.query.filter(
-        ((Message.sender_id == g.user.id) & (Message.recipient_id == other.id)) |
-        ((Message.sender_id == other.id) & (Message.recipient_id == g.user.id))
-    ).order_by(Message.created_at.asc()).all()
-    
-    # Mark received messages as read
-    from datetime import datetime
-    for msg in conv:
-        if msg.recipient_id == g.user.id and not msg.is_read:
-            msg.is_read = True
-            msg.read_at = datetime.utcnow()
-    db.session.commit()
+    # before_id より前の 1 ページ（省略時は最新のページ）。渡した受信分を既読にする
+    conv, next_before_id = conversations.fetch_page(
+        g.user.id, other.id, request.args.get('before_id', type=int), request.args.get('limit', type=int))
     
     # Convert messages to JSON format
-    messages_data = []
-    for m in conv:
-        avatar_path = None
-        if m.sender and m.sender.avatar_filename:
-            avatar_path = f"avatars/{m.sender.avatar_filename}"
-        messages_data.append({
-            'id': m.id,
-            'body': m.body,
-            'sender_id': m.sender_id,
-            'recipient_id': m.recipient_id,
-            'created_at': m.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'is_read': m.is_read,
-            'sender_avatar': avatar_path,
-            'sender_display_name': m.sender.display_name or m.sender.username if m.sender else None
-        })
-    
-    return jsonify({'messages': messages_data})
+    messages_data = [sync.message_payload(m) for m in conv]
+    return jsonify({'messages': messages_data, 'next_before_id': next_before_id})
+
+
+@bp.route('/api/sync', methods=['POST'])
+@query_budget(statements=2, rows=ITEM_ROWS)
+def api_sync():
+    """未読数・会話の新着・既読位置をまとめて返す（クライアントのポーリングを 1 本化）"""
+    from flask import jsonify
+    if not g.user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    state = request.get_json(silent=True)
+    if not isinstance(state, dict):
+        state = {}
+    return jsonify(sync.build_response(g.user, state))
 
 
 @bp.route('/api/unread-count')
+@query_budget(statements=2, rows=ITEM_ROWS)
 def api_unread_count():
     """API endpoint to fetch unread message count"""
     from flask import jsonify
     if not g.user:
         return jsonify({'unread_count': 0}), 401
     
-    unread_count = Message.query.filter_by(recipient_id=g.user.id, is_read=False).count()
-    return jsonify({'unread_count': unread_count})
+    return jsonify({'unread_count': unread.total(g.user.id)})
+
+
+@bp.route('/api/users/suggest')
+@query_budget(statements=2, rows=ITEM_ROWS, params={'q': 'user1'})
+def api_user_suggest():
+    """ユーザー名の入力補完（メッセージの送信先欄）。username_key の前方一致"""
+    from flask import jsonify
+    if not g.user:
+        return jsonify({'error': 'ログインが必要です'}), 401
+    q = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 8, type=int), 20))
+    if not normalize_username(q):
+        return jsonify({'users': []})
+    rows = (db.session.query(User.username, User.display_name)
+            .filter(feed.username_prefix_filter(q))
+            .order_by(User.username_key)
+            .limit(limit)
+            .all())
+    return jsonify({'users': [{'username': r.username, 'display_name': r.display_name or r.username} for r in rows]})
 
 
 @bp.route('/api/partner-unread-count/<username>')
+@query_budget(statements=3, rows=ITEM_ROWS)
 def api_partner_unread_count(username):
     """API endpoint to fetch unread message count for a specific partner"""
     from flask import jsonify
@@ -1289,12 +1217,33 @@ def api_partner_unread_count(username):
     if not partner:
         return jsonify({'error': 'User not found'}), 404
     
-    # Count unread messages from this specific partner
-    unread_count = Message.query.filter_by(sender_id=partner.id, recipient_id=g.user.id, is_read=False).count()
-    return jsonify({'unread_count': unread_count, 'username': username})
+    return jsonify({'unread_count': unread.from_sender(g.user.id, partner.id), 'username': username})
+
+
+@bp.route('/api/feed')
+@query_budget(statements=8, rows=ITEM_ROWS + FEED_PAGE_ROWS)
+def api_feed():
+    """フィードの続きを JSON で返す（無限スクロール用）
+
+    ``format=html`` なら 1 ページ目と同じ投稿カード（_post_card.html）を描画した HTML を返す。
+    """
+    from flask import jsonify
+    scope = request.args.get('scope', 'latest')
+    if scope not in feed.SCOPES:
+        return jsonify({'error': 'Unknown scope'}), 400
+    sort_by = request.args.get('sort', 'latest')
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, current_app.config['FEED_MAX_PAGE_SIZE']))
+    posts, next_cursor = feed.fetch_page(scope, request.args, sort_by, request.args.get('cursor'), limit)
+    if request.args.get('format') == 'html':
+        html = ''.join(fragment_cache.post_card(p) for p in posts)
+        return jsonify({'html': html, 'next_cursor': next_cursor})
+    return jsonify({'posts': feed.serialize_posts(posts), 'next_cursor': next_cursor})
 
 
 @bp.route('/api/post/<int:post_id>/images')
+@query_budget(statements=7, rows=ITEM_ROWS)
 def api_post_images(post_id):
     """API endpoint to fetch all images for a post"""
     from flask import jsonify
@@ -1306,6 +1255,7 @@ def api_post_images(post_id):
 
 
 @bp.route('/api/reply/<int:reply_id>/images')
+@query_budget(statements=7, rows=ITEM_ROWS)
 def api_reply_images(reply_id):
     """API endpoint to fetch all images for a reply"""
     from flask import jsonify
@@ -1317,5 +1267,11 @@ def api_reply_images(reply_id):
 
 
 @bp.route('/uploads/<path:filename>')
+@query_budget(statements=5, rows=ITEM_ROWS)
 def uploaded_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    parts = uploads.split_url_path(filename)
+    if parts is None:
+        return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    upload_type, name = parts
+    path = uploads.resolve(name, upload_type)
+    return send_from_directory(os.path.dirname(path), name)
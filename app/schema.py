@@ -0,0 +1,158 @@
+"""スキーマのバージョン管理（SQLite の ``PRAGMA user_version``）
+
+起動のたびに ``db.create_all()`` で全テーブルの存在確認をするのをやめ、
+``user_version`` が ``SCHEMA_VERSION`` と一致していれば何もしない。
+
+スキーマを変えるときは ``SCHEMA_VERSION`` を上げ、``UPGRADES`` にその版への手順を追加する。
+新しいテーブルだけなら ``create_all`` が作るので手順は空でよい（列・インデックスの追加は手順に書く）。
+
+メッセージ用の DB を分けている場合（app/databases.py）は、ファイルごとに ``user_version`` を持ち、
+そのファイルにある bind のテーブルと手順だけを適用する。
+"""
+import logging
+
+from sqlalchemy.exc import OperationalError
+
+from app import databases
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 7
+
+# (版, bind キー, 手順) の一覧。手順は SQLAlchemy の Connection を受け取る
+UPGRADES = []
+
+
+def upgrade(version, bind_key=None):
+    """``UPGRADES`` に手順を登録するデコレータ（``bind_key`` は手順が触るテーブルの bind）"""
+    def decorator(fn):
+        UPGRADES.append((version, bind_key, fn))
+        UPGRADES.sort(key=lambda item: item[0])
+        return fn
+    return decorator
+
+
+def has_column(conn, table, column):
+    return any(row[1] == column for row in conn.exec_driver_sql(f'PRAGMA table_info("{table}")'))
+
+
+# -- 手順 ------------------------------------------------------------------------
+# 新規作成のデータベースでは create_all が最新の定義で作った後に全手順が走るので、
+# 列やインデックスが既にあっても失敗しないように書く
+
+@upgrade(2)
+def add_username_key(conn):
+    """user.username_key（正規化したユーザー名）を追加して既存の行を埋める"""
+    from models import normalize_username
+
+    if not has_column(conn, 'user', 'username_key'):
+        conn.exec_driver_sql('ALTER TABLE "user" ADD COLUMN username_key VARCHAR(80)')
+    rows = conn.exec_driver_sql('SELECT id, username FROM "user" WHERE username_key IS NULL').fetchall()
+    if rows:
+        # SQLite の lower() は ASCII しか変換しないので、キーは Python 側で計算する
+        conn.exec_driver_sql('UPDATE "user" SET username_key = ? WHERE id = ?',
+                             [(normalize_username(username), user_id) for user_id, username in rows])
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_user_username_key ON "user" (username_key)')
+
+
+@upgrade(3, bind_key='messages')
+def add_message_conversation_key(conn):
+    """message.conversation_key と (conversation_key, id) のインデックスを追加する"""
+    if not has_column(conn, 'message', 'conversation_key'):
+        conn.exec_driver_sql('ALTER TABLE message ADD COLUMN conversation_key VARCHAR(40)')
+    conn.exec_driver_sql(
+        "UPDATE message SET conversation_key = min(sender_id, recipient_id) || ':' || max(sender_id, recipient_id) "
+        'WHERE conversation_key IS NULL AND recipient_id IS NOT NULL')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_message_conversation ON message (conversation_key, id)')
+
+
+@upgrade(5, bind_key='messages')
+def build_unread_counters(conn):
+    """未読数のカウンタ（unread_counter / partner_unread_counter）を既存のメッセージから作る"""
+    from app import unread
+
+    unread.rebuild(conn)
+
+
+# 削除の後片付け（app/deletion.py）が外部キーで行を探す列。インデックス名は models の index=True と同じ ix_<テーブル>_<列>
+TOMBSTONE_INDEXES = [
+    ('post', 'community_id'), ('post', 'deleted_at'), ('post_image', 'post_id'), ('post_like', 'post_id'),
+    ('reply', 'post_id'), ('reply_image', 'reply_id'), ('reply_like', 'reply_id'), ('community_follow', 'community_id'),
+]
+
+
+@upgrade(6)
+def add_tombstones(conn):
+    """community / post に削除の墓標（deleted_at）を追加し、後片付けに使う外部キーにインデックスを張る"""
+    for table in ('community', 'post'):
+        if not has_column(conn, table, 'deleted_at'):
+            conn.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN deleted_at DATETIME')
+    for table, column in TOMBSTONE_INDEXES:
+        conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON "{table}" ({column})')
+
+
+@upgrade(7, bind_key='messages')
+def make_message_ids_autoincrement(conn):
+    """message を AUTOINCREMENT で作り直す（アーカイブへ移した ID を再利用させない）"""
+    from app import archive
+    from models import Message
+
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message'").scalar()
+    if 'AUTOINCREMENT' not in sql.upper():
+        # SQLite は ALTER TABLE で AUTOINCREMENT を付けられないので、新しい定義で作ってコピーする
+        for row in conn.exec_driver_sql('PRAGMA index_list(message)').fetchall():
+            if row[3] == 'c':  # CREATE INDEX で作ったもの（主キー・UNIQUE の自動インデックスは除く）
+                conn.exec_driver_sql(f'DROP INDEX "{row[1]}"')
+        conn.exec_driver_sql('ALTER TABLE message RENAME TO message_old')
+        Message.__table__.create(conn)
+        columns = ', '.join(c.name for c in Message.__table__.columns)
+        conn.exec_driver_sql(f'INSERT INTO message ({columns}) SELECT {columns} FROM message_old ORDER BY id')
+        conn.exec_driver_sql('DROP TABLE message_old')
+    archive.seed_id_sequence(conn)
+
+
+def _is_sqlite(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def current_version(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql('PRAGMA user_version').scalar() or 0
+
+
+def _apply(db, engine, bind_keys, from_version):
+    db.create_all(bind_key=bind_keys)
+    with engine.begin() as conn:
+        for version, bind_key, step in UPGRADES:
+            if bind_key in bind_keys and from_version < version <= SCHEMA_VERSION:
+                logger.info('schema upgrade -> %s (%s)', version, step.__name__)
+                step(conn)
+        conn.exec_driver_sql(f'PRAGMA user_version = {int(SCHEMA_VERSION)}')
+
+
+def _ensure_engine(db, engine, bind_keys):
+    if not _is_sqlite(engine):
+        db.create_all(bind_key=bind_keys)
+        return True
+
+    version = current_version(engine)
+    if version == SCHEMA_VERSION:
+        return False
+    if version > SCHEMA_VERSION:
+        logger.warning('database schema version %s is newer than the application (%s)', version, SCHEMA_VERSION)
+        return False
+    try:
+        _apply(db, engine, bind_keys, version)
+    except OperationalError:
+        # 複数のワーカーが同時に起動して先を越された場合は、最新になっていれば問題ない
+        if current_version(engine) != SCHEMA_VERSION:
+            raise
+    return True
+
+
+def ensure_schema(app, db):
+    """スキーマが最新でなければ作成・更新する。実行したら True を返す"""
+    applied = False
+    for engine, bind_keys in databases.engine_groups(app):
+        applied = _ensure_engine(db, engine, bind_keys) or applied
+    return applied
@@ -0,0 +1,250 @@
+"""検索結果キャッシュ（投稿検索・コミュニティ検索）
+
+同じキーワードの検索が繰り返されるたびに ``ilike`` の全件走査と並べ替えをしないよう、
+検索条件を正規化したキーに対して「並び順どおりの ID の一覧」をプロセス内 LRU に保持する。
+ORM オブジェクトは保持せず、ページの表示に必要な分だけ ID で読み込む。
+
+無効化は世代番号で行う。投稿の作成・削除・編集、ユーザー名の変更などのコミット時に
+SQLAlchemy のセッションイベントで世代を上げ、キーに含まれる世代が古いエントリは使われなくなる。
+
+- ``posts``: 投稿の作成・削除・編集、ユーザー名の変更（投稿検索の全ソート）
+- ``post_counts``: いいね・返信の増減（いいね順・返信順のソートのみ）
+- ``communities``: コミュニティの作成・削除・変更、フォローの増減（コミュニティ検索）
+
+投稿検索は全コミュニティが対象なので、どのコミュニティの投稿が変わっても ``posts`` の世代を上げる。
+世代はプロセスごとに持つため、複数ワーカーでは他のワーカーの書き込みに
+``SEARCH_CACHE_TTL`` 秒までしか遅れないよう、エントリに有効期限を付ける。
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+
+from app import feed, metrics
+from models import db, Community, CommunityFollow, Post, PostLike, Reply, User
+
+COMMUNITY_SORTS = ('name', 'followers', 'created_at')
+
+# SQLite の LIKE は ASCII の範囲だけ大文字・小文字を区別しないので、正規化も ASCII に限る
+# （それ以外の文字まで畳み込むと検索結果が変わってしまう）
+_ASCII_FOLD = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+class SearchCache:
+    """世代番号付きキーで検索結果の ID 一覧を保持する LRU キャッシュ"""
+
+    def __init__(self, max_entries=1000, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _get_cache():
+    return current_app.extensions.get('search_cache')
+
+
+# -- 正規化 ----------------------------------------------------------------------
+
+def normalize_term(value):
+    return (value or '').strip().translate(_ASCII_FOLD)
+
+
+def normalize_date(value):
+    """YYYY-MM-DD 以外は条件なし（apply_search_filters と同じ扱い）"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (ValueError, TypeError):
+        return ''
+
+
+def normalize_post_params(params):
+    return {
+        'username': normalize_term(params.get('username')),
+        'body': normalize_term(params.get('body')),
+        'date_from': normalize_date(params.get('date_from')),
+        'date_to': normalize_date(params.get('date_to')),
+    }
+
+
+# -- 投稿検索 --------------------------------------------------------------------
+
+def _post_generations(sort_by, cache):
+    gens = (cache.generation('posts'),)
+    if sort_by in ('likes', 'replies'):
+        gens += (cache.generation('post_counts'),)
+    return gens
+
+
+def _search_ids(params, sort_by, max_ids):
+    query = feed.scoped_query('search', params)
+    key_expr = feed.sort_key_expr(sort_by)
+    rows = query.with_entities(Post.id).order_by(key_expr.desc(), Post.id.desc()).limit(max_ids + 1).all()
+    ids = tuple(r[0] for r in rows)
+    # 上限を超えた分は、一覧の末尾に達したときにキーセットのクエリで続きを取る
+    return ids[:max_ids], len(ids) > max_ids
+
+
+def fetch_page(params, sort_by, cursor, limit):
+    """``feed.fetch_page('search', ...)`` のキャッシュ付き版"""
+    cache = _get_cache()
+    params = normalize_post_params(params)
+    key = ('posts', sort_by, tuple(sorted(params.items())), _post_generations(sort_by, cache))
+    entry = cache.get(key)
+    if entry is None:
+        entry = _search_ids(params, sort_by, current_app.config['SEARCH_CACHE_MAX_IDS'])
+        cache.set(key, entry)
+    ids, truncated = entry
+
+    start = 0
+    after = feed.decode_cursor(cursor, sort_by)
+    if after is not None:
+        try:
+            start = ids.index(after[1]) + 1
+        except ValueError:
+            # 一覧にない（上限より後ろ、または世代が変わって消えた）投稿の続き
+            return feed.query_page('search', params, sort_by, cursor, limit)
+        if start >= len(ids) and truncated:
+            return feed.query_page('search', params, sort_by, cursor, limit)
+
+    page_ids = ids[start:start + limit]
+    posts = feed.posts_by_ids(page_ids)
+    has_more = start + limit < len(ids) or truncated
+    next_cursor = feed.next_cursor_for(posts, sort_by) if has_more and posts else None
+    return posts, next_cursor
+
+
+# -- コミュニティ検索 ---------------------------------------------------------------
+
+def _community_ids(name, followers_min, followers_max, sort_by):
+    followers = (db.select(db.func.count(CommunityFollow.id))
+                 .where(CommunityFollow.community_id == Community.id)
+                 .correlate(Community).scalar_subquery())
+    query = db.session.query(Community.id)
+    if name:
+        query = query.filter(Community.name.ilike(f'%{name}%'))
+    if followers_min is not None:
+        query = query.filter(followers >= followers_min)
+    if followers_max is not None:
+        query = query.filter(followers <= followers_max)
+    if sort_by == 'followers':
+        query = query.order_by(followers.desc(), Community.id.asc())
+    elif sort_by == 'created_at':
+        query = query.order_by(Community.created_at.desc())
+    else:
+        query = query.order_by(Community.name.asc())
+    return tuple(r[0] for r in query.all())
+
+
+def search_communities(name, followers_min, followers_max, sort_by):
+    """コミュニティ検索の結果を並び順どおりに返す"""
+    if sort_by not in COMMUNITY_SORTS:
+        sort_by = 'name'
+    name = normalize_term(name)
+    cache = _get_cache()
+    ids = None
+    if cache is not None:
+        key = ('communities', name, followers_min, followers_max, sort_by, cache.generation('communities'))
+        ids = cache.get(key)
+    if ids is None:
+        ids = _community_ids(name, followers_min, followers_max, sort_by)
+        if cache is not None:
+            cache.set(key, ids)
+    if not ids:
+        return []
+    by_id = {c.id: c for c in Community.query.filter(Community.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+# -- 無効化 ----------------------------------------------------------------------
+
+def _affected_generations(obj):
+    if isinstance(obj, Post):
+        return ('posts',)
+    if isinstance(obj, User):
+        # ユーザー名の検索結果に効くのは username の変更だけ
+        return ('posts',) if inspect(obj).attrs.username.history.has_changes() else ()
+    if isinstance(obj, (PostLike, Reply)):
+        return ('post_counts',)
+    if isinstance(obj, Community):
+        # 削除の墓標（app/deletion.py）はそのコミュニティの投稿も隠す
+        return ('communities', 'posts') if inspect(obj).attrs.deleted_at.history.has_changes() else ('communities',)
+    if isinstance(obj, CommunityFollow):
+        return ('communities',)
+    return ()
+
+
+def invalidate(session, names):
+    """ORM を通らない書き込み（Core の一括 DELETE など）の後、コミット時に世代を上げる"""
+    session.info.setdefault('search_generations', set()).update(names)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _after_flush(session, flush_context):
+    pending = session.info.setdefault('search_generations', set())
+    for obj in list(session.new) + list(session.deleted):
+        pending.update(_affected_generations(obj))
+    for obj in session.dirty:
+        # 値の変わっていない dirty（関連の読み込みなど）は無視する
+        if session.is_modified(obj, include_collections=False):
+            pending.update(_affected_generations(obj))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    names = session.info.pop('search_generations', None)
+    if names and has_app_context():
+        cache = _get_cache()
+        if cache is not None:
+            cache.bump(names)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('search_generations', None)
+
+
+def init_app(app):
+    app.config.setdefault('SEARCH_CACHE_ENABLED', True)
+    app.config.setdefault('SEARCH_CACHE_SIZE', 1000)
+    app.config.setdefault('SEARCH_CACHE_TTL', 30.0)
+    app.config.setdefault('SEARCH_CACHE_MAX_IDS', 1000)
+    if app.config['SEARCH_CACHE_ENABLED']:
+        cache = app.extensions['search_cache'] = SearchCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+        metrics.register_cache(app, 'search', cache)
@@ -0,0 +1,425 @@
+"""本番用のプリフォークサーバー（``flask serve``）とワーカーのライフサイクルフック
+
+``python run.py`` はリローダーとデバッガ付きの 1 プロセスで、開発専用。
+``flask serve`` はマスターがリッスンソケットを開き、アプリを読み込んだ状態で
+``SERVER_WORKERS`` 個のワーカープロセスを fork する。各ワーカーは ``SERVER_THREADS`` 本の
+スレッドプールでリクエストを処理し、空きスレッドがあるときだけ accept するので、
+混んでいるワーカーの接続は他のワーカーが拾う。
+
+シグナル（マスターに送る）:
+- TERM / INT: 受付を止め、処理中のリクエストを終えてから終了（``SERVER_GRACEFUL_TIMEOUT`` 秒で強制終了）
+- HUP: 新しいワーカーを起動してから古いワーカーを同様に終了させる（無停止の入れ替え）
+- QUIT: 待たずに終了
+
+ワーカーは ``SERVER_MAX_REQUESTS`` 件処理すると自分から終了し、マスターが代わりを起動する（0 で無効）。
+fork できない環境（Windows）ではマスターを置かず、1 プロセスで同じ手順を実行する。
+
+ライフサイクルフックは ``register_hook(app, event, fn)`` で登録する。``fn(app)`` はアプリコンテキスト内で呼ばれる。
+- ``master_start``: fork の前にマスターで 1 回（ここで読み込んだものは全ワーカーで共有される）
+- ``worker_start``: fork 直後のワーカーで。マスターから引き継いだ接続・スレッド・ファイルの後始末をする
+- ``worker_warmup``: ``worker_start`` の後、accept を始める前。接続の確立やテンプレートの読み込み
+- ``worker_stop``: 処理中のリクエストを終えた後、ワーカーの終了直前。集計の書き出しなど
+
+ワーカー内で定期的に動かす処理（アーカイブ・削除の後片付けなど）は ``schedule(app, name, interval, job)`` で登録する。
+"""
+import errno
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # Windows（flask serve は 1 プロセスなのでロック不要）
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('master_start', 'worker_start', 'worker_warmup', 'worker_stop')
+
+# ワーカーの起動処理（フック）が失敗したときの終了コード。マスターは再起動を繰り返さずに止まる
+WORKER_BOOT_ERROR = 3
+
+
+def register_hook(app, event, fn):
+    if event not in EVENTS:
+        raise ValueError(f'unknown worker event: {event}')
+    hooks = app.extensions.setdefault('worker_hooks', {})
+    hooks.setdefault(event, []).append(fn)
+
+
+def run_hooks(app, event):
+    with app.app_context():
+        for fn in app.extensions.get('worker_hooks', {}).get(event, ()):
+            fn(app)
+
+
+# -- ワーカー内での定期実行 -----------------------------------------------------------
+
+class PeriodicJob:
+    """``interval`` 秒ごとに、ロックファイルを取れたときだけ ``job()`` をアプリコンテキスト内で実行するスレッド"""
+
+    def __init__(self, app, name, interval, job, lock_path):
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.job = job
+        self.lock_path = lock_path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('%s failed', self.name)
+
+    def run_once(self):
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # 他のワーカーが実行中
+            with self.app.app_context():
+                try:
+                    self.job()
+                finally:
+                    db.session.remove()
+
+
+def schedule(app, name, interval, job):
+    """``flask serve`` の各ワーカーで ``job()`` を ``interval`` 秒ごとに動かす（同時に実行するのは 1 つのワーカーだけ）"""
+    def start(app):
+        os.makedirs(app.instance_path, exist_ok=True)
+        periodic = app.extensions.setdefault('periodic_jobs', {})[name] = PeriodicJob(
+            app, name, interval, job, os.path.join(app.instance_path, f'{name}.lock'))
+        periodic.start()
+
+    def stop(app):
+        periodic = app.extensions.get('periodic_jobs', {}).pop(name, None)
+        if periodic is not None:
+            periodic.stop()
+
+    register_hook(app, 'worker_start', start)
+    register_hook(app, 'worker_stop', stop)
+
+
+# -- ワーカー --------------------------------------------------------------------
+
+class _RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """共有のリッスンソケットから、スレッドプールに空きがあるときだけ accept するサーバー"""
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, app, listener, threads, keepalive, max_requests):
+        # keep-alive の接続がスレッドを占有し続けないよう、無通信のまま timeout 秒経ったら閉じる
+        handler = type('RequestHandler', (_RequestHandler,), {'timeout': keepalive})
+        host, port = listener.getsockname()[:2]
+        super().__init__(host, port, app, handler=handler, fd=listener.fileno())
+        # 他のワーカーと同じソケットで accept を取り合うので、取れなかったときに待たないようにする
+        self.socket.setblocking(False)
+        self.max_requests = max_requests
+        self.handled = 0
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='worker')
+        self._stopping = threading.Event()
+        self._count_lock = threading.Lock()
+
+    def get_request(self):
+        conn, addr = self.socket.accept()
+        conn.setblocking(True)
+        return conn, addr
+
+    def stop(self):
+        self._stopping.set()
+
+    def serve(self, poll_interval=0.5):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while not self._stopping.is_set():
+                if not self._slots.acquire(timeout=poll_interval):
+                    continue
+                if not selector.select(poll_interval) or self._stopping.is_set():
+                    self._slots.release()
+                    continue
+                try:
+                    request, client_address = self.get_request()
+                except OSError:
+                    # 他のワーカーが先に accept した
+                    self._slots.release()
+                    continue
+                self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+            with self._count_lock:
+                self.handled += 1
+                if self.max_requests and self.handled >= self.max_requests:
+                    self._stopping.set()
+
+    def drain(self):
+        """受付を止め、処理中のリクエストが終わるまで待つ"""
+        self.socket.close()
+        self._executor.shutdown(wait=True)
+
+
+def _worker_config(app):
+    config = app.config
+    return (config['SERVER_THREADS'], config['SERVER_KEEPALIVE'], config['SERVER_MAX_REQUESTS'])
+
+
+def run_worker(app, listener):
+    """ワーカーの本体。終了コードを返す"""
+    try:
+        run_hooks(app, 'worker_start')
+        run_hooks(app, 'worker_warmup')
+    except Exception:
+        logger.exception('worker %s failed to boot', os.getpid())
+        return WORKER_BOOT_ERROR
+
+    server = PooledWSGIServer(app, listener, *_worker_config(app))
+
+    def handle_stop(signum, frame):
+        server.stop()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if hasattr(signal, 'SIGQUIT'):
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+
+    logger.info('worker %s ready', os.getpid())
+    server.serve()
+    server.drain()
+    try:
+        run_hooks(app, 'worker_stop')
+    except Exception:
+        logger.exception('worker %s stop hook failed', os.getpid())
+    logger.info('worker %s exited after %s requests', os.getpid(), server.handled)
+    return 0
+
+
+# -- マスター --------------------------------------------------------------------
+
+class Arbiter:
+    """ワーカープロセスの起動・監視・入れ替え"""
+
+    def __init__(self, app, sock, workers, graceful_timeout):
+        self.app = app
+        self.sock = sock
+        self.num_workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> 起動時刻
+        self._signals = []
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        # ワーカー側
+        code = 1
+        try:
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGCHLD):
+                signal.signal(sig, signal.SIG_DFL)
+            code = run_worker(self.app, self.sock)
+        except BaseException:
+            logger.exception('worker %s crashed', os.getpid())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # マスターの atexit 処理などを走らせないよう、そのまま終了する
+            os._exit(code)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _reap(self):
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if self.workers.pop(pid, None) is not None:
+                exited.append((pid, os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def _stop_workers(self, pids, graceful=True):
+        sig = signal.SIGTERM if graceful else signal.SIGKILL
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + (self.graceful_timeout if graceful else 5)
+        remaining = set(pids)
+        while remaining and time.monotonic() < deadline:
+            remaining -= {pid for pid, _ in self._reap()}
+            remaining &= set(self.workers)
+            time.sleep(0.1)
+        if remaining and graceful:
+            logger.warning('killing %s workers that did not finish in %ss', len(remaining), self.graceful_timeout)
+            self._stop_workers(remaining, graceful=False)
+
+    def reload(self):
+        """新しいワーカーを揃えてから古いワーカーを止める"""
+        old = list(self.workers)
+        for _ in range(self.num_workers):
+            self.spawn()
+        self._stop_workers(old)
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT):
+            signal.signal(sig, self._on_signal)
+        run_hooks(self.app, 'master_start')
+        for _ in range(self.num_workers):
+            self.spawn()
+
+        status = 0
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    logger.info('reloading workers')
+                    self.reload()
+                    continue
+                graceful = signum != signal.SIGQUIT
+                logger.info('shutting down (%s)', 'graceful' if graceful else 'immediate')
+                self._stop_workers(list(self.workers), graceful=graceful)
+                return status
+
+            for pid, code in self._reap():
+                if code == WORKER_BOOT_ERROR:
+                    logger.error('worker %s failed to boot; stopping', pid)
+                    self._signals.append(signal.SIGTERM)
+                    status = 1
+                    break
+                if code != 0:
+                    logger.warning('worker %s exited with %s', pid, code)
+            if not self._signals:
+                # 落ちた・max_requests で終わったワーカーを補充する
+                while len(self.workers) < self.num_workers:
+                    self.spawn()
+            time.sleep(0.2)
+
+
+def create_listener(host, port, backlog):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return (host.strip('[]') or '127.0.0.1'), int(port)
+
+
+@click.command('serve')
+@click.option('--bind', '-b', default=None, help='待ち受けるアドレス（既定: SERVER_BIND）')
+@click.option('--workers', '-w', type=int, default=None, help='ワーカープロセス数（既定: SERVER_WORKERS）')
+@click.option('--threads', '-t', type=int, default=None, help='ワーカーごとのスレッド数（既定: SERVER_THREADS）')
+@click.option('--max-requests', type=int, default=None, help='この件数を処理したワーカーを入れ替える（0 で無効）')
+@click.option('--graceful-timeout', type=float, default=None, help='終了時に処理中のリクエストを待つ秒数')
+def serve_command(bind, workers, threads, max_requests, graceful_timeout):
+    """本番用サーバーを起動する（プリフォーク + ワーカーごとのスレッドプール）"""
+    app = current_app._get_current_object()
+    config = app.config
+    for key, value in (('SERVER_BIND', bind), ('SERVER_WORKERS', workers), ('SERVER_THREADS', threads),
+                       ('SERVER_MAX_REQUESTS', max_requests), ('SERVER_GRACEFUL_TIMEOUT', graceful_timeout)):
+        if value is not None:
+            config[key] = value
+    if config['DEBUG']:
+        raise click.ClickException('DEBUG が有効です。本番サーバーでは無効にしてください')
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(process)d %(levelname)s %(message)s')
+
+    host, port = parse_bind(config['SERVER_BIND'])
+    try:
+        sock = create_listener(host, port, config['SERVER_BACKLOG'])
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE:
+            raise click.ClickException(f'{host}:{port} は使用中です')
+        raise
+
+    if not hasattr(os, 'fork'):
+        click.echo(f'fork できない環境のため 1 プロセスで待ち受けます: http://{host}:{port}')
+        run_hooks(app, 'master_start')
+        sys.exit(run_worker(app, sock))
+
+    click.echo(f"http://{host}:{port} で待ち受けます（ワーカー {config['SERVER_WORKERS']} × "
+               f"スレッド {config['SERVER_THREADS']}、マスター pid {os.getpid()}）")
+    arbiter = Arbiter(app, sock, config['SERVER_WORKERS'], config['SERVER_GRACEFUL_TIMEOUT'])
+    sys.exit(arbiter.run())
+
+
+# -- 既定のフック ------------------------------------------------------------------
+
+def _dispose_engines(app):
+    # マスターが開いた接続をワーカーで使い回さない（close=False: マスター側の接続は閉じない）
+    for engine in db.engines.values():
+        engine.dispose(close=False)
+
+
+def _connect_engines(app):
+    for engine in db.engines.values():
+        with engine.connect():
+            pass
+
+
+def _precompile_templates(app):
+    from app import startup
+    startup.precompile_templates(app)
+
+
+def init_app(app):
+    app.config.setdefault('SERVER_BIND', '127.0.0.1:8000')
+    app.config.setdefault('SERVER_WORKERS', os.cpu_count() or 1)
+    app.config.setdefault('SERVER_THREADS', 8)
+    app.config.setdefault('SERVER_BACKLOG', 2048)
+    app.config.setdefault('SERVER_KEEPALIVE', 5)
+    app.config.setdefault('SERVER_MAX_REQUESTS', 0)
+    app.config.setdefault('SERVER_GRACEFUL_TIMEOUT', 30.0)
+    # マスターで読み込んだテンプレートは fork 後のワーカーと共有される
+    register_hook(app, 'master_start', _precompile_templates)
+    register_hook(app, 'worker_start', _dispose_engines)
+    register_hook(app, 'worker_warmup', _connect_engines)
+    register_hook(app, 'worker_warmup', _precompile_templates)
+    app.cli.add_command(serve_command)
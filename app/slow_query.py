@@ -0,0 +1,270 @@
+"""スロークエリの記録と EXPLAIN QUERY PLAN の自動取得
+
+``SLOW_QUERY_ENABLED = True`` のときだけエンジンイベントを登録する。
+``SLOW_QUERY_THRESHOLD_MS`` を超えた SQL 文ごとに、正規化した SQL・パラメータの形・
+発生元のルート・SQLite の実行計画を JSON Lines でローテーションするログに書き出す。
+インデックスを使わない全件走査（``SCAN <table>``）は ``full_scan`` として目立たせる。
+
+ログはプロセスごとに ``SLOW_QUERY_LOG`` に ``.<pid>`` を付けたファイルに書く。
+ローテーションはファイルのリネームなので、``flask serve`` のワーカーが同じファイルに書くと
+互いのファイルをリネームしてログが失われる。
+
+集計は 2 通り:
+- ``SLOW_QUERY_DEBUG_ENDPOINT = True`` なら ``/debug/slow-queries`` でこのプロセスの上位 N 件
+- ``flask slow-queries`` で全プロセスのログファイル（ローテーション済みを含む）をまとめて集計
+"""
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import current_app, has_request_context, jsonify, request
+from sqlalchemy import event
+
+from app import databases
+
+logger = logging.getLogger('app.slow_query')
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+_FULL_SCAN_RE = re.compile(r'^SCAN (?!CONSTANT ROW)(?!.*\bUSING\b)')
+
+
+def normalize_sql(statement):
+    """リテラルを ? に置き換え、IN (?, ?, ...) をまとめて同じ形の SQL を 1 つに集約できるようにする"""
+    sql = _SPACE_RE.sub(' ', statement).strip()
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    return _IN_LIST_RE.sub('IN (...)', sql)
+
+
+def _type_name(value):
+    return 'null' if value is None else type(value).__name__
+
+
+def param_shape(parameters, executemany):
+    """パラメータの値は記録せず、型の並びだけを返す"""
+    if executemany:
+        rows = list(parameters) if parameters else []
+        return {'executemany': len(rows), 'row': param_shape(rows[0], False) if rows else None}
+    if isinstance(parameters, dict):
+        return {k: _type_name(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_type_name(v) for v in parameters]
+    return _type_name(parameters)
+
+
+def explain(cursor, statement, parameters):
+    """同じ接続で EXPLAIN QUERY PLAN を実行し、実行計画の各行（detail）を返す"""
+    plan_cursor = cursor.connection.cursor()
+    try:
+        plan_cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in plan_cursor.fetchall()]
+    finally:
+        plan_cursor.close()
+
+
+def is_full_scan(plan):
+    return any(_FULL_SCAN_RE.match(detail) for detail in plan)
+
+
+class SlowQueryStats:
+    """正規化した SQL ごとの件数・合計時間・最大時間（このプロセス分）"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def plan_for(self, sql):
+        entry = self._entries.get(sql)
+        return entry['plan'] if entry else None
+
+    def add(self, record):
+        with self._lock:
+            add_record(self._entries, record)
+
+    def top(self, n):
+        with self._lock:
+            entries = [dict(e, routes=sorted(e['routes'])) for e in self._entries.values()]
+        return rank(entries, n)
+
+
+def add_record(entries, record):
+    entry = entries.get(record['sql'])
+    if entry is None:
+        entry = entries[record['sql']] = {
+            'sql': record['sql'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'routes': set(), 'plan': record.get('plan'), 'full_scan': record.get('full_scan', False),
+        }
+    entry['count'] += 1
+    entry['total_ms'] += record['duration_ms']
+    entry['max_ms'] = max(entry['max_ms'], record['duration_ms'])
+    if record.get('route'):
+        entry['routes'].add(record['route'])
+    if entry['plan'] is None and record.get('plan') is not None:
+        entry['plan'] = record['plan']
+        entry['full_scan'] = record.get('full_scan', False)
+
+
+def rank(entries, n):
+    for e in entries:
+        e['total_ms'] = round(e['total_ms'], 2)
+        e['max_ms'] = round(e['max_ms'], 2)
+        e['avg_ms'] = round(e['total_ms'] / e['count'], 2) if e['count'] else 0.0
+    entries.sort(key=lambda e: e['total_ms'], reverse=True)
+    return entries[:n]
+
+
+class PerProcessFileHandler(logging.Handler):
+    """``<path>.<pid>`` に書く RotatingFileHandler。fork した後は最初の書き込みで開き直す"""
+
+    def __init__(self, path, max_bytes, backups):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._pid = None
+        self._handler = None
+
+    def emit(self, record):
+        pid = os.getpid()
+        if self._pid != pid:
+            # fork 元から引き継いだハンドラは親プロセスのファイルなので閉じずに手放す
+            self._handler = RotatingFileHandler(f'{self.path}.{pid}', maxBytes=self.max_bytes,
+                                                backupCount=self.backups, encoding='utf-8')
+            self._handler.setFormatter(self.formatter)
+            self._pid = pid
+        self._handler.emit(record)
+
+    def close(self):
+        if self._handler is not None and self._pid == os.getpid():
+            self._handler.close()
+        super().close()
+
+
+def _current_route():
+    if has_request_context():
+        return request.endpoint or request.path
+    return None
+
+
+def instrument_engine(app, engine, label):
+    threshold = app.config['SLOW_QUERY_THRESHOLD_MS'] / 1000.0
+    stats = app.extensions['slow_query_stats']
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('slow_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed < threshold:
+            return
+
+        sql = normalize_sql(statement)
+        plan = stats.plan_for(sql)
+        # 実行計画は SQL の形ごとに 1 回だけ取る（executemany や PRAGMA などは対象外）
+        if plan is None and not executemany and statement.lstrip()[:6].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH '):
+            try:
+                plan = explain(cursor, statement, parameters)
+            except Exception as e:  # EXPLAIN の失敗で本来の処理を止めない
+                plan = [f'EXPLAIN failed: {e}']
+        record = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'engine': label,
+            'route': _current_route(),
+            'duration_ms': round(elapsed * 1000, 2),
+            'sql': sql,
+            'params': param_shape(parameters, executemany),
+            'plan': plan,
+            'full_scan': is_full_scan(plan or []),
+        }
+        stats.add(record)
+        logger.warning(json.dumps(record, ensure_ascii=False))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('slow_query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def debug_slow_queries():
+    """このプロセスで記録したスロークエリの上位 N 件（合計時間順）"""
+    n = request.args.get('n', current_app.config['SLOW_QUERY_TOP_N'], type=int)
+    return jsonify({
+        'threshold_ms': current_app.config['SLOW_QUERY_THRESHOLD_MS'],
+        'queries': current_app.extensions['slow_query_stats'].top(n),
+    })
+
+
+@click.command('slow-queries')
+@click.option('--log', 'log_path', type=click.Path(dir_okay=False), help='集計するログ（その名前で始まる各プロセスのファイルをすべて読む。既定: SLOW_QUERY_LOG）')
+@click.option('--top', 'top_n', type=int, default=None, help='表示件数')
+@click.option('--full-scan-only', is_flag=True, help='全件走査を含むものだけ表示する')
+def slow_queries_command(log_path, top_n, full_scan_only):
+    """スロークエリログを SQL ごとに集計して合計時間の多い順に表示する"""
+    log_path = log_path or current_app.config['SLOW_QUERY_LOG']
+    top_n = top_n or current_app.config['SLOW_QUERY_TOP_N']
+    entries = {}
+    for path in sorted(glob.glob(log_path + '*')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    add_record(entries, json.loads(line))
+                except (ValueError, KeyError):
+                    continue
+    ranked = [e for e in entries.values() if e['full_scan'] or not full_scan_only]
+    for e in ranked:
+        e['routes'] = sorted(e['routes'])
+    ranked = rank(ranked, top_n)
+    if not ranked:
+        click.echo('スロークエリは記録されていません')
+        return
+    for i, e in enumerate(ranked, 1):
+        flag = ' [FULL SCAN]' if e['full_scan'] else ''
+        click.echo(f"{i}. total={e['total_ms']}ms count={e['count']} avg={e['avg_ms']}ms max={e['max_ms']}ms{flag}")
+        click.echo(f"   routes: {', '.join(e['routes']) or '-'}")
+        click.echo(f"   {e['sql']}")
+        for detail in e['plan'] or []:
+            click.echo(f'     plan: {detail}')
+
+
+def init_app(app, db):
+    app.config.setdefault('SLOW_QUERY_ENABLED', False)
+    app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', 50)
+    app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow_queries.log'))
+    app.config.setdefault('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+    app.config.setdefault('SLOW_QUERY_TOP_N', 20)
+    app.config.setdefault('SLOW_QUERY_DEBUG_ENDPOINT', False)
+    app.cli.add_command(slow_queries_command)
+    if not app.config['SLOW_QUERY_ENABLED']:
+        return
+
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(app.config['SLOW_QUERY_LOG']) or '.', exist_ok=True)
+        handler = PerProcessFileHandler(app.config['SLOW_QUERY_LOG'], app.config['SLOW_QUERY_LOG_MAX_BYTES'],
+                                        app.config['SLOW_QUERY_LOG_BACKUPS'])
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
+
+    app.extensions['slow_query_stats'] = SlowQueryStats()
+    for label, engine in databases.labeled_engines(app):
+        instrument_engine(app, engine, label)
+
+    if app.config['SLOW_QUERY_DEBUG_ENDPOINT']:
+        app.add_url_rule('/debug/slow-queries', 'debug_slow_queries', debug_slow_queries)
@@ -0,0 +1,126 @@
+"""SQLite 本番向けエンジンプロファイル
+
+``SQLITE_PROFILE = 'production'``（既定）のとき、書き込み用エンジンと
+読み取り専用エンジンの両方に次の PRAGMA を接続ごとに適用する。
+
+- journal_mode=WAL（読み取りが書き込みをブロックしない）
+- synchronous=NORMAL / busy_timeout / mmap_size / cache_size / temp_store
+
+GET・HEAD リクエスト中の読み取りは ``models.RoutingSession`` によって
+読み取り専用エンジン（``query_only=ON``）へ振り分けられ、書き込みロックを
+取り合わない。メッセージ用の DB を分けている場合（app/databases.py）はそちらにも同じ設定をする。``'default'`` を指定すると従来どおり SQLAlchemy の既定値で動く。
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+from app import databases, server
+
+
+def is_file_sqlite(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _pragmas(config, read_only=False):
+    pragmas = [
+        ('journal_mode', config['SQLITE_JOURNAL_MODE']),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT_MS'])),
+        ('mmap_size', int(config['SQLITE_MMAP_SIZE'])),
+        ('cache_size', int(config['SQLITE_CACHE_SIZE'])),
+        ('temp_store', config['SQLITE_TEMP_STORE']),
+        ('foreign_keys', 'ON'),
+    ]
+    if read_only:
+        pragmas.append(('query_only', 'ON'))
+    return pragmas
+
+
+def apply_pragmas(engine, pragmas):
+    """エンジンが新しい接続を張るたびに PRAGMA を実行する"""
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, connection_record):
+        cur = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas:
+                cur.execute(f'PRAGMA {name}={value}')
+        finally:
+            cur.close()
+
+
+def _engine_options(config, pool_size, max_overflow):
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': config['SQLITE_POOL_TIMEOUT'],
+        # busy_timeout PRAGMA と揃える（pysqlite の timeout は秒単位）
+        'connect_args': {
+            'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000.0,
+            'check_same_thread': False,
+        },
+    }
+
+
+def configure(app):
+    """db.init_app() より前に呼び、エンジンオプションを設定する"""
+    app.config.setdefault('SQLITE_PROFILE', 'production')
+    app.config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    # 負の値は KiB 単位（-64000 で約 64MB）
+    app.config.setdefault('SQLITE_CACHE_SIZE', -64000)
+    app.config.setdefault('SQLITE_TEMP_STORE', 'MEMORY')
+    # SQLite は単一ライターなので書き込み側のプールは小さく保つ
+    app.config.setdefault('SQLITE_WRITE_POOL_SIZE', 2)
+    app.config.setdefault('SQLITE_WRITE_MAX_OVERFLOW', 2)
+    app.config.setdefault('SQLITE_READ_POOL_SIZE', 8)
+    app.config.setdefault('SQLITE_READ_MAX_OVERFLOW', 8)
+    app.config.setdefault('SQLITE_POOL_TIMEOUT', 10)
+
+    if not _is_production(app):
+        return
+    options = _engine_options(app.config, app.config['SQLITE_WRITE_POOL_SIZE'], app.config['SQLITE_WRITE_MAX_OVERFLOW'])
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def _is_production(app):
+    return app.config['SQLITE_PROFILE'] == 'production' and is_file_sqlite(app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+def create_sibling_engine(app, url, pool_size, max_overflow, read_only=False):
+    """書き込み用エンジンと同じ接続設定・PRAGMA で別のエンジンを作る（読み取り専用・グループコミット用）"""
+    engine = create_engine(url, **_engine_options(app.config, pool_size, max_overflow))
+    if _is_production(app):
+        apply_pragmas(engine, _pragmas(app.config, read_only=read_only))
+    return engine
+
+
+def init_app(app, db):
+    """db.init_app() の後に呼び、PRAGMA と読み取り専用エンジンを準備する"""
+    if not _is_production(app):
+        return
+    # 書き込み用エンジン（既定の DB、MESSAGES_DATABASE_URI があればメッセージ用の DB）ごとに用意する
+    read_engines = {}
+    for write_engine, _keys in databases.engine_groups(app):
+        if not is_file_sqlite(write_engine.url):
+            continue
+        apply_pragmas(write_engine, _pragmas(app.config))
+        read_engines[write_engine] = create_sibling_engine(
+            app, write_engine.url, app.config['SQLITE_READ_POOL_SIZE'], app.config['SQLITE_READ_MAX_OVERFLOW'],
+            read_only=True)
+    app.extensions['sqlite_read_engines'] = read_engines
+
+    def dispose(app):
+        for engine in read_engines.values():
+            engine.dispose(close=False)
+
+    def connect(app):
+        for engine in read_engines.values():
+            engine.connect().close()
+
+    # flask serve: fork したワーカーはマスターの接続を捨て、受付前に接続し直す
+    server.register_hook(app, 'worker_start', dispose)
+    server.register_hook(app, 'worker_warmup', connect)
@@ -0,0 +1,102 @@
+"""ワーカー起動の高速化と起動時間の計測
+
+- Jinja のバイトコードキャッシュ（``JINJA_BYTECODE_CACHE_DIR``）。テンプレートのコンパイル結果を
+  ファイルに残し、再起動後や他のワーカーでは読み込むだけで済ませる
+- ``TEMPLATES_PRECOMPILE = True`` なら起動時に全テンプレートを読み込んでおき、
+  各ワーカーの最初のリクエストでコンパイルが走らないようにする
+- ``flask startup-profile`` で import・アプリ生成・最初のリクエストにかかる時間を別プロセスで計測する
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+# 別プロセスで実行する計測スクリプト（import から計測するためコールドな状態で動かす）
+_PROFILE_SCRIPT = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import app as app_package
+t1 = time.perf_counter()
+app = app_package.create_app()
+t2 = time.perf_counter()
+client = app.test_client()
+paths = json.loads(sys.argv[1])
+requests = []
+for path in paths:
+    for attempt in ('first', 'second'):
+        s = time.perf_counter()
+        status = client.get(path).status_code
+        requests.append({'path': path, 'attempt': attempt, 'status': status, 'ms': (time.perf_counter() - s) * 1000})
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'create_app_ms': (t2 - t1) * 1000,
+    'phases': app.extensions.get('startup_timings', {}),
+    'requests': requests,
+}))
+'''
+
+
+def configure_templates(app):
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def precompile_templates(app):
+    """全テンプレートを読み込んで Jinja の環境にキャッシュさせる"""
+    count = 0
+    for name in app.jinja_env.list_templates(extensions=('html',)):
+        app.jinja_env.get_template(name)
+        count += 1
+    return count
+
+
+def record(app, phase, seconds):
+    app.extensions.setdefault('startup_timings', {})[phase] = round(seconds * 1000, 2)
+
+
+@click.command('startup-profile')
+@click.option('--runs', type=int, default=3, show_default=True, help='計測回数（中央値を表示）')
+@click.option('--path', 'paths', multiple=True, help='最初のリクエストで叩くパス（既定: / と /?tab=latest）')
+def startup_profile_command(runs, paths):
+    """import・create_app・最初のリクエストの所要時間を別プロセスで計測する"""
+    paths = list(paths) or ['/', '/?tab=latest']
+    root = os.path.dirname(current_app.root_path)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    results = []
+    for i in range(runs):
+        proc = subprocess.run([sys.executable, '-c', _PROFILE_SCRIPT, json.dumps(paths)], cwd=root, env=env,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise click.ClickException(proc.stderr.strip().splitlines()[-1] if proc.stderr else '計測に失敗しました')
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    click.echo(f'{runs} 回の中央値（ミリ秒）')
+    click.echo(f"  import app                    {median([r['import_ms'] for r in results]):>9.1f}")
+    click.echo(f"  create_app()                  {median([r['create_app_ms'] for r in results]):>9.1f}")
+    for phase in results[0]['phases']:
+        click.echo(f"    {phase:<28}{median([r['phases'].get(phase, 0.0) for r in results]):>9.1f}")
+    for idx, req in enumerate(results[0]['requests']):
+        label = f"GET {req['path']} ({req['attempt']})"
+        click.echo(f"  {label:<30}{median([r['requests'][idx]['ms'] for r in results]):>9.1f}  [{req['status']}]")
+
+
+def init_app(app):
+    app.config.setdefault('JINJA_BYTECODE_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    app.config.setdefault('TEMPLATES_PRECOMPILE', False)
+    configure_templates(app)
+    if app.config['TEMPLATES_PRECOMPILE']:
+        t0 = time.perf_counter()
+        precompile_templates(app)
+        record(app, 'templates', time.perf_counter() - t0)
+    app.cli.add_command(startup_profile_command)
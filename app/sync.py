@@ -0,0 +1,124 @@
+"""クライアントのポーリングをまとめる /api/sync
+
+クライアントは手元の状態（未読総数・開いている会話ごとの最終メッセージ ID と既読位置）を送り、
+サーバーは変化した値だけを 1 つのレスポンスで返す。あわせて次回ポーリングまでの
+推奨間隔を返し、操作のないクライアントやバックグラウンドのタブは間隔を延ばす。
+
+リクエスト例::
+
+    {"unread_total": 3, "threads": {"alice": {"after_id": 120, "read_up_to": 118}},
+     "partners": true, "idle_ms": 4000, "hidden": false, "interval_ms": 1000}
+"""
+from flask import current_app
+
+from app import conversations, unread
+from models import db, User
+
+
+def message_payload(m):
+    avatar_path = None
+    if m.sender and m.sender.avatar_filename:
+        avatar_path = f"avatars/{m.sender.avatar_filename}"
+    return {
+        'id': m.id,
+        'body': m.body,
+        'sender_id': m.sender_id,
+        'recipient_id': m.recipient_id,
+        'created_at': m.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_read': m.is_read,
+        'sender_avatar': avatar_path,
+        'sender_display_name': m.sender.display_name or m.sender.username if m.sender else None
+    }
+
+
+def _int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def suggest_interval(state, changed, watching_thread):
+    """次回ポーリングまでの推奨間隔（ミリ秒）
+
+    変化があった・前回のポーリング以降に操作があったなら基本間隔に戻し、
+    そうでなければ前回の間隔から SYNC_BACKOFF 倍ずつ延ばす。
+    一定時間操作がない・タブが非表示なら上限を返す。
+    """
+    config = current_app.config
+    base = config['SYNC_THREAD_INTERVAL_MS'] if watching_thread else config['SYNC_BASE_INTERVAL_MS']
+    maximum = config['SYNC_MAX_INTERVAL_MS']
+    idle_ms = _int(state.get('idle_ms'))
+    if state.get('hidden') or idle_ms >= config['SYNC_IDLE_AFTER_MS']:
+        return maximum
+    previous = max(_int(state.get('interval_ms'), base), base)
+    if changed or idle_ms < previous:
+        return base
+    return min(int(previous * config['SYNC_BACKOFF']), maximum)
+
+
+def _sync_thread(user_id, other_id, thread_state):
+    """1 つの会話について新着メッセージと既読位置の変化を返す（渡した受信分は既読にする）"""
+    after_id = _int(thread_state.get('after_id'))
+    read_up_to = _int(thread_state.get('read_up_to'))
+    result = {}
+
+    # 会話を開いている間に届いた分を 1 ページずつ渡し、渡した分だけ既読にする
+    new_messages = conversations.fetch_after(user_id, other_id, after_id)
+    if new_messages:
+        result['messages'] = [message_payload(m) for m in new_messages]
+
+    # 自分が送ったメッセージのうち既読になった最大の ID（既読は古い順に付くので位置で表せる）
+    latest_read = conversations.latest_read_id(user_id, other_id)
+    if latest_read != read_up_to:
+        result['read_up_to'] = latest_read
+    return result
+
+
+def build_response(user, state):
+    threads_state = state.get('threads') or {}
+    if not isinstance(threads_state, dict):
+        threads_state = {}
+    limit = current_app.config['SYNC_MAX_THREADS']
+    usernames = list(threads_state)[:limit]
+
+    user_id = user.id
+    response = {}
+    changed = False
+    threads = {}
+    if usernames:
+        others = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)).all())
+        for username in usernames:
+            other_id = others.get(username)
+            if other_id is None:
+                continue
+            thread_state = threads_state[username] if isinstance(threads_state[username], dict) else {}
+            result = _sync_thread(user_id, other_id, thread_state)
+            if result:
+                threads[username] = result
+                changed = True
+    if threads:
+        response['threads'] = threads
+
+    # 未読数は送信者ごとのカウンタ（app/unread.py）から読み、総数もそこから出す
+    rows = list(unread.by_sender(user_id).items())
+    unread_total = sum(count for _, count in rows)
+    if unread_total != _int(state.get('unread_total'), -1):
+        response['unread_total'] = unread_total
+        changed = True
+    if state.get('partners'):
+        names = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_([sender_id for sender_id, _ in rows])).all()) if rows else {}
+        response['partners'] = {names[sender_id]: count for sender_id, count in rows if sender_id in names}
+
+    response['next_poll_ms'] = suggest_interval(state, changed, bool(usernames))
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('SYNC_BASE_INTERVAL_MS', 5000)
+    app.config.setdefault('SYNC_THREAD_INTERVAL_MS', 1000)
+    app.config.setdefault('SYNC_MAX_INTERVAL_MS', 30000)
+    app.config.setdefault('SYNC_IDLE_AFTER_MS', 60000)
+    app.config.setdefault('SYNC_BACKOFF', 1.5)
+    app.config.setdefault('SYNC_MAX_THREADS', 5)
@@ -0,0 +1,177 @@
+"""未読メッセージ数のカウンタ（受信者ごとの総数と送信者ごとの内訳）
+
+ヘッダーのバッジ（``load_logged_in_user``）と ``/api/unread-count`` は毎リクエスト・数秒おきに
+未読数を読むので、``message`` を数える代わりに主キーで 1 行引くだけで済むようにする。
+
+- ``UnreadCounter`` / ``PartnerUnreadCounter`` はメッセージと同じ bind に置き、
+  メッセージを書き込むのと同じトランザクションで更新する
+- ORM での送信・削除・既読の変更は ``after_flush`` でこのモジュールが反映する
+- ORM を通らない一括 UPDATE は呼び出し側が ``apply`` を呼ぶ（既読化: app/conversations.py）。
+  アカウント削除で消すメッセージの分は ``forget_user`` が反映する。
+  Core での一括投入（インポート・ベンチマークのシード・split-messages）の後は ``rebuild`` で数え直す
+- ``flask check-unread-counters`` で ``message`` から数え直した値と比べ、``--fix`` で直す
+"""
+from collections import Counter
+
+import click
+from sqlalchemy import event, inspect
+
+from app import importer
+from models import db, Message, PartnerUnreadCounter, UnreadCounter
+
+
+def total(user_id):
+    """``user_id`` 宛ての未読数"""
+    return db.session.query(UnreadCounter.unread).filter(UnreadCounter.user_id == user_id).scalar() or 0
+
+
+def from_sender(user_id, sender_id):
+    """``sender_id`` から ``user_id`` への未読数"""
+    return db.session.query(PartnerUnreadCounter.unread).filter(
+        PartnerUnreadCounter.recipient_id == user_id, PartnerUnreadCounter.sender_id == sender_id
+    ).scalar() or 0
+
+
+def by_sender(user_id):
+    """``user_id`` 宛ての未読数を送信者ごとに返す（{sender_id: 件数}。0 件の送信者は含まない）"""
+    return dict(db.session.query(PartnerUnreadCounter.sender_id, PartnerUnreadCounter.unread).filter(
+        PartnerUnreadCounter.recipient_id == user_id, PartnerUnreadCounter.unread > 0).all())
+
+
+def _bump(executor, table, keys, delta):
+    condition = [table.c[name] == value for name, value in keys.items()]
+    updated = executor.execute(table.update().where(*condition).values(
+        unread=db.func.max(table.c.unread + delta, 0))).rowcount
+    if not updated and delta > 0:
+        executor.execute(table.insert().values(unread=delta, **keys))
+
+
+def apply(executor, deltas):
+    """{(受信者, 送信者): 増減} をカウンタに加える（コミットはしない）"""
+    totals = Counter()
+    for (recipient_id, sender_id), delta in deltas.items():
+        if not delta or recipient_id is None:
+            continue
+        _bump(executor, PartnerUnreadCounter.__table__,
+              {'recipient_id': recipient_id, 'sender_id': sender_id}, delta)
+        totals[recipient_id] += delta
+    for recipient_id, delta in totals.items():
+        if delta:
+            _bump(executor, UnreadCounter.__table__, {'user_id': recipient_id}, delta)
+
+
+def _was_read(message):
+    history = inspect(message).attrs.is_read.history
+    if history.deleted:
+        return bool(history.deleted[0])
+    return bool(message.is_read)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_flush(session, flush_context):
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Message) and obj.recipient_id is not None and not obj.is_read:
+            deltas[(obj.recipient_id, obj.sender_id)] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Message) and obj.recipient_id is not None and not _was_read(obj):
+            deltas[(obj.recipient_id, obj.sender_id)] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, Message) and obj.recipient_id is not None:
+            history = inspect(obj).attrs.is_read.history
+            if history.added and history.deleted and bool(history.added[0]) != bool(history.deleted[0]):
+                deltas[(obj.recipient_id, obj.sender_id)] += -1 if history.added[0] else 1
+    if deltas:
+        apply(session, deltas)
+
+
+def forget_user(session, user_id):
+    """アカウント削除時に、そのユーザーのカウンタを消す
+
+    そのユーザーが送った未読の分は相手の総数から減らす。メッセージは Core でまとめて消してよい
+    （ORM で消して flush 済みなら、その分は ``_track_flush`` が減らしてあるので二重には減らない）。
+    """
+    session.flush()
+    partner = PartnerUnreadCounter.__table__
+    counter = UnreadCounter.__table__
+    sent = (db.select(partner.c.unread)
+            .where(partner.c.recipient_id == counter.c.user_id, partner.c.sender_id == user_id).scalar_subquery())
+    session.execute(counter.update().where(
+        counter.c.user_id.in_(db.select(partner.c.recipient_id).where(partner.c.sender_id == user_id, partner.c.unread > 0))
+    ).values(unread=db.func.max(counter.c.unread - sent, 0)))
+    session.execute(counter.delete().where(counter.c.user_id == user_id))
+    session.execute(partner.delete().where((partner.c.recipient_id == user_id) | (partner.c.sender_id == user_id)))
+
+
+def _expected_query():
+    message = Message.__table__
+    return (db.select(message.c.recipient_id, message.c.sender_id, db.func.count())
+            .where(message.c.recipient_id.isnot(None), message.c.is_read.is_(False))
+            .group_by(message.c.recipient_id, message.c.sender_id))
+
+
+def rebuild(executor):
+    """``message`` から数え直してカウンタを作り直す（コミットはしない）"""
+    partner = PartnerUnreadCounter.__table__
+    counter = UnreadCounter.__table__
+    executor.execute(partner.delete())
+    executor.execute(counter.delete())
+    executor.execute(partner.insert().from_select(['recipient_id', 'sender_id', 'unread'], _expected_query()))
+    executor.execute(counter.insert().from_select(
+        ['user_id', 'unread'],
+        db.select(partner.c.recipient_id, db.func.sum(partner.c.unread)).group_by(partner.c.recipient_id)))
+
+
+def find_mismatches(executor):
+    """カウンタと ``message`` から数え直した値の違いを (種類, キー, カウンタの値, 正しい値) で返す"""
+    partner = PartnerUnreadCounter.__table__
+    counter = UnreadCounter.__table__
+    expected = {(r, s): n for r, s, n in executor.execute(_expected_query())}
+    stored = {(r, s): n for r, s, n in executor.execute(
+        db.select(partner.c.recipient_id, partner.c.sender_id, partner.c.unread))}
+    expected_totals = Counter()
+    for (recipient_id, _sender_id), n in expected.items():
+        expected_totals[recipient_id] += n
+    stored_totals = dict(executor.execute(db.select(counter.c.user_id, counter.c.unread)).all())
+
+    mismatches = []
+    for key in sorted(set(expected) | set(stored)):
+        if stored.get(key, 0) != expected.get(key, 0):
+            mismatches.append(('partner', key, stored.get(key, 0), expected.get(key, 0)))
+    for user_id in sorted(set(expected_totals) | set(stored_totals)):
+        if stored_totals.get(user_id, 0) != expected_totals.get(user_id, 0):
+            mismatches.append(('total', user_id, stored_totals.get(user_id, 0), expected_totals.get(user_id, 0)))
+    return mismatches
+
+
+@importer.finalizer
+def _rebuild_after_import():
+    # インポートはメッセージを Core で一括投入するのでカウンタを通らない
+    rebuild(db.session)
+
+
+@click.command('check-unread-counters')
+@click.option('--fix', is_flag=True, help='不一致があれば message から数え直す')
+def check_unread_counters_command(fix):
+    """未読数のカウンタを message から数え直した値と比べる"""
+    mismatches = find_mismatches(db.session)
+    for kind, key, stored, expected in mismatches[:50]:
+        click.echo(f'{kind} {key}: {stored} -> {expected}')
+    if len(mismatches) > 50:
+        click.echo(f'... ほか {len(mismatches) - 50} 件')
+    if not mismatches:
+        click.echo('不一致はありません')
+        return
+    if not fix:
+        raise click.ClickException(f'{len(mismatches)} 件の不一致があります（--fix で数え直します）')
+    try:
+        rebuild(db.session)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    click.echo(f'{len(mismatches)} 件の不一致を直しました')
+
+
+def init_app(app):
+    app.cli.add_command(check_unread_counters_command)
@@ -0,0 +1,179 @@
+"""アップロードファイルの配置（用途別ディレクトリ + ハッシュによる分散）
+
+1 つのディレクトリに何百万ものファイルを置くと、ファイルの検索・バックアップ・ls が極端に遅くなる。
+``UPLOAD_LAYOUT = 'sharded'``（既定）では、ファイル名先頭の UUID（なければファイル名の SHA-1）から
+``UPLOAD_SHARD_DEPTH`` 段のサブディレクトリを作って保存する::
+
+    uploads/posts/3f/a2/3fa2...c1_photo.jpg
+
+URL やテンプレートで使うパスは従来どおり ``<用途>/<ファイル名>`` のままで、実際の置き場所は
+``resolve`` が新旧どちらの配置からも探す。``flask migrate-uploads`` で既存のファイルを
+動かしている間も、移動前・移動後のどちらのファイルも読める。
+"""
+import hashlib
+import os
+import re
+import time
+
+import click
+from flask import current_app
+
+UPLOAD_TYPES = {
+    'avatars': 'ユーザープロフィール画像',
+    'community_icons': 'コミュニティアイコン',
+    'posts': '投稿画像・動画',
+    'replies': '返信画像・動画',
+}
+LAYOUTS = ('flat', 'sharded')
+
+# save_upload_file が付ける uuid4().hex の接頭辞
+_UUID_PREFIX_RE = re.compile(r'^([0-9a-f]{32})_')
+
+
+def shard_key(filename):
+    m = _UUID_PREFIX_RE.match(filename)
+    if m:
+        return m.group(1)
+    return hashlib.sha1(filename.encode('utf-8')).hexdigest()
+
+
+def shard_dirs(filename, depth=None):
+    if depth is None:
+        depth = current_app.config['UPLOAD_SHARD_DEPTH']
+    key = shard_key(filename)
+    return [key[i * 2:i * 2 + 2] for i in range(depth)]
+
+
+def type_dir(upload_type, root=None):
+    if upload_type not in UPLOAD_TYPES:
+        raise ValueError(f"Invalid upload type: {upload_type}")
+    return os.path.join(root or current_app.config['UPLOAD_FOLDER'], upload_type)
+
+
+def layout_path(filename, upload_type, layout, root=None, depth=None):
+    base = type_dir(upload_type, root)
+    if layout == 'flat':
+        return os.path.join(base, filename)
+    return os.path.join(base, *shard_dirs(filename, depth), filename)
+
+
+def resolve(filename, upload_type):
+    """ファイルの実際のパス。どの配置にもなければ現在の配置で保存する場合のパスを返す"""
+    layout = current_app.config['UPLOAD_LAYOUT']
+    preferred = layout_path(filename, upload_type, layout)
+    if os.path.isfile(preferred):
+        return preferred
+    other = layout_path(filename, upload_type, 'flat' if layout == 'sharded' else 'sharded')
+    if os.path.isfile(other):
+        return other
+    # 見つからない場合も、移行ツールが直前に移動させたのであれば preferred にある
+    return preferred
+
+
+def path_for_write(filename, upload_type):
+    path = resolve(filename, upload_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def remove(filename, upload_type):
+    """アップロードファイルを削除する（見つからなければ何もしない）"""
+    if not filename:
+        return
+    try:
+        os.remove(resolve(filename, upload_type))
+    except OSError:
+        pass
+
+
+def url_path(filename, upload_type):
+    """``uploaded_file`` に渡すパス（配置によらず ``<用途>/<ファイル名>``）"""
+    if not filename:
+        return ''
+    return f"{upload_type}/{filename}"
+
+
+def split_url_path(path):
+    """``<用途>/<ファイル名>`` を分解する。当てはまらなければ None"""
+    upload_type, _, filename = path.partition('/')
+    if upload_type not in UPLOAD_TYPES or not filename or '/' in filename:
+        return None
+    return upload_type, filename
+
+
+# -- 移行 ------------------------------------------------------------------------
+
+def iter_misplaced(root, upload_type, layout, depth):
+    """``layout`` の位置にないファイルを (現在のパス, 移動先) で返す"""
+    base = type_dir(upload_type, root)
+    if not os.path.isdir(base):
+        return
+    for dirpath, dirnames, filenames in os.walk(base):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith('.tmp'):
+                continue
+            src = os.path.join(dirpath, name)
+            dest = layout_path(name, upload_type, layout, root, depth)
+            if src != dest:
+                yield src, dest
+
+
+def _remove_empty_dirs(root, upload_type):
+    base = type_dir(upload_type, root)
+    for dirpath, dirnames, filenames in os.walk(base, topdown=False):
+        if dirpath != base and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def migrate(root, layout, depth, batch_size, pause, dry_run=False, log=None):
+    """既存ファイルを ``layout`` の配置へ ``batch_size`` 件ずつ移動する。移動した件数を返す"""
+    moved = 0
+    for upload_type in UPLOAD_TYPES:
+        batch = 0
+        for src, dest in iter_misplaced(root, upload_type, layout, depth):
+            if dry_run:
+                moved += 1
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.exists(dest):
+                # 移行中に新しい配置へ保存し直されたもの。新しい方を残す
+                os.remove(src)
+            else:
+                # 同じファイルシステム内の rename なので、読み手からは旧・新のどちらかに必ず見える
+                os.replace(src, dest)
+            moved += 1
+            batch += 1
+            if batch >= batch_size:
+                if log:
+                    log(f'{upload_type}: {moved} 件')
+                batch = 0
+                time.sleep(pause)
+        if not dry_run and layout == 'flat':
+            # 空になったシャードのディレクトリを片付ける
+            _remove_empty_dirs(root, upload_type)
+    return moved
+
+
+@click.command('migrate-uploads')
+@click.option('--to', 'layout', type=click.Choice(LAYOUTS), default=None, help='移行先の配置（既定: UPLOAD_LAYOUT）')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='一度に移動するファイル数')
+@click.option('--pause', type=float, default=0.1, show_default=True, help='バッチ間の待ち時間（秒）')
+@click.option('--dry-run', is_flag=True, help='移動せずに件数だけ数える')
+def migrate_uploads_command(layout, batch_size, pause, dry_run):
+    """アップロードファイルを指定の配置へ移動する（稼働中に実行してよい）"""
+    config = current_app.config
+    layout = layout or config['UPLOAD_LAYOUT']
+    if layout != config['UPLOAD_LAYOUT']:
+        click.echo(f"注意: UPLOAD_LAYOUT は {config['UPLOAD_LAYOUT']!r} です。移行後に設定も変更してください")
+    moved = migrate(config['UPLOAD_FOLDER'], layout, config['UPLOAD_SHARD_DEPTH'], batch_size, pause,
+                    dry_run=dry_run, log=click.echo)
+    click.echo(f"{moved} 件{'が対象です' if dry_run else 'を移動しました'}（配置: {layout}）")
+
+
+def init_app(app):
+    app.config.setdefault('UPLOAD_LAYOUT', 'sharded')
+    app.config.setdefault('UPLOAD_SHARD_DEPTH', 2)
+    if app.config['UPLOAD_LAYOUT'] not in LAYOUTS:
+        raise ValueError(f"UPLOAD_LAYOUT must be one of {LAYOUTS}")
+    app.cli.add_command(migrate_uploads_command)
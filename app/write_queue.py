@@ -0,0 +1,254 @@
+"""小さな書き込みのグループコミット（``WRITE_QUEUE_ENABLED``）
+
+SQLite の書き込みは 1 ファイルにつき同時に 1 つだけで、コミットのたびに fsync が走る。
+いいね・フォロー・既読・メッセージ送信のような小さな書き込みをリクエストごとにコミットすると、
+負荷時には処理時間の大半がロック待ちと fsync になり、``database is locked`` で失敗するものも出る。
+
+``WRITE_QUEUE_ENABLED = True`` のとき、``run(fn)`` で渡した書き込みはプロセスに 1 本の
+コーディネータースレッドが ``WRITE_QUEUE_WINDOW_MS`` の間（最大 ``WRITE_QUEUE_MAX_BATCH`` 件）まとめ、
+1 つのトランザクションで実行してコミットする。
+
+- ``fn(session)`` はセッションに書き込むだけでコミットしない。戻り値（ID など。ORM オブジェクトは返さない）が
+  呼び出し側の ``run`` の戻り値になる
+- バッチはまず全件をまとめて flush し、どれかが失敗（制約違反など）したら 1 件ずつ SAVEPOINT の中で
+  やり直す。失敗はその呼び出し側にだけ例外として返り、同じバッチの他の書き込みはコミットされる。
+  そのため ``fn`` は同じバッチの中で 2 回実行されることがある（セッションへの書き込み以外の副作用を持たない）
+- ``run`` はコミットが終わってから戻るので、戻った後の読み取りには書き込みが見えている
+- コミットがロック待ちで失敗したらバッチ全体を ``WRITE_QUEUE_RETRIES`` 回までやり直す
+
+コーディネーターは専用のエンジンで ``BEGIN IMMEDIATE`` から始め、最初に書き込みロックを取る
+（pysqlite の既定のトランザクション処理では SAVEPOINT が正しく動かないため）。
+無効なとき・ファイルの SQLite でないときは、``run`` はその場で実行してコミットする（結果は同じ）。
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from app import databases, metrics, server, sqlite_profile
+from models import db
+
+
+class _Item:
+    __slots__ = ('fn', 'future')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+
+
+def _is_locked(exc):
+    return 'database is locked' in str(exc) or 'database is busy' in str(exc)
+
+
+def _make_engine(app, write_engine):
+    engine = sqlite_profile.create_sibling_engine(app, write_engine.url, 1, 0)
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, connection_record):
+        # pysqlite に BEGIN を出させず、下の begin で自分で出す
+        dbapi_conn.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _on_begin(conn):
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+class WriteCoordinator:
+    """書き込みを集めて 1 トランザクションでコミットするスレッド"""
+
+    def __init__(self, app, window, max_batch, retries):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.retries = retries
+        self.pid = os.getpid()
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        with app.app_context():
+            self.engines = {engine: _make_engine(app, engine) for engine, _keys in databases.engine_groups(app)}
+        self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        item = _Item(fn)
+        self._queue.put(item)
+        return item.future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        for engine in self.engines.values():
+            engine.dispose()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = [item for item in batch if item.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with self.app.app_context():
+                try:
+                    self._execute(batch)
+                except BaseException as exc:  # 呼び出し側を待たせたままにしない
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(exc)
+                finally:
+                    db.session.remove()
+
+    def _apply_all(self, session, batch):
+        """SAVEPOINT なしで全件を実行して 1 回で flush する（同じ種類の INSERT は executemany になる）"""
+        results = [item.fn(session) for item in batch]
+        session.flush()
+        return [(result, None) for result in results]
+
+    def _apply_each(self, session, batch):
+        """1 件ずつ SAVEPOINT の中で実行し、失敗した書き込みだけを取り消す"""
+        outcomes = []
+        for item in batch:
+            try:
+                # SAVEPOINT を抜けるときに flush するので、制約違反はここで捕まる
+                with session.begin_nested():
+                    result = item.fn(session)
+            except OperationalError as exc:
+                if _is_locked(exc):
+                    raise  # BEGIN IMMEDIATE が取れなかった。バッチごとやり直す
+                outcomes.append((None, exc))
+            except Exception as exc:
+                outcomes.append((None, exc))
+            else:
+                outcomes.append((result, None))
+        return outcomes
+
+    def _apply(self, session, batch):
+        if len(batch) > 1:
+            try:
+                return self._apply_all(session, batch)
+            except OperationalError as exc:
+                if _is_locked(exc):
+                    raise
+                session.rollback()
+            except Exception:
+                # どれかが失敗した。やり直して失敗した書き込みを特定する
+                session.rollback()
+        return self._apply_each(session, batch)
+
+    def _execute(self, batch):
+        session = db.session()
+        # このセッションの書き込みは BEGIN IMMEDIATE を出す専用のエンジンで行う（models.RoutingSession）
+        session.info['engine_map'] = self.engines
+        for attempt in range(self.retries + 1):
+            try:
+                outcomes = self._apply(session, batch)
+                session.commit()
+            except OperationalError as exc:
+                session.rollback()
+                if _is_locked(exc) and attempt < self.retries:
+                    metrics.count_lock_retry()
+                    time.sleep(0.01 * (attempt + 1))
+                    continue
+                raise
+            break
+        self.batches += 1
+        self.writes += len(batch)
+        for item, (result, exc) in zip(batch, outcomes):
+            if exc is not None:
+                item.future.set_exception(exc)
+            else:
+                item.future.set_result(result)
+
+
+_lock = threading.Lock()
+
+
+def _coordinator():
+    app = current_app._get_current_object()
+    coordinator = app.extensions.get('write_queue')
+    if coordinator is None or coordinator.pid != os.getpid():
+        with _lock:
+            coordinator = app.extensions.get('write_queue')
+            # fork したワーカーにはスレッドが引き継がれないので作り直す
+            if coordinator is None or coordinator.pid != os.getpid():
+                config = app.config
+                coordinator = app.extensions['write_queue'] = WriteCoordinator(
+                    app, config['WRITE_QUEUE_WINDOW_MS'] / 1000.0, config['WRITE_QUEUE_MAX_BATCH'],
+                    config['WRITE_QUEUE_RETRIES'])
+    return coordinator
+
+
+def enabled(app):
+    return app.extensions.get('write_queue_enabled', False)
+
+
+def run(fn):
+    """``fn(session)`` を実行してコミットし、その戻り値を返す（失敗したら例外）"""
+    if enabled(current_app):
+        return _coordinator().submit(fn).result(timeout=current_app.config['WRITE_QUEUE_TIMEOUT'])
+    try:
+        result = fn(db.session)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
+
+
+def _stop_worker(app):
+    coordinator = app.extensions.pop('write_queue', None)
+    if coordinator is not None and coordinator.pid == os.getpid():
+        coordinator.close()
+
+
+def init_app(app):
+    app.config.setdefault('WRITE_QUEUE_ENABLED', False)
+    app.config.setdefault('WRITE_QUEUE_WINDOW_MS', 2)
+    app.config.setdefault('WRITE_QUEUE_MAX_BATCH', 64)
+    app.config.setdefault('WRITE_QUEUE_RETRIES', 5)
+    app.config.setdefault('WRITE_QUEUE_TIMEOUT', 10.0)
+    if not app.config['WRITE_QUEUE_ENABLED']:
+        return
+    with app.app_context():
+        file_backed = all(sqlite_profile.is_file_sqlite(engine.url) for engine, _keys in databases.engine_groups(app))
+    app.extensions['write_queue_enabled'] = file_backed
+    if not file_backed:
+        return
+    server.register_hook(app, 'worker_stop', _stop_worker)
+
+    registry = app.extensions.get('metrics')
+    if registry is not None:
+        def collect():
+            coordinator = app.extensions.get('write_queue')
+            if coordinator is None:
+                return []
+            return [('write_queue_batches_total', (), coordinator.batches),
+                    ('write_queue_writes_total', (), coordinator.writes)]
+        registry.collectors.append(collect)
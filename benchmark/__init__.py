@@ -0,0 +1,27 @@
+"""負荷試験・ベンチマーク用パッケージ
+
+- ``python -m benchmark.seed``   : 合成データを一括生成する
+- ``python -m benchmark.runner`` : 主要ルートを叩いてスループット・レイテンシ・クエリ数を計測する
+- ``python -m benchmark.budgets`` : 全ルートの SQL 文の数・読み込んだ行数がクエリ予算内か確かめる
+"""
+import os
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_DB = os.path.join(BENCH_DIR, 'data', 'bench.db')
+DEFAULT_UPLOADS = os.path.join(BENCH_DIR, 'data', 'uploads')
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, 'results')
+# シードで作るユーザーは全員このパスワード
+SEED_PASSWORD = 'benchpass'
+
+
+def bench_app(db_path=DEFAULT_DB, uploads=DEFAULT_UPLOADS, **config):
+    """ベンチマーク用 DB・アップロード先を向いたアプリを作る"""
+    from app import create_app
+
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.abspath(db_path)}',
+        'UPLOAD_FOLDER': os.path.abspath(uploads),
+    }
+    settings.update(config)
+    return create_app(settings)
@@ -0,0 +1,330 @@
+"""ルートごとのクエリ予算のチェック
+
+中規模の合成データを一時ディレクトリに生成し、``main`` ブループリントの全エンドポイントを
+ログインした状態で 1 回ずつ叩いて、``@query_budget``（app/query_budget.py）で宣言した上限
+（SQL 文の数・ORM が読み込んだ行数）を超えていないか確かめる。
+あわせて応答のステータスとリダイレクト先、書き込み系のルートは DB の結果（``AFTER_CHECKS``）も確かめ、
+途中で失敗して SQL 文が少なく済んだだけの応答を予算内と数えないようにする。
+超えたルート・結果が違うルートは実行された SQL を一覧で出し、終了コード 1 で終わる。予算のないルートも失敗にする。
+
+SQL 文の予算は件数によらない定数なので（app/query_budget.py の「予算の決め方」）、件数が 10 倍違う
+2 つのデータ（``SIZES``）で同じ予算を確かめる。N+1 は大きい方のデータで予算を超える。
+
+例::
+
+    python -m benchmark.budgets
+    python -m benchmark.budgets --only main.view_post --verbose
+    python -m benchmark.budgets --size base
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from urllib.parse import urlsplit
+
+from flask import url_for
+from werkzeug.exceptions import HTTPException
+
+from app import uploads
+from app.query_budget import Recorder, budget_for
+from benchmark import SEED_PASSWORD, bench_app, seed
+from benchmark.runner import pick_fixtures
+from models import (db, ArchivedMessage, Community, CommunityFollow, Message, Post, PostImage, PostLike,
+                    Reply, ReplyLike, User)
+
+# 中規模のデータ（ページング・N+1 が件数に表れる程度で、数十秒で生成できる大きさ）
+SEED_ARGS = [
+    '--communities', '20', '--follows-per-user', '5', '--replies-per-post', '3', '--likes-per-post', '5',
+    '--messages-per-thread', '20', '--no-image-files',
+]
+
+# ユーザー・投稿・会話の数だけを 10 倍にしたデータ。1 人・1 件あたりの量（フォロー・いいね・返信・
+# 会話の長さ）とコミュニティの数は同じなので、ページの行数は変わらず、SQL 文の数も変わらないはず
+SIZES = {
+    'base': ['--users', '300', '--posts', '3000', '--threads', '300'],
+    'x10': ['--users', '3000', '--posts', '30000', '--threads', '3000'],
+}
+
+# URL の変数名 -> 既定で使うフィクスチャ
+DEFAULT_ARGS = {
+    'community_id': '{community_id}',
+    'post_id': '{post_id}',
+    'reply_id': '{reply_id}',
+    'username': '{partner}',
+    'msg_id': '{own_message_id}',
+    'filename': '{image_path}',
+}
+
+MAX_STATEMENT_CHARS = 300
+
+
+def _exists(query):
+    return db.session.query(query.execution_options(include_deleted=True).exists()).scalar()
+
+
+def _account_left(fx):
+    """アカウント削除の後に残っている、計測したユーザーを参照する行のテーブル名"""
+    uid = fx['user_id']
+    columns = (User.id, Post.user_id, Reply.user_id, PostLike.user_id, ReplyLike.user_id, CommunityFollow.user_id,
+               Message.sender_id, Message.recipient_id, ArchivedMessage.sender_id, ArchivedMessage.recipient_id)
+    return sorted({c.class_.__tablename__ for c in columns if _exists(db.session.query(c).filter(c == uid))})
+
+
+# (エンドポイント, メソッド) -> (失敗したときの説明, 成功していれば True を返す関数)
+# 削除系は墓標（app/deletion.py）で隠れていれば消えたものとみなす
+AFTER_CHECKS = {
+    ('main.create_community', 'POST'): (
+        'コミュニティが作成されていません', lambda fx: Community.query.filter_by(name='予算チェック').first() is not None),
+    ('main.follow_community', 'POST'): (
+        'フォローが作成されていません', lambda fx: CommunityFollow.query.filter_by(
+            user_id=fx['user_id'], community_id=fx['other_community_id']).first() is not None),
+    ('main.unfollow_community', 'POST'): (
+        'フォローが削除されていません', lambda fx: CommunityFollow.query.filter_by(
+            user_id=fx['user_id'], community_id=fx['other_community_id']).first() is None),
+    ('main.delete_community', 'POST'): (
+        'コミュニティが削除されていません', lambda fx: Community.query.filter_by(id=fx['own_community_id']).first() is None),
+    ('main.create_post', 'POST'): (
+        '投稿が作成されていません', lambda fx: Post.query.filter_by(
+            user_id=fx['user_id'], body='query budget', community_id=fx['followed_community_id']).first() is not None),
+    ('main.reply_post', 'POST'): (
+        '返信が作成されていません', lambda fx: Reply.query.filter_by(
+            user_id=fx['user_id'], body='query budget', post_id=fx['post_id']).first() is not None),
+    ('main.delete_post', 'POST'): (
+        '投稿が削除されていません', lambda fx: Post.query.filter_by(id=fx['own_post_id']).first() is None),
+    ('main.register', 'POST'): (
+        'ユーザーが登録されていません', lambda fx: User.query.filter_by(username='budget_user').first() is not None),
+    ('main.settings', 'POST'): (
+        '設定が更新されていません', lambda fx: db.session.get(User, fx['user_id']).display_name == 'query budget'),
+    ('main.delete_account', 'POST'): (
+        'アカウントの行が残っています', lambda fx: not _account_left(fx)),
+    ('main.messages_with', 'POST'): (
+        'メッセージが送信されていません', lambda fx: Message.query.filter_by(
+            sender_id=fx['user_id'], body='query budget thread').first() is not None),
+    ('main.messages', 'POST'): (
+        'メッセージが送信されていません', lambda fx: Message.query.filter_by(
+            sender_id=fx['user_id'], body='query budget').first() is not None),
+    ('main.delete_message', 'POST'): (
+        'メッセージが削除されていません', lambda fx: db.session.get(Message, fx['own_message_id']) is None
+        and db.session.get(ArchivedMessage, fx['own_message_id']) is None),
+}
+
+
+def build_fixtures(app):
+    """pick_fixtures の値に、書き込み系のルートが使う ID を足す
+
+    削除系のルートが成功を確かめられるよう、計測するユーザーが設立したコミュニティ、
+    他人の投稿・返信へのいいね、画像ファイルがなければここで作る。
+    """
+    fx = pick_fixtures(app)
+    with app.app_context():
+        viewer = User.query.filter_by(username=fx['username']).one()
+        reply = Reply.query.filter_by(post_id=fx['post_id']).first() or Reply.query.first()
+        own_post = (db.session.query(Post.id).filter(Post.user_id == viewer.id)
+                    .order_by(Post.id.desc()).limit(1).scalar())
+        own_community = (db.session.query(Community.id).filter(Community.created_by == viewer.id)
+                         .order_by(Community.id.asc()).limit(1).scalar())
+        if own_community is None:
+            community = Community(name='予算チェック（削除用）', created_by=viewer.id)
+            db.session.add(community)
+            db.session.flush()
+            db.session.add(CommunityFollow(user_id=viewer.id, community_id=community.id))
+            own_community = community.id
+        followed = set(db.session.scalars(db.select(CommunityFollow.community_id).where(
+            CommunityFollow.user_id == viewer.id)))
+        followed_community = min(followed - {own_community}, default=own_community)
+        other_community = (db.session.query(Community.id)
+                           .filter(Community.id.notin_(followed),
+                                   (Community.created_by.is_(None)) | (Community.created_by != viewer.id))
+                           .order_by(Community.id.asc()).limit(1).scalar())
+        # アカウント削除で他人の投稿・返信へのいいねも消えることを確かめる
+        if not _exists(PostLike.query.join(Post, Post.id == PostLike.post_id).filter(
+                PostLike.user_id == viewer.id, Post.user_id != viewer.id)):
+            post = Post.query.filter(Post.user_id != viewer.id).order_by(Post.id.asc()).first()
+            db.session.add(PostLike(user_id=viewer.id, post_id=post.id))
+        if not _exists(ReplyLike.query.join(Reply, Reply.id == ReplyLike.reply_id).filter(
+                ReplyLike.user_id == viewer.id, Reply.user_id != viewer.id)):
+            other_reply = Reply.query.filter(Reply.user_id != viewer.id).order_by(Reply.id.asc()).first()
+            db.session.add(ReplyLike(user_id=viewer.id, reply_id=other_reply.id))
+        own_message = (db.session.query(Message.id).filter(Message.sender_id == viewer.id)
+                       .order_by(Message.id.desc()).limit(1).scalar())
+        image = PostImage.query.order_by(PostImage.id.desc()).first()
+        if image:
+            # シードは --no-image-files で作るので、uploaded_file が返すファイルだけ置く
+            with open(uploads.path_for_write(image.filename, 'posts'), 'wb') as f:
+                f.write(b'budget')
+        db.session.commit()
+        fx.update({
+            'user_id': viewer.id,
+            'password': SEED_PASSWORD,
+            'reply_id': reply.id if reply else 0,
+            'own_post_id': own_post or fx['post_id'],
+            'own_community_id': own_community,
+            'followed_community_id': followed_community,
+            'other_community_id': other_community or fx['community_id'],
+            'own_message_id': own_message or 0,
+            'image_path': uploads.url_path(image.filename, 'posts') if image else 'posts/missing.jpg',
+        })
+    return fx
+
+
+def _fill(values, fx):
+    return {k: v.format(**fx) if isinstance(v, str) else v for k, v in values.items()}
+
+
+def plan(app, fx, only=None):
+    """(エンドポイント, メソッド, URL, フォーム, 予算) を計測する順に返す"""
+    checks = []
+    with app.test_request_context():
+        for index, rule in enumerate(app.url_map.iter_rules()):
+            if not rule.endpoint.startswith('main.') or (only and rule.endpoint not in only):
+                continue
+            view = app.view_functions[rule.endpoint]
+            if getattr(view, 'query_budget_exempt', False):
+                continue
+            for method in ('GET', 'POST'):
+                if method not in rule.methods:
+                    continue
+                budget = budget_for(view, method)
+                args = _fill({name: DEFAULT_ARGS.get(name, '') for name in rule.arguments}, fx)
+                params = {}
+                order = 0
+                if budget is not None:
+                    args.update(_fill(budget.args, fx))
+                    params = _fill(budget.params, fx)
+                    order = budget.order
+                query = params if method == 'GET' else {}
+                url = url_for(rule.endpoint, **args, **query)
+                form = params if method == 'POST' else None
+                checks.append((order, index, rule.endpoint, method, url, form, budget))
+    checks.sort(key=lambda c: (c[0], c[1]))
+    return [c[2:] for c in checks]
+
+
+def _redirect_endpoint(app, location):
+    try:
+        endpoint, _args = app.url_map.bind('localhost').match(urlsplit(location).path, method='GET')
+    except HTTPException:
+        return None
+    return endpoint
+
+
+def check_outcome(app, fx, endpoint, method, resp, budget):
+    """応答のステータス・リダイレクト先と DB の結果を確かめ、違っていた点を返す"""
+    problems = []
+    if resp.status_code != budget.status:
+        problems.append(f'ステータス {resp.status_code} != {budget.status}')
+    if budget.redirect and resp.status_code in (301, 302, 303, 307, 308):
+        target = _redirect_endpoint(app, resp.location)
+        if target != budget.redirect:
+            problems.append(f'リダイレクト先 {target or resp.location} != {budget.redirect}')
+    after = AFTER_CHECKS.get((endpoint, method))
+    if after is not None:
+        message, ok = after
+        with app.app_context():
+            if not ok(fx):
+                problems.append(message)
+    return problems
+
+
+def _ensure_login(client, fx):
+    # ログアウト・登録（新しいユーザーでログインする）の後は計測するユーザーでログインし直す
+    with client.session_transaction() as sess:
+        if sess.get('user_id') == fx['user_id']:
+            return
+    client.post('/login', data={'username': fx['username'], 'password': fx['password']})
+
+
+def summarize_statements(statements):
+    """同じ SQL をまとめて (回数, SQL, 最初のパラメータ) を出現順に返す"""
+    seen = {}
+    for statement, parameters in statements:
+        if statement in seen:
+            seen[statement][0] += 1
+        else:
+            seen[statement] = [1, parameters]
+    return [(count, statement, parameters) for statement, (count, parameters) in seen.items()]
+
+
+def print_statements(statements):
+    for count, statement, parameters in summarize_statements(statements):
+        text = ' '.join(statement.split())
+        if len(text) > MAX_STATEMENT_CHARS:
+            text = text[:MAX_STATEMENT_CHARS] + '...'
+        prefix = f'x{count}' if count > 1 else '  '
+        print(f'      {prefix:>5} {text}')
+        if parameters:
+            print(f'            params: {str(parameters)[:120]}')
+
+
+def check(app, fx, only=None, verbose=False):
+    """全エンドポイントを叩いて予算を確かめ、失敗した数を返す"""
+    client = app.test_client()
+    failures = 0
+    print(f"{'endpoint':<36}{'method':<8}{'status':>7}{'queries':>12}{'rows':>14}")
+    with Recorder(app) as recorder:
+        for endpoint, method, url, form, budget in plan(app, fx, only):
+            _ensure_login(client, fx)
+            recorder.reset()
+            resp = client.open(url, method=method, data=form)
+            resp.get_data()
+            statements = list(recorder.statements)
+            rows = recorder.rows
+
+            problems = []
+            if budget is None:
+                problems.append('予算が宣言されていません')
+            else:
+                if len(statements) > budget.statements:
+                    problems.append(f'SQL 文 {len(statements)} > {budget.statements}')
+                if rows > budget.rows:
+                    problems.append(f'行数 {rows} > {budget.rows}')
+                problems.extend(check_outcome(app, fx, endpoint, method, resp, budget))
+            limit_q = budget.statements if budget else '-'
+            limit_r = budget.rows if budget else '-'
+            mark = 'NG' if problems else 'ok'
+            print(f'{endpoint:<36}{method:<8}{resp.status_code:>7}'
+                  f'{f"{len(statements)}/{limit_q}":>12}{f"{rows}/{limit_r}":>14}  {mark}')
+            if problems:
+                failures += 1
+                print(f"    {url}: {', '.join(problems)}")
+            if problems or verbose:
+                print_statements(statements)
+    return failures
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='ルートごとのクエリ予算をチェックします')
+    p.add_argument('--only', action='append', help='チェックするエンドポイント（例: main.view_post。複数指定可）')
+    p.add_argument('--verbose', '-v', action='store_true', help='予算内のルートも SQL を表示する')
+    p.add_argument('--seed', default='42', help='データ生成の乱数シード')
+    p.add_argument('--size', action='append', choices=sorted(SIZES), help='チェックするデータの大きさ（既定はすべて）')
+    return p
+
+
+def check_size(size, args):
+    """1 つの大きさのデータを生成して全エンドポイントをチェックし、失敗した数を返す"""
+    print(f'\n== {size}: {" ".join(SIZES[size])}')
+    workdir = tempfile.mkdtemp(prefix='query-budgets-')
+    try:
+        db_path = os.path.join(workdir, 'budgets.db')
+        app = bench_app(db_path, os.path.join(workdir, 'uploads'), EXPORT_FOLDER=os.path.join(workdir, 'exports'))
+        with app.app_context():
+            seed.Seeder(seed.build_parser().parse_args(SEED_ARGS + SIZES[size] + ['--seed', args.seed])).run()
+        fx = build_fixtures(app)
+        return check(app, fx, set(args.only) if args.only else None, args.verbose)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    failures = {size: check_size(size, args) for size in (args.size or SIZES)}
+    if any(failures.values()):
+        summary = '、'.join(f'{size}: {n} 件' for size, n in failures.items() if n)
+        print(f'\n予算を超えたか、期待した結果にならなかったルートがあります（{summary}）')
+        sys.exit(1)
+    print('\nすべてのルートが予算内です')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""主要ルートのベンチマーク
+
+Flask のテストクライアント（既定）またはローカルサーバー（``--url``）に対して
+各ルートを繰り返し叩き、スループット・レイテンシのパーセンタイル・
+1 リクエストあたりの SQL 数（テストクライアント時のみ）を JSON に保存する。
+
+例::
+
+    python -m benchmark.runner --iterations 200
+    python -m benchmark.runner --compare benchmark/results/20260101-120000.json
+"""
+import argparse
+import json
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from sqlalchemy import event
+
+from app import databases
+from benchmark import DEFAULT_DB, DEFAULT_RESULTS, DEFAULT_UPLOADS, SEED_PASSWORD, bench_app
+from models import db, User, Community, Post, Message
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[idx]
+
+
+class QueryCounter:
+    def __init__(self, engines):
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+class TestClientTarget:
+    """アプリをプロセス内で動かしてテストクライアントで叩く"""
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+        self.queries = QueryCounter([engine for _label, engine in databases.labeled_engines(app)])
+
+    def login(self, username, password):
+        self.client.post('/login', data={'username': username, 'password': password})
+
+    def get(self, path):
+        before = self.queries.count
+        resp = self.client.get(path)
+        resp.get_data()
+        return resp.status_code, self.queries.count - before
+
+
+class HttpTarget:
+    """起動済みのローカルサーバーを urllib で叩く（SQL 数は計測しない）"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def login(self, username, password):
+        data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+        self.opener.open(self.base_url + '/login', data=data).read()
+
+    def get(self, path):
+        try:
+            with self.opener.open(self.base_url + path) as resp:
+                resp.read()
+                return resp.status, None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+
+def pick_fixtures(app):
+    """計測に使うユーザー・コミュニティ・投稿・会話相手を DB から選ぶ"""
+    with app.app_context():
+        viewer_id = (db.session.query(Message.recipient_id)
+                     .filter(Message.recipient_id.isnot(None))
+                     .group_by(Message.recipient_id)
+                     .order_by(db.func.count().desc()).limit(1).scalar())
+        viewer = db.session.get(User, viewer_id) if viewer_id else User.query.first()
+        if viewer is None:
+            raise SystemExit('データがありません。先に python -m benchmark.seed を実行してください')
+        partner_id = (db.session.query(Message.sender_id)
+                      .filter(Message.recipient_id == viewer.id)
+                      .group_by(Message.sender_id)
+                      .order_by(db.func.count().desc()).limit(1).scalar())
+        partner = db.session.get(User, partner_id) if partner_id else None
+        community_id = (db.session.query(Post.community_id)
+                        .group_by(Post.community_id)
+                        .order_by(db.func.count().desc()).limit(1).scalar())
+        post_id = db.session.query(db.func.max(Post.id)).scalar()
+        return {
+            'username': viewer.username,
+            'partner': partner.username if partner else None,
+            'community_id': community_id or (Community.query.first().id if Community.query.first() else None),
+            'post_id': post_id,
+        }
+
+
+def build_routes(fx):
+    routes = [
+        ('index_home', '/'),
+        ('index_latest', '/?tab=latest'),
+        ('index_latest_likes', '/?tab=latest&sort=likes'),
+        ('search', '/search?body=%E7%8C%AB'),
+        ('search_user', '/search?username=user1'),
+        ('messages', '/messages'),
+        ('api_unread_count', '/api/unread-count'),
+    ]
+    if fx['community_id']:
+        routes.append(('community', f"/communities/{fx['community_id']}"))
+    if fx['post_id']:
+        routes.append(('post', f"/post/{fx['post_id']}"))
+        routes.append(('api_post_images', f"/api/post/{fx['post_id']}/images"))
+    if fx['partner']:
+        routes.append(('messages_thread', f"/messages?username={fx['partner']}"))
+        routes.append(('api_messages', f"/api/messages/{fx['partner']}"))
+        routes.append(('api_partner_unread', f"/api/partner-unread-count/{fx['partner']}"))
+    return routes
+
+
+def measure(target, path, iterations, warmup):
+    for _ in range(warmup):
+        target.get(path)
+    latencies = []
+    queries = []
+    statuses = {}
+    t_start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        status, nq = target.get(path)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+        if nq is not None:
+            queries.append(nq)
+    elapsed = time.perf_counter() - t_start
+    latencies.sort()
+    return {
+        'path': path,
+        'iterations': iterations,
+        'throughput_rps': round(iterations / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p90': round(percentile(latencies, 90), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+        },
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'statuses': {str(k): v for k, v in statuses.items()},
+    }
+
+
+def compare(current, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n比較対象: {baseline_path}")
+    print(f"{'route':<22}{'p50 ms':>18}{'p95 ms':>18}{'queries':>16}")
+    for name, r in current['routes'].items():
+        b = baseline['routes'].get(name)
+        if not b:
+            continue
+
+        def fmt(new, old):
+            if new is None or old is None:
+                return '-'
+            delta = (new - old) / old * 100 if old else 0.0
+            return f'{new:.1f} ({delta:+.0f}%)'
+        print(f"{name:<22}{fmt(r['latency_ms']['p50'], b['latency_ms']['p50']):>18}"
+              f"{fmt(r['latency_ms']['p95'], b['latency_ms']['p95']):>18}"
+              f"{fmt(r['queries_per_request'], b['queries_per_request']):>16}")
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='主要ルートのベンチマークを実行します')
+    p.add_argument('--db', default=DEFAULT_DB)
+    p.add_argument('--uploads', default=DEFAULT_UPLOADS)
+    p.add_argument('--url', help='指定するとテストクライアントではなくこのサーバーを叩く')
+    p.add_argument('--iterations', type=int, default=100)
+    p.add_argument('--warmup', type=int, default=5)
+    p.add_argument('--only', action='append', help='計測するルート名（複数指定可）')
+    p.add_argument('--label', default='', help='結果に残すラベル')
+    p.add_argument('--output', help='結果 JSON の出力先（既定: benchmark/results/<日時>.json）')
+    p.add_argument('--compare', help='比較する過去の結果 JSON')
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    app = bench_app(args.db, args.uploads)
+    fx = pick_fixtures(app)
+    target = HttpTarget(args.url) if args.url else TestClientTarget(app)
+    target.login(fx['username'], SEED_PASSWORD)
+
+    results = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'target': args.url or 'test_client',
+        'fixtures': fx,
+        'routes': {},
+    }
+    print(f"{'route':<22}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'queries':>10}")
+    for name, path in build_routes(fx):
+        if args.only and name not in args.only:
+            continue
+        r = measure(target, path, args.iterations, args.warmup)
+        results['routes'][name] = r
+        lat = r['latency_ms']
+        q = r['queries_per_request']
+        print(f"{name:<22}{r['throughput_rps']:>10.1f}{lat['p50']:>10.2f}{lat['p95']:>10.2f}"
+              f"{lat['p99']:>10.2f}{q if q is not None else '-':>10}")
+
+    output = args.output or os.path.join(DEFAULT_RESULTS, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'\n結果を保存しました: {output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
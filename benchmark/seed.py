@@ -0,0 +1,291 @@
+"""合成データ生成
+
+ユーザー・コミュニティ・フォロー・投稿・画像（スタブファイル）・深くネストした返信・
+いいね・メッセージスレッドを、Core の executemany でバッチ挿入する。
+ID はこちらで採番するため、挿入後に読み戻す必要がない。
+
+例::
+
+    python -m benchmark.seed --users 10000 --posts 200000 --replies-per-post 5
+"""
+import argparse
+import os
+import random
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from app import unread
+from benchmark import DEFAULT_DB, DEFAULT_UPLOADS, SEED_PASSWORD, bench_app
+from models import (db, User, Community, CommunityFollow, Post, PostImage, PostLike,
+                    Reply, ReplyImage, ReplyLike, Message)
+
+# 1x1 の透過 PNG
+STUB_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082'
+)
+WORDS = ['ごはん', '猫', '犬', '散歩', '旅行', 'カフェ', 'ラーメン', '写真', '週末', '天気',
+         'coffee', 'trip', 'photo', 'lunch', 'music', 'game', 'book', 'movie', 'sunset', 'garden']
+
+
+class Seeder:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.now = datetime.utcnow()
+        self.counts = {}
+        self.stub_path = None
+
+    # -- helpers -----------------------------------------------------------
+
+    def next_id(self, model):
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    def insert(self, model, rows):
+        """rows（ジェネレータ可）を batch_size ごとに executemany で挿入"""
+        table = model.__table__
+        batch = []
+        total = 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.args.batch_size:
+                db.session.execute(table.insert(), batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(table.insert(), batch)
+            total += len(batch)
+        db.session.commit()
+        self.counts[table.name] = self.counts.get(table.name, 0) + total
+        return total
+
+    def random_time(self):
+        return self.now - timedelta(seconds=self.rng.randint(0, self.args.days * 86400))
+
+    def text(self, lo=3, hi=20):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(lo, hi)))
+
+    def stub_file(self, upload_type):
+        """アップロード先にスタブ画像を置く（可能ならハードリンクで高速化）"""
+        name = f'{uuid.uuid4().hex}_bench.png'
+        if not self.args.image_files:
+            return name
+        directory = os.path.join(self.args.uploads, upload_type)
+        os.makedirs(directory, exist_ok=True)
+        if self.stub_path is None:
+            self.stub_path = os.path.join(self.args.uploads, 'bench_stub.png')
+            with open(self.stub_path, 'wb') as f:
+                f.write(STUB_PNG)
+        dest = os.path.join(directory, name)
+        try:
+            os.link(self.stub_path, dest)
+        except OSError:
+            shutil.copyfile(self.stub_path, dest)
+        return name
+
+    # -- generators ----------------------------------------------------------
+
+    def seed_users(self):
+        a = self.args
+        start = self.next_id(User)
+        # ハッシュ計算は重いので全員で共有する
+        password_hash = generate_password_hash(SEED_PASSWORD)
+        self.user_ids = list(range(start, start + a.users))
+        self.insert(User, ({
+            'id': uid,
+            'username': f'{a.prefix}user{uid}',
+            'password_hash': password_hash,
+            'display_name': f'ベンチ{uid}',
+            'bio': self.text(2, 8),
+        } for uid in self.user_ids))
+
+    def seed_communities(self):
+        a = self.args
+        start = self.next_id(Community)
+        self.community_ids = list(range(start, start + a.communities))
+        self.insert(Community, ({
+            'id': cid,
+            'name': f'{a.prefix}community{cid}',
+            'description': self.text(2, 6),
+            'created_by': self.rng.choice(self.user_ids),
+            'created_at': self.random_time(),
+        } for cid in self.community_ids))
+
+    def seed_follows(self):
+        per_user = min(self.args.follows_per_user, len(self.community_ids))
+
+        def rows():
+            for uid in self.user_ids:
+                for cid in self.rng.sample(self.community_ids, per_user):
+                    yield {'user_id': uid, 'community_id': cid, 'created_at': self.random_time()}
+        self.insert(CommunityFollow, rows())
+
+    def seed_posts(self):
+        a = self.args
+        start = self.next_id(Post)
+        self.post_ids = list(range(start, start + a.posts))
+        self.insert(Post, ({
+            'id': pid,
+            'body': self.text(),
+            'created_at': self.random_time(),
+            'user_id': self.rng.choice(self.user_ids),
+            'community_id': self.rng.choice(self.community_ids),
+        } for pid in self.post_ids))
+
+        def images():
+            for pid in self.post_ids:
+                if self.rng.random() < a.image_ratio:
+                    for order in range(self.rng.randint(1, 4)):
+                        yield {'post_id': pid, 'filename': self.stub_file('posts'), 'order': order}
+        self.insert(PostImage, images())
+
+    def seed_replies(self):
+        a = self.args
+        next_id = self.next_id(Reply)
+        reply_ids = []
+
+        def rows():
+            nonlocal next_id
+            for pid in self.post_ids:
+                n = self.rng.randint(0, a.replies_per_post * 2)
+                # (reply_id, depth) のリストから親を選び、深いネストを作る
+                chain = []
+                for _ in range(n):
+                    parent_id = None
+                    depth = 0
+                    if chain and self.rng.random() < a.nest_ratio:
+                        parent_id, parent_depth = chain[-1] if self.rng.random() < 0.7 else self.rng.choice(chain)
+                        if parent_depth + 1 <= a.max_depth:
+                            depth = parent_depth + 1
+                        else:
+                            parent_id, depth = None, 0
+                    rid = next_id
+                    next_id += 1
+                    chain.append((rid, depth))
+                    reply_ids.append(rid)
+                    yield {
+                        'id': rid,
+                        'post_id': pid,
+                        'parent_id': parent_id,
+                        'user_id': self.rng.choice(self.user_ids),
+                        'body': self.text(1, 10),
+                        'created_at': self.random_time(),
+                    }
+        self.insert(Reply, rows())
+        self.reply_ids = reply_ids
+
+        def images():
+            for rid in self.reply_ids:
+                if self.rng.random() < a.image_ratio / 4:
+                    yield {'reply_id': rid, 'filename': self.stub_file('replies'), 'order': 0}
+        self.insert(ReplyImage, images())
+
+    def _like_rows(self, target_ids, key, per_target):
+        users = self.user_ids
+        for tid in target_ids:
+            n = min(len(users), self.rng.randint(0, per_target * 2))
+            for uid in self.rng.sample(users, n):
+                yield {'user_id': uid, key: tid, 'created_at': self.random_time()}
+
+    def seed_likes(self):
+        a = self.args
+        self.insert(PostLike, self._like_rows(self.post_ids, 'post_id', a.likes_per_post))
+        self.insert(ReplyLike, self._like_rows(self.reply_ids, 'reply_id', a.likes_per_reply))
+
+    def seed_messages(self):
+        a = self.args
+        if len(self.user_ids) < 2:
+            return
+
+        def rows():
+            for _ in range(a.threads):
+                u1, u2 = self.rng.sample(self.user_ids, 2)
+                t = self.random_time()
+                for i in range(self.rng.randint(1, a.messages_per_thread * 2)):
+                    sender, recipient = (u1, u2) if self.rng.random() < 0.5 else (u2, u1)
+                    t += timedelta(seconds=self.rng.randint(5, 3600))
+                    is_read = self.rng.random() < a.read_ratio
+                    yield {
+                        'body': self.text(1, 12),
+                        'created_at': t,
+                        'sender_id': sender,
+                        'recipient_id': recipient,
+                        'is_read': is_read,
+                        'read_at': t if is_read else None,
+                    }
+        self.insert(Message, rows())
+        # Core で投入したのでカウンタを通っていない
+        unread.rebuild(db.session)
+        db.session.commit()
+
+    def run(self):
+        # 生成中は耐久性より速度を優先する
+        db.session.execute(db.text('PRAGMA synchronous=OFF'))
+        steps = [
+            ('users', self.seed_users),
+            ('communities', self.seed_communities),
+            ('follows', self.seed_follows),
+            ('posts', self.seed_posts),
+            ('replies', self.seed_replies),
+            ('likes', self.seed_likes),
+            ('messages', self.seed_messages),
+        ]
+        for name, step in steps:
+            t0 = time.perf_counter()
+            step()
+            print(f'{name:<12} {time.perf_counter() - t0:8.2f}s')
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        return self.counts
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='ベンチマーク用の合成データを生成します')
+    p.add_argument('--db', default=DEFAULT_DB, help='SQLite ファイル')
+    p.add_argument('--uploads', default=DEFAULT_UPLOADS, help='アップロード先ディレクトリ')
+    p.add_argument('--reset', action='store_true', help='既存の DB とアップロードを削除してから生成')
+    p.add_argument('--seed', type=int, default=42, help='乱数シード（再現性のため）')
+    p.add_argument('--prefix', default='', help='ユーザー名・コミュニティ名の接頭辞（追加生成用）')
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--communities', type=int, default=50)
+    p.add_argument('--follows-per-user', type=int, default=5)
+    p.add_argument('--posts', type=int, default=20000)
+    p.add_argument('--image-ratio', type=float, default=0.3, help='画像付き投稿の割合')
+    p.add_argument('--no-image-files', dest='image_files', action='store_false', help='スタブファイルを作らない')
+    p.add_argument('--replies-per-post', type=int, default=3, help='投稿あたりの平均返信数')
+    p.add_argument('--nest-ratio', type=float, default=0.6, help='返信が別の返信へのリプライになる確率')
+    p.add_argument('--max-depth', type=int, default=12)
+    p.add_argument('--likes-per-post', type=int, default=5)
+    p.add_argument('--likes-per-reply', type=int, default=1)
+    p.add_argument('--threads', type=int, default=2000, help='メッセージスレッド数')
+    p.add_argument('--messages-per-thread', type=int, default=20)
+    p.add_argument('--read-ratio', type=float, default=0.8)
+    p.add_argument('--days', type=int, default=365, help='作成日時を散らす期間')
+    p.add_argument('--batch-size', type=int, default=5000)
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.reset:
+        for path in (args.db, args.db + '-wal', args.db + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(args.uploads, ignore_errors=True)
+    app = bench_app(args.db, args.uploads)
+    t0 = time.perf_counter()
+    with app.app_context():
+        counts = Seeder(args).run()
+    elapsed = time.perf_counter() - t0
+    total = sum(counts.values())
+    for table, n in counts.items():
+        print(f'{table:<18} {n:>10,}')
+    print(f'{total:,} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
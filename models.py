@@ -1,10 +1,50 @@
 from datetime import datetime
+from flask import current_app, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Models for Users, Posts, Messages and Images
 
-db = SQLAlchemy()
+
+class RoutingSession(Session):
+    """GET/HEAD リクエスト中の読み取りを読み取り専用エンジンへ振り分けるセッション
+
+    読み取り専用エンジンは app/sqlite_profile.py が本番プロファイル時に書き込み用エンジンごとに用意する。
+    同じトランザクション内で一度でも書き込んだら、コミットまで書き込み側を使う。
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if clause is not None and getattr(clause, 'is_dml', False):
+            self.info['has_writes'] = True
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        engine_map = self.info.get('engine_map')
+        if engine_map:
+            # グループコミットのセッション（app/write_queue.py）は専用のエンジンで書き込む
+            return engine_map.get(engine, engine)
+        if (bind is None and not self._flushing and not self.info.get('has_writes')
+                and has_request_context() and request.method in ('GET', 'HEAD')):
+            # bind（既定の DB・メッセージ用の DB）ごとに対応する読み取り専用エンジンを使う
+            read_engine = current_app.extensions.get('sqlite_read_engines', {}).get(engine)
+            if read_engine is not None:
+                return read_engine
+        return engine
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+@event.listens_for(db.session, 'after_flush')
+def _mark_writes(session, flush_context):
+    session.info['has_writes'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _clear_writes(session):
+    session.info.pop('has_writes', None)
 
 
 class Community(db.Model):
@@ -14,14 +54,28 @@ class Community(db.Model):
     icon_filename = db.Column(db.String(255), nullable=True)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 削除の墓標。付いたものとその投稿は表示から消え、app/deletion.py の後片付けで行が削除される
+    deleted_at = db.Column(db.DateTime, nullable=True)
 
     posts = db.relationship('Post', backref='community', lazy=True, cascade='all, delete-orphan')
     follows = db.relationship('CommunityFollow', backref='community', lazy=True, cascade='all, delete-orphan')
 
 
+def normalize_username(username):
+    """大文字・小文字を区別しない比較・前方一致検索に使うキー"""
+    return (username or '').strip().casefold()
+
+
+def _default_username_key(context):
+    # Core の INSERT（インポート・ベンチマークの投入）でもキーが入るよう列の既定値で計算する
+    return normalize_username(context.get_current_parameters().get('username'))
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
+    # normalize_username(username)。重複チェックと前方一致検索はこの列のインデックスを使う
+    username_key = db.Column(db.String(80), nullable=True, index=True, default=_default_username_key)
     password_hash = db.Column(db.String(128), nullable=False)
     # Display name and avatar
     display_name = db.Column(db.String(120), nullable=True)
@@ -30,11 +84,16 @@ class User(db.Model):
     bio = db.Column(db.Text, nullable=True)
 
     posts = db.relationship('Post', backref='author', lazy=True)
-    # 明示的に送信／受信を区別して外部キーを指定
-    sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy=True)
-    received_messages = db.relationship('Message', foreign_keys='Message.recipient_id', backref='recipient', lazy=True)
+    # 明示的に送信／受信を区別して外部キーを指定（メッセージは別 DB に置けるので外部キー制約は持たない）
+    sent_messages = db.relationship('Message', primaryjoin='User.id == foreign(Message.sender_id)', backref='sender', lazy=True)
+    received_messages = db.relationship('Message', primaryjoin='User.id == foreign(Message.recipient_id)', backref='recipient', lazy=True)
     community_follows = db.relationship('CommunityFollow', backref='user', lazy=True, cascade='all, delete-orphan')
 
+    @validates('username')
+    def _sync_username_key(self, key, value):
+        self.username_key = normalize_username(value)
+        return value
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -47,9 +106,11 @@ class Post(db.Model):
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    community_id = db.Column(db.Integer, db.ForeignKey('community.id'), nullable=True)
+    community_id = db.Column(db.Integer, db.ForeignKey('community.id'), nullable=True, index=True)
     # Optional single video attached to a post
     video_filename = db.Column(db.String(255), nullable=True)
+    # 削除の墓標（Community.deleted_at と同じ）
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
     
     # Relationship to images
     images = db.relationship('PostImage', backref='post', lazy=True, cascade='all, delete-orphan')
@@ -59,25 +120,85 @@ class Post(db.Model):
 
 class PostImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     order = db.Column(db.Integer, default=0)  # For maintaining image order
 
 
+def conversation_key(user_id, other_id):
+    """2 人の会話を表すキー（送受信の向きによらず同じ値）。ブロードキャストは None"""
+    if user_id is None or other_id is None:
+        return None
+    low, high = sorted((user_id, other_id))
+    return f'{low}:{high}'
+
+
+def _default_conversation_key(context):
+    params = context.get_current_parameters()
+    return conversation_key(params.get('sender_id'), params.get('recipient_id'))
+
+
 class Message(db.Model):
+    # MESSAGES_DATABASE_URI を設定すると別の SQLite ファイルに置かれる（app/databases.py）
+    __bind_key__ = 'messages'
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # user.id を指すが、別ファイルの DB には外部キー制約を張れないのでアプリ側で整合を保つ
+    sender_id = db.Column(db.Integer, nullable=False)
+    recipient_id = db.Column(db.Integer, nullable=True)
     # Read status tracking
     is_read = db.Column(db.Boolean, default=False, nullable=False)
     read_at = db.Column(db.DateTime, nullable=True)
+    # 会話単位のページングに使う（送信者・受信者は変わらないので INSERT 時にだけ計算する）
+    conversation_key = db.Column(db.String(40), nullable=True, default=_default_conversation_key)
+
+    # AUTOINCREMENT: アーカイブへ移して消した ID を再利用させない（app/archive.py）
+    __table_args__ = (db.Index('ix_message_conversation', 'conversation_key', 'id'), {'sqlite_autoincrement': True})
+
+
+class ArchivedMessage(db.Model):
+    """古い既読メッセージの保管先（app/archive.py が Message から移す。ID はそのまま引き継ぐ）"""
+    __tablename__ = 'message_archive'
+    __bind_key__ = 'messages'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime)
+    sender_id = db.Column(db.Integer, nullable=False)
+    recipient_id = db.Column(db.Integer, nullable=True)
+    is_read = db.Column(db.Boolean, default=True, nullable=False)
+    read_at = db.Column(db.DateTime, nullable=True)
+    conversation_key = db.Column(db.String(40), nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    sender = db.relationship('User', primaryjoin='foreign(ArchivedMessage.sender_id) == User.id')
+    recipient = db.relationship('User', primaryjoin='foreign(ArchivedMessage.recipient_id) == User.id')
+
+    __table_args__ = (db.Index('ix_message_archive_conversation', 'conversation_key', 'id'),)
+
+
+class UnreadCounter(db.Model):
+    """受信者ごとの未読メッセージ数（app/unread.py がメッセージの書き込みと同じトランザクションで更新する）"""
+    __bind_key__ = 'messages'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    unread = db.Column(db.Integer, default=0, nullable=False)
+
+
+class PartnerUnreadCounter(db.Model):
+    """受信者・送信者ごとの未読メッセージ数（UnreadCounter の内訳）"""
+    __bind_key__ = 'messages'
+
+    recipient_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    unread = db.Column(db.Integer, default=0, nullable=False)
 
 
 class Reply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False, index=True)
     parent_id = db.Column(db.Integer, db.ForeignKey('reply.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     body = db.Column(db.Text, nullable=False)
@@ -94,7 +215,7 @@ class Reply(db.Model):
 class CommunityFollow(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    community_id = db.Column(db.Integer, db.ForeignKey('community.id'), nullable=False)
+    community_id = db.Column(db.Integer, db.ForeignKey('community.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __table_args__ = (db.UniqueConstraint('user_id', 'community_id', name='uix_user_community_follow'),)
@@ -103,7 +224,7 @@ class CommunityFollow(db.Model):
 class PostLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uix_user_post_like'),)
@@ -112,7 +233,7 @@ class PostLike(db.Model):
 class ReplyLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    reply_id = db.Column(db.Integer, db.ForeignKey('reply.id'), nullable=False)
+    reply_id = db.Column(db.Integer, db.ForeignKey('reply.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __table_args__ = (db.UniqueConstraint('user_id', 'reply_id', name='uix_user_reply_like'),)
@@ -120,6 +241,22 @@ class ReplyLike(db.Model):
 
 class ReplyImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    reply_id = db.Column(db.Integer, db.ForeignKey('reply.id'), nullable=False)
+    reply_id = db.Column(db.Integer, db.ForeignKey('reply.id'), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     order = db.Column(db.Integer, default=0)
+
+
+class ImportMap(db.Model):
+    """一括インポート時の外部 ID → ローカル ID 対応表（再開用）"""
+    source = db.Column(db.String(120), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)
+    external_id = db.Column(db.String(255), primary_key=True)
+    local_id = db.Column(db.Integer, nullable=False)
+
+
+class ImportCheckpoint(db.Model):
+    """一括インポートの進捗（ファイルごとの処理済みレコード数）"""
+    source = db.Column(db.String(120), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)
+    records_done = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,59 @@
+/**
+ * Infinite scroll for post feeds
+ * The server renders only the first page; when the .feed-sentinel comes into view
+ * the next page is fetched from /api/feed?format=html and the cards are inserted before it.
+ * The cards are rendered server-side from templates/_post_card.html (the same template as
+ * the first page), so like_handler.js and image_carousel.js keep working via their
+ * delegated listeners.
+ */
+
+document.addEventListener('DOMContentLoaded', function() {
+  const sentinel = document.querySelector('.feed-sentinel');
+  if (!sentinel) return;
+
+  let nextCursor = sentinel.dataset.nextCursor;
+  let loading = false;
+
+  function loadMore() {
+    if (loading || !nextCursor) return;
+    loading = true;
+
+    const url = new URL(sentinel.dataset.feedUrl, window.location.origin);
+    url.searchParams.set('cursor', nextCursor);
+    url.searchParams.set('format', 'html');
+
+    fetch(url, { credentials: 'same-origin' })
+      .then(response => {
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+      })
+      .then(data => {
+        sentinel.insertAdjacentHTML('beforebegin', data.html);
+
+        nextCursor = data.next_cursor;
+        if (!nextCursor) {
+          observer.disconnect();
+          sentinel.remove();
+        } else {
+          // Re-observe so a sentinel that is still on screen triggers the next page
+          observer.unobserve(sentinel);
+          observer.observe(sentinel);
+        }
+      })
+      .catch(error => {
+        console.error('[infinite_scroll] Fetch error:', error);
+        sentinel.textContent = '読み込みに失敗しました。クリックで再試行';
+        sentinel.style.cursor = 'pointer';
+      })
+      .finally(() => {
+        loading = false;
+      });
+  }
+
+  sentinel.addEventListener('click', loadMore);
+
+  const observer = new IntersectionObserver(entries => {
+    if (entries.some(entry => entry.isIntersecting)) loadMore();
+  }, { rootMargin: '600px 0px' });
+  observer.observe(sentinel);
+});
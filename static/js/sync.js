@@ -0,0 +1,127 @@
+/**
+ * Single poller for /api/sync
+ * Sends the client state vector (unread total, last message ID and read position
+ * per open thread) and dispatches the changed values to registered handlers.
+ * The server suggests the next poll interval (backs off while the user is idle
+ * or the tab is hidden); user activity polls again immediately.
+ *
+ * Usage:
+ *   Sync.watchThread('alice', lastMessageId, readUpTo);
+ *   Sync.onUpdate(data => { ... });
+ *   Sync.pollNow();
+ */
+
+window.Sync = (function() {
+  const state = {
+    unreadTotal: null,
+    threads: {},
+    partners: false,
+    intervalMs: 0,
+  };
+  const handlers = [];
+  let lastActivity = Date.now();
+  let timer = null;
+  let inFlight = false;
+  let started = false;
+  let url = null;
+
+  function watchThread(username, afterId, readUpTo) {
+    state.threads[username] = { after_id: afterId || 0, read_up_to: readUpTo || 0 };
+  }
+
+  function watchPartners() {
+    state.partners = true;
+  }
+
+  function onUpdate(fn) {
+    handlers.push(fn);
+  }
+
+  function schedule(ms) {
+    clearTimeout(timer);
+    timer = setTimeout(poll, ms);
+  }
+
+  function poll() {
+    if (!url || inFlight) return;
+    inFlight = true;
+    clearTimeout(timer);
+
+    const body = {
+      unread_total: state.unreadTotal,
+      threads: state.threads,
+      partners: state.partners,
+      idle_ms: Date.now() - lastActivity,
+      hidden: document.hidden,
+      interval_ms: state.intervalMs,
+    };
+
+    fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      credentials: 'same-origin',
+      body: JSON.stringify(body),
+    })
+      .then(response => {
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+      })
+      .then(data => {
+        if (data.unread_total !== undefined) state.unreadTotal = data.unread_total;
+        Object.entries(data.threads || {}).forEach(([username, thread]) => {
+          const t = state.threads[username];
+          if (!t) return;
+          if (thread.messages && thread.messages.length) {
+            t.after_id = Math.max(t.after_id, thread.messages[thread.messages.length - 1].id);
+          }
+          if (thread.read_up_to !== undefined) t.read_up_to = thread.read_up_to;
+        });
+        handlers.forEach(fn => {
+          try {
+            fn(data);
+          } catch (e) {
+            console.error('[sync] handler error', e);
+          }
+        });
+        state.intervalMs = data.next_poll_ms || 5000;
+      })
+      .catch(error => {
+        console.log('[sync] poll error', error);
+        state.intervalMs = Math.min((state.intervalMs || 5000) * 2, 30000);
+      })
+      .finally(() => {
+        inFlight = false;
+        schedule(state.intervalMs);
+      });
+  }
+
+  function pollNow() {
+    poll();
+  }
+
+  function markActive() {
+    const wasIdle = state.intervalMs > 5000;
+    lastActivity = Date.now();
+    // Backed off while idle: catch up right away instead of waiting out the long interval
+    if (wasIdle && started) pollNow();
+  }
+
+  function start() {
+    url = document.body.dataset.syncUrl;
+    if (!url) return;
+    const initial = parseInt(document.body.dataset.unreadTotal, 10);
+    if (!isNaN(initial)) state.unreadTotal = initial;
+    started = true;
+    poll();
+  }
+
+  ['mousemove', 'keydown', 'scroll', 'touchstart', 'focus'].forEach(type => {
+    window.addEventListener(type, markActive, { passive: true, capture: true });
+  });
+  document.addEventListener('visibilitychange', () => {
+    if (!document.hidden) markActive();
+  });
+  document.addEventListener('DOMContentLoaded', start);
+
+  return { watchThread, watchPartners, onUpdate, pollNow };
+})();
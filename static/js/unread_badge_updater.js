@@ -1,55 +1,50 @@
 /**
- * Update unread message badge after reading messages
- * Calls the unread count API and updates the badge in the navbar
+ * Update unread message badges from /api/sync results
+ * Updates the navbar badge and, on the messages page, the per-partner badges
  */
 
 document.addEventListener('DOMContentLoaded', function() {
-  // Function to update unread badge
-  function updateUnreadBadge() {
-    fetch('/api/unread-count')
-      .then(response => response.json())
-      .then(data => {
-        const unreadCount = data.unread_count;
-        const badgeElement = document.getElementById('unread-badge');
-        
-        if (badgeElement) {
-          if (unreadCount > 0) {
-            badgeElement.textContent = unreadCount;
-            badgeElement.style.display = 'inline-block';
-          } else {
-            badgeElement.style.display = 'none';
-          }
-        }
+  if (!window.Sync) return;
 
-        // Also update partner conversation list badges if on messages page
-        const partners = document.querySelectorAll('[data-partner-username]');
-        partners.forEach(partner => {
-          const username = partner.dataset.partnerUsername;
-          const badgeEl = partner.querySelector('.partner-unread-badge');
-          if (badgeEl) {
-            // Get unread count for this specific partner from the element
-            const count = parseInt(badgeEl.dataset.unreadCount || 0);
-            if (count > 0 && !badgeEl.textContent) {
-              badgeEl.textContent = count;
-            }
-          }
-        });
-      })
-      .catch(err => console.error('Failed to update unread badge:', err));
+  const partnerLinks = document.querySelectorAll('[data-partner-username]');
+  if (partnerLinks.length) {
+    Sync.watchPartners();
   }
 
-  // Update badge on page load
-  updateUnreadBadge();
-
-  // If on messages thread or messages page, update badge after a short delay
-  // (to account for the is_read flag being set on the server)
-  const chatDiv = document.querySelector('.chat');
-  if (chatDiv) {
-    setTimeout(updateUnreadBadge, 500);
+  function updateUnreadBadge(unreadCount) {
+    const badgeElement = document.getElementById('unread-badge');
+    if (!badgeElement) return;
+    if (unreadCount > 0) {
+      badgeElement.textContent = unreadCount;
+      badgeElement.style.display = 'inline-block';
+    } else {
+      badgeElement.style.display = 'none';
+    }
   }
 
-  // Periodically update unread badge every 5 seconds while viewing messages
-  if (chatDiv) {
-    setInterval(updateUnreadBadge, 5000);
+  function updatePartnerBadges(partners) {
+    document.querySelectorAll('[data-partner-username]').forEach(partnerLink => {
+      const unreadCount = partners[partnerLink.dataset.partnerUsername] || 0;
+      let badgeEl = partnerLink.querySelector('.partner-unread-badge');
+      if (unreadCount > 0) {
+        if (!badgeEl) {
+          // Create badge if it doesn't exist
+          badgeEl = document.createElement('span');
+          badgeEl.className = 'badge bg-danger rounded-pill partner-unread-badge';
+          partnerLink.appendChild(badgeEl);
+        }
+        badgeEl.dataset.unreadCount = unreadCount;
+        badgeEl.textContent = unreadCount;
+        badgeEl.style.display = 'inline-block';
+      } else if (badgeEl) {
+        // Remove badge if count is 0
+        badgeEl.remove();
+      }
+    });
   }
+
+  Sync.onUpdate(data => {
+    if (data.unread_total !== undefined) updateUnreadBadge(data.unread_total);
+    if (data.partners) updatePartnerBadges(data.partners);
+  });
 });
@@ -0,0 +1,45 @@
+/**
+ * Username autocomplete for inputs with data-autocomplete-url
+ * Fills the input's <datalist> with prefix matches from /api/users/suggest
+ */
+
+document.addEventListener('DOMContentLoaded', function() {
+  document.querySelectorAll('input[data-autocomplete-url]').forEach(input => {
+    const list = document.getElementById(input.getAttribute('list'));
+    if (!list) return;
+    let timer = null;
+    let lastQuery = null;
+    let controller = null;
+
+    function render(users) {
+      list.replaceChildren(...users.map(u => {
+        const option = document.createElement('option');
+        option.value = u.username;
+        if (u.display_name && u.display_name !== u.username) option.label = u.display_name;
+        return option;
+      }));
+    }
+
+    function suggest() {
+      const q = input.value.trim();
+      if (q === lastQuery) return;
+      lastQuery = q;
+      if (!q) {
+        render([]);
+        return;
+      }
+      if (controller) controller.abort();
+      controller = new AbortController();
+      const url = `${input.dataset.autocompleteUrl}?q=${encodeURIComponent(q)}`;
+      fetch(url, { signal: controller.signal, headers: { 'Accept': 'application/json' } })
+        .then(response => response.ok ? response.json() : { users: [] })
+        .then(data => render(data.users || []))
+        .catch(() => {});
+    }
+
+    input.addEventListener('input', function() {
+      clearTimeout(timer);
+      timer = setTimeout(suggest, 150);
+    });
+  });
+});
@@ -0,0 +1,57 @@
+"""フラグメントキャッシュのスロット差し込み（app/fragment_cache.py）"""
+import pytest
+
+from app import create_app, fragment_cache
+from models import db, Community, CommunityFollow, Post, Reply, User
+
+# 本文に入れる、旧来の区切り文字やスロットに似た文字列
+TRICKY_BODIES = ['hithere', 'time', 'x?ownery']
+
+
+def test_compile_fragment_ignores_private_use_characters_in_text():
+    html = f"<p>{TRICKY_BODIES[0]}</p>{fragment_cache.slot('time')}<p>{TRICKY_BODIES[1]}</p>"
+    parts = fragment_cache.compile_fragment(html)
+    assert parts == (f'<p>{TRICKY_BODIES[0]}</p>', 'time', f'<p>{TRICKY_BODIES[1]}</p>')
+    assert fragment_cache.splice(parts, {'time': '1分前'}, {}) == (
+        f'<p>{TRICKY_BODIES[0]}</p>1分前<p>{TRICKY_BODIES[1]}</p>')
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'REAPER_INTERVAL': 0,
+    })
+    with app.app_context():
+        u = User(username='alice')
+        u.set_password('pw')
+        db.session.add(u)
+        db.session.flush()
+        c = Community(name='テスト', created_by=u.id)
+        db.session.add(c)
+        db.session.flush()
+        db.session.add(CommunityFollow(user_id=u.id, community_id=c.id))
+        for body in TRICKY_BODIES:
+            p = Post(body=body, user_id=u.id, community_id=c.id)
+            db.session.add(p)
+            db.session.flush()
+            db.session.add(Reply(post_id=p.id, user_id=u.id, body=body))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    return client
+
+
+@pytest.mark.parametrize('url', ['/?tab=latest', '/post/1', '/post/2', '/post/3'])
+def test_cards_render_bodies_with_private_use_characters(client, url):
+    # 2 回目はキャッシュ済みのフラグメントから描画される
+    for _ in range(2):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        html = resp.get_data(as_text=True)
+        assert fragment_cache.SLOT_TOKEN not in html
+        if url.startswith('/post/'):
+            assert html.count(TRICKY_BODIES[int(url[-1]) - 1]) >= 2  # 投稿と返信
+        else:
+            assert all(body in html for body in TRICKY_BODIES)